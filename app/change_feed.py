@@ -0,0 +1,159 @@
+"""Pushes each change to a graph to the processes serving it, so that their
+cached copies (see utils) are brought up to date within milliseconds of the
+write, by applying the change rather than reading the graph again.
+
+A change is published as its delta, with the versions of the graph before and
+after it. A reader whose cached graph is at the version before applies the
+delta in place; any other reader (e.g. one that missed a change) revalidates
+its copy against storage instead. Changes are pushed through a transport,
+chosen by KG_CHANGE_FEED:
+
+    (unset)          none; readers find changes when revalidating
+    local            within this process
+    unix:///{dir}    to every process of the host subscribed in dir, by Unix
+                     datagram sockets; changes too large for a datagram are
+                     sent without their delta
+"""
+import functools
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+from dataclasses import asdict, dataclass
+from typing import Callable, Optional, Protocol
+
+import metrics
+
+# Larger datagrams may be refused, depending on the host's socket buffers.
+MAX_DATAGRAM_BYTES = int(os.environ.get('KG_CHANGE_FEED_MAX_DATAGRAM_BYTES', 200_000))
+
+
+@dataclass
+class Change:
+    graph_id: str
+    base_version: tuple[int, int]
+    version: tuple[int, int]
+    # {'remove_subgraph': ..., 'add_subgraph': ...}, or None if omitted.
+    delta: Optional[dict]
+
+    def to_json(self) -> bytes:
+        return json.dumps(asdict(self)).encode()
+
+    @classmethod
+    def from_json(cls, data: bytes) -> "Change":
+        fields = json.loads(data)
+        return cls(
+            graph_id=fields['graph_id'],
+            base_version=tuple(fields['base_version']),
+            version=tuple(fields['version']),
+            delta=fields['delta'])
+
+
+Subscriber = Callable[[Change], None]
+
+
+class Transport(Protocol):
+    def publish(self, change: Change) -> None:
+        ...
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        """Has subscriber called with every change published from now on,
+        in the publishing thread or a background one."""
+        ...
+
+
+class LocalTransport:
+    def __init__(self):
+        self._subscribers: list[Subscriber] = []
+
+    def publish(self, change: Change) -> None:
+        for subscriber in list(self._subscribers):
+            # A copy, as other transports deliver, so the writer's objects aren't shared.
+            _deliver(subscriber, Change.from_json(change.to_json()))
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        self._subscribers.append(subscriber)
+
+
+class UnixSocketTransport:
+    """Sends each change to every socket `{directory}/{pid}.sock`, each
+    bound by a subscribed process."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def publish(self, change: Change) -> None:
+        data = change.to_json()
+        if len(data) > MAX_DATAGRAM_BYTES:
+            metrics.increment('change_feed.deltas_omitted')
+            change = Change(change.graph_id, change.base_version, change.version, delta=None)
+            data = change.to_json()
+
+        for path in glob.glob(os.path.join(glob.escape(self.directory), '*.sock')):
+            try:
+                self._socket.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Its process is gone.
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            except OSError:
+                logging.warning('Change not sent.', exc_info=True, extra={'json_fields': {'path': path}})
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.sock')
+        if os.path.exists(path):
+            os.remove(path)
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(path)
+        threading.Thread(target=self._receive, args=(receiver, subscriber), daemon=True).start()
+
+    def _receive(self, receiver: socket.socket, subscriber: Subscriber) -> None:
+        while True:
+            data = receiver.recv(MAX_DATAGRAM_BYTES)
+            try:
+                change = Change.from_json(data)
+            except (ValueError, KeyError):
+                logging.warning('Malformed change received.', exc_info=True)
+                continue
+            _deliver(subscriber, change)
+
+
+@functools.cache
+def get_change_feed() -> Optional[Transport]:
+    """Returns the process's transport, as configured by KG_CHANGE_FEED, or
+    None if changes aren't pushed."""
+    kind = os.environ.get('KG_CHANGE_FEED', '')
+    if not kind:
+        return None
+    if kind == 'local':
+        return LocalTransport()
+    if kind.startswith('unix:///'):
+        return UnixSocketTransport(kind[len('unix://'):])
+    raise ValueError(f'Unknown change feed: {kind}')
+
+
+def publish(graph_id: str, base_version: tuple[int, int], version: tuple[int, int], delta: dict) -> None:
+    """Publishes a change to the graph, if changes are pushed."""
+    if (feed := get_change_feed()) is None:
+        return
+    try:
+        feed.publish(Change(graph_id, base_version, version, delta))
+        metrics.increment('change_feed.published')
+    except Exception:
+        # Readers still find the change when revalidating.
+        metrics.increment('change_feed.publish_failures')
+        logging.warning('Change not published.', exc_info=True, extra={'json_fields': {'graph_id': graph_id}})
+
+
+def _deliver(subscriber: Subscriber, change: Change) -> None:
+    try:
+        subscriber(change)
+    except Exception:
+        metrics.increment('change_feed.subscriber_failures')
+        logging.exception('Change not applied.', extra={'json_fields': {'graph_id': change.graph_id}})
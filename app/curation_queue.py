@@ -0,0 +1,316 @@
+"""Schedules knowledge curation runs, so that bursts of /curate_knowledge
+requests neither start unbounded numbers of agent runs nor race each other's
+read-modify-writes of a graph.
+
+Requests are queued, up to KG_CURATION_QUEUE_SIZE of them, and run by
+KG_CURATION_CONCURRENCY workers per process, at most
+KG_CURATION_GRAPH_CONCURRENCY of them on the same graph at once (one, i.e.
+serialized per graph, by default). Submitting to a full queue raises
+QueueFull.
+
+The queue is kept by a backend, chosen by KG_CURATION_QUEUE:
+
+    memory            in-process (the default)
+    sqlite:///{path}  a SQLite database, which every process of a host using
+                      it takes jobs from, with the per-graph limit applied
+                      across them
+
+A job claimed by a process that dies is claimed again once its lease, of
+KG_CURATION_LEASE_SECONDS, has expired.
+
+With KG_CURATION_BATCH_WINDOW_SECONDS set, jobs of the same graph and user
+are held for that long after the first is queued, and then run as one, with
+their queries joined, so that a user's burst of snippets costs one agent run
+and one write of the graph. A batch holds at most KG_CURATION_MAX_BATCH jobs,
+and runs as soon as it is full.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Protocol
+
+import metrics
+
+
+class QueueFull(Exception):
+    """The curation queue has no room for another job."""
+
+
+@dataclass
+class Job:
+    id: int
+    graph_id: str
+    user_id: str
+    query: str
+    enqueued_at: float
+
+
+class QueueBackend(Protocol):
+    def put(self, graph_id: str, user_id: str, query: str) -> bool:
+        """Queues a job, unless the queue is full. Returns whether it was queued."""
+        ...
+
+    def claim(self, max_per_graph: int, window: float = 0, max_batch: int = 1) -> list[Job]:
+        """Returns the oldest queued job whose graph has fewer than
+        max_per_graph batches running, with up to max_batch - 1 later jobs of
+        the same graph and user, marked as running as one batch. Returns no
+        jobs if there are none, or if the oldest has been queued for less than
+        window seconds and the batch isn't full."""
+        ...
+
+    def finish(self, jobs: list[Job]) -> None:
+        """Removes a claimed batch from the queue."""
+        ...
+
+    def depth(self) -> int:
+        """Returns the number of jobs queued and not yet claimed."""
+        ...
+
+
+class MemoryQueueBackend:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pending: deque[Job] = deque()
+        self._running: defaultdict[str, int] = defaultdict(int)
+        self._next_id = 0
+
+    def put(self, graph_id: str, user_id: str, query: str) -> bool:
+        with self._lock:
+            if len(self._pending) >= self.max_size:
+                return False
+            self._next_id += 1
+            self._pending.append(Job(self._next_id, graph_id, user_id, query, time.time()))
+            return True
+
+    def claim(self, max_per_graph: int, window: float = 0, max_batch: int = 1) -> list[Job]:
+        now = time.time()
+        with self._lock:
+            seen = set()
+            for job in self._pending:
+                key = job.graph_id, job.user_id
+                if key in seen or self._running[job.graph_id] >= max_per_graph:
+                    continue
+                seen.add(key)
+                batch = [other for other in self._pending if (other.graph_id, other.user_id) == key]
+                batch = batch[:max_batch]
+                if now - job.enqueued_at < window and len(batch) < max_batch:
+                    continue
+                for other in batch:
+                    self._pending.remove(other)
+                self._running[job.graph_id] += 1
+                return batch
+            return []
+
+    def finish(self, jobs: list[Job]) -> None:
+        graph_id = jobs[0].graph_id
+        with self._lock:
+            self._running[graph_id] -= 1
+            if not self._running[graph_id]:
+                del self._running[graph_id]
+
+    def depth(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+
+class SqliteQueueBackend:
+    """Keeps the queue in a SQLite database, which several processes can
+    share. Jobs are claimed by stamping them with the time they were claimed,
+    and the ID of the first job of their batch."""
+
+    def __init__(self, path: str, max_size: int, lease: float):
+        self.path = path
+        self.max_size = max_size
+        self.lease = lease
+        self._local = threading.local()
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS curation_job (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    graph_id TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    enqueued_at REAL NOT NULL,
+                    claimed_at REAL,
+                    batch_id INTEGER
+                )""")
+
+    def put(self, graph_id: str, user_id: str, query: str) -> bool:
+        with self._transaction() as db:
+            (depth,) = db.execute(
+                    'SELECT COUNT(*) FROM curation_job WHERE claimed_at IS NULL').fetchone()
+            if depth >= self.max_size:
+                return False
+            db.execute(
+                    'INSERT INTO curation_job (graph_id, user_id, query, enqueued_at) VALUES (?, ?, ?, ?)',
+                    (graph_id, user_id, query, time.time()))
+            return True
+
+    def claim(self, max_per_graph: int, window: float = 0, max_batch: int = 1) -> list[Job]:
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                    'UPDATE curation_job SET claimed_at = NULL, batch_id = NULL WHERE claimed_at < ?',
+                    (now - self.lease,))
+            key = db.execute("""
+                SELECT graph_id, user_id
+                FROM curation_job
+                WHERE claimed_at IS NULL AND graph_id NOT IN (
+                    SELECT graph_id FROM curation_job
+                    WHERE claimed_at IS NOT NULL
+                    GROUP BY graph_id HAVING COUNT(DISTINCT batch_id) >= ?)
+                GROUP BY graph_id, user_id
+                HAVING MIN(enqueued_at) <= ? OR COUNT(*) >= ?
+                ORDER BY MIN(id)
+                LIMIT 1""", (max_per_graph, now - window, max_batch)).fetchone()
+            if key is None:
+                return []
+            rows = db.execute("""
+                SELECT id, graph_id, user_id, query, enqueued_at
+                FROM curation_job
+                WHERE claimed_at IS NULL AND graph_id = ? AND user_id = ?
+                ORDER BY id
+                LIMIT ?""", (*key, max_batch)).fetchall()
+            db.executemany(
+                    'UPDATE curation_job SET claimed_at = ?, batch_id = ? WHERE id = ?',
+                    [(now, rows[0][0], row[0]) for row in rows])
+            return [Job(*row) for row in rows]
+
+    def finish(self, jobs: list[Job]) -> None:
+        with self._transaction() as db:
+            db.executemany('DELETE FROM curation_job WHERE id = ?', [(job.id,) for job in jobs])
+
+    def depth(self) -> int:
+        (depth,) = self._connection().execute(
+                'SELECT COUNT(*) FROM curation_job WHERE claimed_at IS NULL').fetchone()
+        return depth
+
+    def _connection(self) -> sqlite3.Connection:
+        if (db := getattr(self._local, 'db', None)) is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+
+class _Transaction:
+    """Holds the database's write lock from the start, so that reads and
+    writes within it are atomic across processes."""
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+class CurationScheduler:
+    """Runs queued jobs in worker tasks of the running event loop."""
+
+    def __init__(
+            self, run: Callable[..., Awaitable], backend: QueueBackend,
+            concurrency: int = 4, max_per_graph: int = 1, poll_interval: float = 1.0,
+            batch_window: float = 0, max_batch: int = 1):
+        self.run = run
+        self.backend = backend
+        self.concurrency = concurrency
+        self.max_per_graph = max_per_graph
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        # How often idle workers look for jobs queued by other processes.
+        self.poll_interval = poll_interval
+        self._workers: list[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    @classmethod
+    def from_env(cls, run: Callable[..., Awaitable]) -> "CurationScheduler":
+        max_size = int(os.environ.get('KG_CURATION_QUEUE_SIZE', 100))
+        queue = os.environ.get('KG_CURATION_QUEUE', 'memory')
+        if queue == 'memory':
+            backend = MemoryQueueBackend(max_size)
+        elif queue.startswith('sqlite:///'):
+            backend = SqliteQueueBackend(
+                    queue[len('sqlite:///'):], max_size,
+                    lease=float(os.environ.get('KG_CURATION_LEASE_SECONDS', 3600)))
+        else:
+            raise ValueError(f'Unknown curation queue: {queue}')
+        return cls(
+            run, backend,
+            concurrency=int(os.environ.get('KG_CURATION_CONCURRENCY', 4)),
+            max_per_graph=int(os.environ.get('KG_CURATION_GRAPH_CONCURRENCY', 1)),
+            batch_window=float(os.environ.get('KG_CURATION_BATCH_WINDOW_SECONDS', 0)),
+            max_batch=int(os.environ.get('KG_CURATION_MAX_BATCH', 10)))
+
+    def start(self) -> None:
+        """Starts the workers, if not already started."""
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        """Cancels the workers. Jobs they were running are run again once
+        their leases expire, if the backend is persistent."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, graph_id: str, user_id: str, query: str) -> None:
+        """Queues a curation run. Raises QueueFull if the queue is full."""
+        self.start()
+        if not await asyncio.to_thread(self.backend.put, graph_id, user_id, query):
+            metrics.increment('curation.rejected')
+            raise QueueFull()
+        metrics.increment('curation.submitted')
+        self._wakeup.set()
+
+    async def _work(self) -> None:
+        while True:
+            self._wakeup.clear()
+            jobs = await asyncio.to_thread(
+                    self.backend.claim, self.max_per_graph,
+                    window=self.batch_window,
+                    max_batch=self.max_batch if self.batch_window > 0 else 1)
+            metrics.set_gauge('curation.queue_depth', await asyncio.to_thread(self.backend.depth))
+            if not jobs:
+                # Held batches are ready once their window has passed.
+                timeout = min(self.poll_interval, self.batch_window or self.poll_interval)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.time()
+            for job in jobs:
+                metrics.observe('curation.wait_ms', 1000 * (now - job.enqueued_at))
+            metrics.increment('curation.coalesced', len(jobs) - 1)
+            graph_id, user_id = jobs[0].graph_id, jobs[0].user_id
+            start = time.perf_counter()
+            try:
+                await self.run(
+                        graph_id=graph_id, user_id=user_id,
+                        query='\n\n'.join(job.query for job in jobs))
+                metrics.increment('curation.completed', len(jobs))
+            except Exception:
+                metrics.increment('curation.failures', len(jobs))
+                logging.exception(
+                    'Curation failed.',
+                    extra={'json_fields': {'graph_id': graph_id, 'user_id': user_id, 'jobs': len(jobs)}})
+            finally:
+                metrics.observe('curation.run_ms', 1000 * (time.perf_counter() - start))
+                await asyncio.to_thread(self.backend.finish, jobs)
+                self._wakeup.set()
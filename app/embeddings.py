@@ -0,0 +1,124 @@
+"""Embeddings of entities and relationships, for semantic retrieval.
+
+The embedder is chosen by KG_EMBEDDER:
+
+    genai    Gemini text embeddings (model KG_EMBEDDING_MODEL), via google-genai
+    hashing  a local, deterministic stand-in, embedding the hashed words and
+             character trigrams of a text, for tests and benchmarks
+
+Embeddings have DIMENSION components, as the Spanner schema's embedding
+columns do, and unit length, so that cosine similarity is a dot product.
+"""
+import functools
+import hashlib
+import json
+import math
+import os
+import re
+from typing import Protocol
+
+DIMENSION = 768
+BATCH_SIZE = int(os.environ.get('KG_EMBEDDING_BATCH_SIZE', 100))
+
+
+class Embedder(Protocol):
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embeds texts to be retrieved, e.g. entities."""
+        ...
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embeds a text to retrieve others by."""
+        ...
+
+
+class HashingEmbedder:
+    """Sums a signed, hashed basis vector per word and character trigram."""
+
+    def __init__(self, dimension: int = DIMENSION):
+        self.dimension = dimension
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        vector = [0.0] * self.dimension
+        for feature in _features(text):
+            h = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+            vector[(h >> 1) % self.dimension] += 1.0 if h & 1 else -1.0
+        return _normalize(vector)
+
+
+class GenaiEmbedder:
+    def __init__(self, model: str, dimension: int = DIMENSION):
+        from google import genai
+
+        self.model = model
+        self.dimension = dimension
+        self._client = genai.Client()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed(texts, task_type='RETRIEVAL_DOCUMENT')
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed([text], task_type='RETRIEVAL_QUERY')[0]
+
+    def _embed(self, texts: list[str], task_type: str) -> list[list[float]]:
+        from google.genai import types
+
+        response = self._client.models.embed_content(
+                model=self.model, contents=texts,
+                config=types.EmbedContentConfig(
+                    task_type=task_type, output_dimensionality=self.dimension))
+        # Truncated embeddings are not normalized.
+        return [_normalize(embedding.values) for embedding in response.embeddings]
+
+
+@functools.cache
+def get_embedder() -> Embedder:
+    """Returns the process's embedder, as configured by KG_EMBEDDER."""
+    kind = os.environ.get('KG_EMBEDDER', 'genai')
+    if kind == 'hashing':
+        return HashingEmbedder()
+    if kind == 'genai':
+        return GenaiEmbedder(model=os.environ.get('KG_EMBEDDING_MODEL', 'gemini-embedding-001'))
+    raise ValueError(f'Unknown embedder: {kind}')
+
+
+def embed_documents(embedder: Embedder, texts: list[str]) -> list[list[float]]:
+    """Embeds texts in batches of at most BATCH_SIZE."""
+    embeddings = []
+    for start in range(0, len(texts), BATCH_SIZE):
+        embeddings.extend(embedder.embed_documents(texts[start:start + BATCH_SIZE]))
+    return embeddings
+
+
+def entity_text(entity: dict) -> str:
+    """Returns the text an entity is embedded as: its names, then properties."""
+    text = '; '.join(entity.get('entity_names', []))
+    if properties := entity.get('properties'):
+        text += '\n' + json.dumps(properties, sort_keys=True, ensure_ascii=False)
+    return text
+
+
+def relationship_text(rel: dict, entities: dict) -> str:
+    """Returns the text a relationship is embedded as, naming its endpoints
+    by their primary names if they are among entities, else by ID."""
+    def name(entity_id: str) -> str:
+        names = entities.get(entity_id, {}).get('entity_names')
+        return names[0] if names else entity_id
+
+    return f"{name(rel['source_entity_id'])} {rel['relationship']} {name(rel['target_entity_id'])}"
+
+
+def _features(text: str) -> list[str]:
+    words = re.findall(r'\w+', text.lower())
+    features = [f'w:{word}' for word in words]
+    for word in words:
+        padded = f' {word} '
+        features.extend(f'c:{padded[i:i + 3]}' for i in range(len(padded) - 2))
+    return features
+
+
+def _normalize(vector) -> list[float]:
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm else list(vector)
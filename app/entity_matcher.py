@@ -0,0 +1,183 @@
+import threading
+from typing import Iterable
+
+
+class EntityMatcher:
+    """Aho-Corasick automaton over the (lowercased) names of a graph's entities.
+
+    Finds every entity having a name that occurs in a query, in time linear in
+    the query length plus the number of matches. Entities can be added and
+    removed in place; failure links are recomputed lazily on the next match.
+    """
+
+    def __init__(self, entities: dict):
+        self._lock = threading.Lock()
+        self._names: dict[str, list[str]] = {}
+        self._reset()
+        for entity_id, entity_names in _entity_names(entities):
+            self._add(entity_id, entity_names)
+
+    def add_entity(self, entity_id: str, entity_names: list[str]) -> None:
+        with self._lock:
+            self._remove(entity_id)
+            self._add(entity_id, entity_names)
+
+    def remove_entity(self, entity_id: str) -> None:
+        with self._lock:
+            self._remove(entity_id)
+
+    def rebase(self, entities: dict, old_entities: dict) -> "EntityMatcher":
+        """Updates the matcher in place from old_entities to entities."""
+        if hasattr(entities, 'changes_since') and (
+                narrowed := entities.changes_since(old_entities)) is not None:
+            entities, old_entities = narrowed
+        old_names = dict(_entity_names(old_entities))
+        with self._lock:
+            for entity_id in old_names.keys() - entities.keys():
+                self._remove(entity_id)
+            for entity_id, entity_names in _entity_names(entities):
+                if old_names.get(entity_id) != entity_names:
+                    self._remove(entity_id)
+                    self._add(entity_id, entity_names)
+        return self
+
+    def match(self, query: str, word_boundary: bool = False) -> set[str]:
+        """Returns the IDs of entities having a name that occurs in query,
+        ignoring case. With word_boundary, a name must also start and end at
+        word boundaries of the query."""
+        with self._lock:
+            self._compile()
+            return self._match(query.lower(), word_boundary)
+
+    def match_batch(self, queries: list[str], word_boundary: bool = False) -> list[set[str]]:
+        """Like match, for each of queries, compiling and locking the matcher
+        once and matching repeated queries once."""
+        matches: dict[str, set[str]] = {}
+        with self._lock:
+            self._compile()
+            for query in queries:
+                if (query := query.lower()) not in matches:
+                    matches[query] = self._match(query, word_boundary)
+        return [set(matches[query.lower()]) for query in queries]
+
+    def _match(self, query: str, word_boundary: bool) -> set[str]:
+        matches = set()
+        if not word_boundary:
+            matches.update(self._out[0])
+
+        state = 0
+        for end, char in enumerate(query):
+            while char not in self._goto[state] and state:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+
+            node = state if self._out[state] else self._dict_link[state]
+            while node:
+                if not word_boundary or _is_bounded(query, end + 1 - self._depth[node], end + 1):
+                    matches.update(self._out[node])
+                node = self._dict_link[node]
+
+        return matches
+
+    def compile(self) -> None:
+        """Brings failure links up to date now, rather than on the next match."""
+        with self._lock:
+            self._compile()
+
+    def _compile(self) -> None:
+        if self._stale:
+            self._link()
+
+    def _reset(self) -> None:
+        self._goto: list[dict[str, int]] = [{}]
+        self._depth: list[int] = [0]
+        # Entity ID -> number of its names ending at the node.
+        self._out: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._dict_link: list[int] = [0]
+        self._num_names = 0
+        self._num_removed = 0
+        self._stale = False
+
+    def _add(self, entity_id: str, entity_names: list[str]) -> None:
+        names = [name.lower() for name in entity_names]
+        self._names[entity_id] = names
+        self._num_names += len(names)
+        for name in names:
+            node = 0
+            for char in name:
+                if (child := self._goto[node].get(char)) is None:
+                    child = self._goto[node][char] = len(self._goto)
+                    self._goto.append({})
+                    self._depth.append(self._depth[node] + 1)
+                    self._out.append({})
+                node = child
+            self._out[node][entity_id] = self._out[node].get(entity_id, 0) + 1
+        self._stale = True
+
+    def _remove(self, entity_id: str) -> None:
+        for name in self._names.pop(entity_id, []):
+            node = 0
+            for char in name:
+                node = self._goto[node][char]
+            if self._out[node][entity_id] > 1:
+                self._out[node][entity_id] -= 1
+            else:
+                del self._out[node][entity_id]
+            self._num_names -= 1
+            self._num_removed += 1
+        self._stale = True
+
+        # Trie nodes are never unlinked; rebuild once most of them are dead.
+        if self._num_removed > self._num_names:
+            names, self._names = self._names, {}
+            self._reset()
+            for other_id, other_names in names.items():
+                self._add(other_id, other_names)
+
+    def _link(self) -> None:
+        """Recomputes failure and output links breadth-first."""
+        self._fail = [0] * len(self._goto)
+        self._dict_link = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while char not in self._goto[fail] and fail:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[child] = fail
+                self._dict_link[child] = fail if self._out[fail] else self._dict_link[fail]
+                queue.append(child)
+        self._stale = False
+
+
+def _entity_names(entities) -> Iterable[tuple[str, list[str]]]:
+    """Yields (entity ID, names) pairs, cheaply if entities are a snapshot's."""
+    if hasattr(entities, 'entity_names'):
+        return entities.entity_names()
+    return ((entity_id, entity['entity_names']) for entity_id, entity in entities.items())
+
+
+def substrings(query: str, max_length: int, word_boundary: bool = False) -> set[str]:
+    """Returns the (lowercased) substrings of query, of at most max_length
+    characters, that an entity name must equal to match the query."""
+    query = query.lower()
+    found = set() if word_boundary else {''}
+    for start in range(len(query)):
+        for end in range(start + 1, min(start + max_length, len(query)) + 1):
+            if not word_boundary or _is_bounded(query, start, end):
+                found.add(query[start:end])
+    return found
+
+
+def _is_bounded(text: str, start: int, end: int) -> bool:
+    """Whether text[start:end] is delimited by non-word characters."""
+    return (
+        (start == 0 or not _is_word_char(text[start - 1]))
+        and (end == len(text) or not _is_word_char(text[end]))
+    )
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
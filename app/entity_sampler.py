@@ -0,0 +1,121 @@
+"""Random draws of a graph's entities, in O(1) each.
+
+An EntitySampler is built once per graph version, with one of the weightings:
+
+    uniform    every entity equally
+    degree     in proportion to the entity's number of relationships
+    recency    halving with every KG_SAMPLE_HALF_LIFE_DAYS since the entity
+               was last updated (entities never updated count as that old)
+    connected  uniformly among entities with at least one relationship
+
+Weighted draws use an alias table (Vose's method): one uniform draw of a
+slot, then one biased coin between the slot's entity and its alias.
+"""
+import datetime as dt
+import os
+import random
+from array import array
+from typing import Optional
+
+from graph_index import AdjacencyIndex
+
+WEIGHTINGS = ('uniform', 'degree', 'recency', 'connected')
+HALF_LIFE_DAYS = float(os.environ.get('KG_SAMPLE_HALF_LIFE_DAYS', 30))
+
+
+class EntitySampler:
+    def __init__(self, graph: dict, index: AdjacencyIndex, weighting: str = 'uniform'):
+        entity_ids = list(graph['entities'])
+        if weighting == 'uniform':
+            weights = None
+        elif weighting == 'degree':
+            weights = [_degree(index, entity_id) for entity_id in entity_ids]
+        elif weighting == 'connected':
+            entity_ids = [entity_id for entity_id in entity_ids if _degree(index, entity_id)]
+            weights = None
+        elif weighting == 'recency':
+            now = dt.datetime.now(dt.UTC)
+            weights = [
+                    0.5 ** (_age_days(graph['entities'][entity_id], now) / HALF_LIFE_DAYS)
+                    for entity_id in entity_ids]
+        else:
+            raise ValueError(f'Unknown weighting: {weighting}')
+
+        if weights is not None:
+            # Entities that can't be drawn would only take up slots.
+            entity_ids, weights = (
+                    [entity_id for entity_id, w in zip(entity_ids, weights) if w > 0],
+                    [w for w in weights if w > 0])
+
+        self.entity_ids = entity_ids
+        self._prob, self._alias = _alias_table(weights) if weights is not None else (None, None)
+
+    def __len__(self) -> int:
+        return len(self.entity_ids)
+
+    def draw(self) -> Optional[str]:
+        """Returns a random entity ID, or None if there are none to draw."""
+        if not self.entity_ids:
+            return None
+        slot = random.randrange(len(self.entity_ids))
+        if self._prob is not None and random.random() >= self._prob[slot]:
+            slot = self._alias[slot]
+        return self.entity_ids[slot]
+
+    def draw_distinct(self, count: int) -> list[str]:
+        """Returns count distinct random entity IDs (or all, if there are
+        fewer), drawn without replacement."""
+        if count >= len(self.entity_ids):
+            entity_ids = list(self.entity_ids)
+            random.shuffle(entity_ids)
+            return entity_ids
+
+        drawn = {}
+        # Redraws are rare unless count is most of the entities, or a few
+        # entities carry most of the weight; then give up on weighting.
+        for _ in range(8 * count):
+            if len(drawn) == count:
+                break
+            drawn.setdefault(self.draw(), None)
+        else:
+            remaining = [entity_id for entity_id in self.entity_ids if entity_id not in drawn]
+            drawn.update((entity_id, None) for entity_id in random.sample(remaining, count - len(drawn)))
+        return list(drawn)
+
+
+def _degree(index: AdjacencyIndex, entity_id: str) -> int:
+    if (node := index.position.get(entity_id)) is None:
+        return 0
+    return (
+        index.out_offsets[node + 1] - index.out_offsets[node]
+        + index.in_offsets[node + 1] - index.in_offsets[node])
+
+
+def _age_days(entity: dict, now: dt.datetime) -> float:
+    try:
+        updated_at = dt.datetime.fromisoformat(entity['updated_at'])
+    except (KeyError, TypeError, ValueError):
+        return HALF_LIFE_DAYS
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=dt.UTC)
+    return max(0.0, (now - updated_at).total_seconds() / 86400)
+
+
+def _alias_table(weights: list[float]) -> tuple[array, array]:
+    """Returns the (probability, alias) of each slot of an alias table."""
+    n = len(weights)
+    total = sum(weights)
+    scaled = [w * n / total for w in weights] if total else []
+    prob = array('d', bytes(8 * n))
+    alias = array('i', range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1]
+    large = [i for i, p in enumerate(scaled) if p >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] -= 1 - scaled[s]
+        (small if scaled[l] < 1 else large).append(l)
+    for i in small + large:
+        # Left over only by rounding error.
+        prob[i] = 1
+    return prob, alias
@@ -0,0 +1,55 @@
+import asyncio
+from typing import Optional
+
+from instrumentation import instrument
+
+from get_relevant_neighborhood import main_async as get_relevant_neighborhood
+from neighborhood_renderer import get_budget, render_neighborhood
+from utils import READ_BACKEND, fetch_knowledge_graph_async, get_fragment_renderer, get_knowledge_subgraphs, get_relevant_entities_batch
+
+
+@instrument
+async def main_async(query: str, graph_id: str, word_boundary: bool = False, max_chars: Optional[int] = None, max_tokens: Optional[int] = None) -> str:
+    """
+    Args:
+        query (str): A user query that might be relevant to some entities in the knowledge graph.
+        graph_id (str): The ID of the knowledge graph to query.
+        word_boundary (bool): Whether entity names must match whole words of the query.
+        max_chars (int, optional): The most characters to return.
+        max_tokens (int, optional): The most tokens to return, estimated from characters.
+
+    Returns:
+        str: A paragraph relating what the knowledge graph holds about the
+            entities in the query and their neighbors, most relevant first,
+            within the budget (see neighborhood_renderer).
+    """
+    return (await batch_async(
+            [query], graph_id=graph_id, word_boundary=word_boundary,
+            max_chars=max_chars, max_tokens=max_tokens))[0]
+
+
+@instrument
+async def batch_async(queries: list[str], graph_id: str, word_boundary: bool = False, max_chars: Optional[int] = None, max_tokens: Optional[int] = None) -> list[str]:
+    """Like main_async, for each of queries, loading the graph once."""
+    budget = get_budget(max_chars, max_tokens)
+    if READ_BACKEND == 'spanner':
+        nbhds = await asyncio.gather(*(
+                get_relevant_neighborhood(query=query, graph_id=graph_id, word_boundary=word_boundary)
+                for query in queries))
+        # Its neighborhoods don't tell the seeds apart; they are ranked by degree.
+        return [render_neighborhood(nbhd, seeds=set(), max_chars=budget) for nbhd in nbhds]
+
+    g = await fetch_knowledge_graph_async(graph_id=graph_id)
+    if len(queries) == 1:
+        return _expand(queries, g, word_boundary, budget)
+    return await asyncio.to_thread(_expand, queries, g, word_boundary, budget)
+
+
+def _expand(queries: list[str], g: dict, word_boundary: bool, budget: int) -> list[str]:
+    seeds = get_relevant_entities_batch(
+            queries=queries, entities=g['entities'], word_boundary=word_boundary)
+    nbhds = get_knowledge_subgraphs(entity_id_sets=seeds, graph=g, num_hops=1)
+    renderer = get_fragment_renderer(g['entities'])
+    return [
+        render_neighborhood(nbhd, seeds=entity_ids, max_chars=budget, renderer=renderer)
+        for nbhd, entity_ids in zip(nbhds, seeds)]
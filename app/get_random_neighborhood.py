@@ -1,27 +1,63 @@
-import random
-from floggit import flog
+import asyncio
+from typing import Optional, Union
+from instrumentation import instrument
 
-from utils import fetch_knowledge_graph, get_knowledge_subgraph
+import spanner_graph
+from utils import (
+    READ_BACKEND, fetch_knowledge_graph, fetch_knowledge_graph_async, get_entity_sampler,
+    get_knowledge_subgraphs, get_spanner_database)
 
 
-@flog
-def main(graph_id: str) -> dict:
+@instrument
+def main(graph_id: str, weighting: str = 'uniform', count: Optional[int] = None) -> Union[dict, list[dict], None]:
     """
     Args:
         graph_id (str): The ID of the knowledge graph to query.
+        weighting (str): How entities are drawn: 'uniform', 'degree', 'recency'
+            or 'connected' (see entity_sampler). Spanner draws uniformly.
+        count (int, optional): If given, the number of distinct entities to draw.
 
     Returns:
-        dict: A random entity from the knowledge graph along with its surrounding neighborhood.
+        dict: A random entity from the knowledge graph along with its surrounding
+            neighborhood, or None if it has no entities; with count, a list of up
+            to count of them.
     """
+    if READ_BACKEND == 'spanner':
+        return _get_spanner_neighborhoods(graph_id, count)
+
     g = fetch_knowledge_graph(graph_id=graph_id)
-    entity_id = random.choice(list(g['entities'].keys()))
-    entity = g['entities'][entity_id]
-    nbhd = get_knowledge_subgraph(
-            entity_ids={entity_id}, graph=g, num_hops=1)
+    return _get_random_neighborhoods(g, weighting, count)
+
+
+@instrument
+async def main_async(graph_id: str, weighting: str = 'uniform', count: Optional[int] = None) -> Union[dict, list[dict], None]:
+    """Like main, but loads the graph without blocking the event loop."""
+    if READ_BACKEND == 'spanner':
+        return await asyncio.to_thread(main, graph_id=graph_id, weighting=weighting, count=count)
+
+    g = await fetch_knowledge_graph_async(graph_id=graph_id)
+    return _get_random_neighborhoods(g, weighting, count)
+
+
+def _get_random_neighborhoods(g: dict, weighting: str, count: Optional[int]) -> Union[dict, list[dict], None]:
+    sampler = get_entity_sampler(g, weighting)
+    entity_ids = sampler.draw_distinct(1 if count is None else count)
+    nbhds = get_knowledge_subgraphs([{entity_id} for entity_id in entity_ids], graph=g, num_hops=1)
+
+    entities_and_nbhds = [
+        {
+            'entity': g['entities'][entity_id],
+            'entity_neighborhood': nbhd
+        }
+        for entity_id, nbhd in zip(entity_ids, nbhds)
+    ]
+
+    if count is None:
+        return entities_and_nbhds[0] if entities_and_nbhds else None
+    return entities_and_nbhds
 
-    entity_and_nbhd = {
-        'entity': entity,
-        'entity_neighborhood': nbhd
-    }
 
-    return entity_and_nbhd
+def _get_spanner_neighborhoods(graph_id: str, count: Optional[int]) -> Union[dict, list[dict], None]:
+    if count is None:
+        return spanner_graph.get_random_neighborhood(get_spanner_database(), graph_id=graph_id)
+    return spanner_graph.get_random_neighborhoods(get_spanner_database(), graph_id=graph_id, count=count)
@@ -1,23 +1,105 @@
-from floggit import flog
+import asyncio
+import itertools
+from typing import Iterator
 
-from utils import fetch_knowledge_graph, get_relevant_entities, get_knowledge_subgraph
+from instrumentation import instrument
 
+import spanner_graph
+from utils import HYBRID_MIN_SIMILARITY, READ_BACKEND, fetch_knowledge_graph, fetch_knowledge_graph_async, get_relevant_entities, get_relevant_entities_batch, get_knowledge_subgraph, get_knowledge_subgraphs, get_spanner_database, iter_knowledge_subgraph
 
-@flog
-def main(query: str, graph_id: str) -> dict:
+
+@instrument
+def main(query: str, graph_id: str, word_boundary: bool = False, mode: str = 'substring', k: int = 10) -> dict:
     """
     Args:
         query (str): A user query that might be relevanet to some entities in the knowledge graph.
         graph_id (str): The ID of the knowledge graph to query.
+        word_boundary (bool): Whether entity names must match whole words of the query.
+        mode (str): How entities are found: 'substring', by their names occurring in the query, 'semantic', as the k entities whose embeddings are nearest the query's, or 'hybrid', both.
+        k (int): The number of entities found by their embeddings.
 
     Returns:
         dict: A relevant subgraph of the knowledge graph, including a surrounding neighborhood of the relevant entities (to help patching in a replacement subgraph).
     """
+    if READ_BACKEND == 'spanner':
+        return spanner_graph.get_relevant_neighborhood(
+                get_spanner_database(), graph_id=graph_id, query=query,
+                word_boundary=word_boundary, mode=mode, k=k,
+                min_similarity=HYBRID_MIN_SIMILARITY)
+
     g = fetch_knowledge_graph(graph_id=graph_id)
+    return _get_neighborhood(query=query, g=g, word_boundary=word_boundary, mode=mode, k=k)
+
+
+@instrument
+async def main_async(query: str, graph_id: str, word_boundary: bool = False, mode: str = 'substring', k: int = 10) -> dict:
+    """Like main, but loads the graph (and embeds the query) without blocking
+    the event loop."""
+    if READ_BACKEND == 'spanner':
+        return await asyncio.to_thread(
+                main, query=query, graph_id=graph_id, word_boundary=word_boundary, mode=mode, k=k)
+
+    g = await fetch_knowledge_graph_async(graph_id=graph_id)
+    if mode != 'substring':
+        return await asyncio.to_thread(
+                _get_neighborhood, query=query, g=g, word_boundary=word_boundary, mode=mode, k=k)
+    return _get_neighborhood(query=query, g=g, word_boundary=word_boundary, mode=mode, k=k)
+
+
+@instrument
+async def stream_async(query: str, graph_id: str, word_boundary: bool = False, mode: str = 'substring', k: int = 10) -> Iterator[dict]:
+    """Like main_async, but returns the neighborhood as an iterator of items
+    (see iter_knowledge_subgraph), traversed as it is consumed."""
+    if READ_BACKEND == 'spanner':
+        nbhd = await main_async(
+                query=query, graph_id=graph_id, word_boundary=word_boundary, mode=mode, k=k)
+        return itertools.chain(
+                ({'entity': entity} for entity in nbhd['entities'].values()),
+                ({'relationship': rel} for rel in nbhd['relationships']))
+
+    g = await fetch_knowledge_graph_async(graph_id=graph_id)
+    if mode != 'substring':
+        relevant_entity_ids = await asyncio.to_thread(
+                _get_relevant_entities, query=query, g=g, word_boundary=word_boundary, mode=mode, k=k)
+    else:
+        relevant_entity_ids = _get_relevant_entities(
+                query=query, g=g, word_boundary=word_boundary, mode=mode, k=k)
+    return iter_knowledge_subgraph(
+            entity_ids=relevant_entity_ids, graph=g, num_hops=1)
 
-    relevant_entity_ids = get_relevant_entities(
-            query=query, entities=g['entities'])
+
+@instrument
+async def batch_async(queries: list[str], graph_id: str, word_boundary: bool = False, mode: str = 'substring', k: int = 10) -> list[dict]:
+    """Like main_async, for each of queries, loading the graph once, finding
+    the entities of all queries in one pass and sharing the neighborhoods of
+    entities found by more than one."""
+    if READ_BACKEND == 'spanner':
+        return await asyncio.to_thread(
+                lambda: [
+                    main(query=query, graph_id=graph_id, word_boundary=word_boundary, mode=mode, k=k)
+                    for query in queries])
+
+    g = await fetch_knowledge_graph_async(graph_id=graph_id)
+    return await asyncio.to_thread(
+            _get_neighborhoods, queries=queries, g=g, word_boundary=word_boundary, mode=mode, k=k)
+
+
+def _get_neighborhoods(queries: list[str], g: dict, word_boundary: bool, mode: str, k: int) -> list[dict]:
+    relevant_entity_ids = get_relevant_entities_batch(
+            queries=queries, entities=g['entities'], word_boundary=word_boundary, mode=mode, k=k)
+    return get_knowledge_subgraphs(
+            entity_id_sets=relevant_entity_ids, graph=g, num_hops=1)
+
+
+def _get_neighborhood(query: str, g: dict, word_boundary: bool, mode: str = 'substring', k: int = 10) -> dict:
+    relevant_entity_ids = _get_relevant_entities(
+            query=query, g=g, word_boundary=word_boundary, mode=mode, k=k)
     neighborhood = get_knowledge_subgraph(
             entity_ids=relevant_entity_ids, graph=g, num_hops=1)
 
     return neighborhood
+
+
+def _get_relevant_entities(query: str, g: dict, word_boundary: bool, mode: str, k: int) -> set[str]:
+    return get_relevant_entities(
+            query=query, entities=g['entities'], word_boundary=word_boundary, mode=mode, k=k)
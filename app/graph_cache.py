@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+import metrics
+
+
+@dataclass
+class CachedGraph:
+    graph: dict
+    version: Any
+    nbytes: int
+    checked_at: float = field(default_factory=time.monotonic)
+    derived: dict = field(default_factory=dict)
+
+
+# A loader is called as load(graph_id, cached), with the cached entry if any.
+# It returns None if the stored graph is still at the cached version, else a
+# (graph, version, nbytes, deltas) tuple, where deltas are the changes applied
+# to the cached graph to get graph, or None if graph was read afresh.
+Loader = Callable[[str, Optional[CachedGraph]], Optional[tuple[dict, Any, int, Optional[list]]]]
+
+
+class GraphCache:
+    """Per-process LRU cache of knowledge graphs, keyed by graph ID.
+
+    Entries are bounded both by count and by their serialized size in bytes.
+    A cached graph is served without any storage round trip for `ttl` seconds
+    after its version was last confirmed; after that, the loader is asked to
+    compare versions and only downloads the graph again if it has changed.
+    """
+
+    def __init__(self, max_graphs: int = 16, max_bytes: int = 256 * 2**20, ttl: float = 0):
+        self.max_graphs = max_graphs
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict[str, CachedGraph] = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "GraphCache":
+        return cls(
+            max_graphs=int(os.environ.get('KG_CACHE_MAX_GRAPHS', 16)),
+            max_bytes=int(os.environ.get('KG_CACHE_MAX_BYTES', 256 * 2**20)),
+            ttl=float(os.environ.get('KG_CACHE_TTL_SECONDS', 0)))
+
+    def get(self, graph_id: str, load: Loader) -> dict:
+        """Returns the current graph, loading it only if missing or stale."""
+        return self.get_entry(graph_id, load).graph
+
+    def get_entry(self, graph_id: str, load: Loader, max_age: Optional[float] = None) -> CachedGraph:
+        """Returns the cache entry of the current graph, whose version was
+        confirmed at most max_age (by default, ttl) seconds ago."""
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._entries.get(graph_id)
+            if entry is not None:
+                self._entries.move_to_end(graph_id)
+                if time.monotonic() - entry.checked_at < max_age:
+                    metrics.increment('graph_cache.hits')
+                    return entry
+
+        loaded = load(graph_id, entry)
+
+        if loaded is None:
+            entry.checked_at = time.monotonic()
+            metrics.increment('graph_cache.hits')
+            return entry
+
+        graph, version, nbytes, deltas = loaded
+        metrics.increment('graph_cache.misses')
+        new_entry = CachedGraph(graph=graph, version=version, nbytes=nbytes)
+        if entry is not None:
+            new_entry.derived = _rebase_derived(entry, graph, deltas)
+        self._put(graph_id, new_entry)
+        return new_entry
+
+    def refresh(self, graph_id: str, load: Loader) -> None:
+        """Updates the cached graph by load, whatever its age, if it is cached."""
+        with self._lock:
+            if graph_id not in self._entries:
+                return
+        self.get_entry(graph_id, load, max_age=0)
+
+    def derived(self, source: dict, key: str, build: Callable[[dict], Any]) -> Any:
+        """Returns an index built by build(source), where source is a graph
+        or its entities.
+
+        Indexes of cached graphs are built once per graph version. When a new
+        version is loaded, indexes having a rebase(source, old_source) method
+        are updated in place, as are indexes of graphs having an
+        apply_deltas(graph, deltas) method if the new version was derived by
+        applying deltas; others are dropped and rebuilt on demand. Graphs
+        not in the cache get a fresh, uncached index."""
+        with self._lock:
+            entry = next(
+                    (e for e in self._entries.values() if _is_source(source, e.graph)), None)
+            if entry is not None and key in entry.derived:
+                return entry.derived[key][1]
+
+        index = build(source)
+        if entry is not None:
+            entry.derived.setdefault(key, (source is entry.graph, index))
+        return index
+
+    def invalidate(self, graph_id: str) -> None:
+        with self._lock:
+            if (entry := self._entries.pop(graph_id, None)) is not None:
+                self._nbytes -= entry.nbytes
+            self._record_size()
+
+    def _put(self, graph_id: str, entry: CachedGraph) -> None:
+        with self._lock:
+            if (old := self._entries.pop(graph_id, None)) is not None:
+                self._nbytes -= old.nbytes
+
+            if entry.nbytes <= self.max_bytes:
+                self._entries[graph_id] = entry
+                self._nbytes += entry.nbytes
+
+            while (
+                len(self._entries) > self.max_graphs
+                or self._nbytes > self.max_bytes
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                metrics.increment('graph_cache.evictions')
+
+            self._record_size()
+
+    def _record_size(self) -> None:
+        metrics.set_gauge('graph_cache.graphs', len(self._entries))
+        metrics.set_gauge('graph_cache.bytes', self._nbytes)
+
+
+def _is_source(source, graph: dict) -> bool:
+    # By identity: comparing graphs by value would compare their contents.
+    return source is graph or source is graph['entities']
+
+
+def _rebase_derived(old_entry: CachedGraph, graph: dict, deltas: Optional[list]) -> dict:
+    """Carries the rebaseable indexes of old_entry over to graph."""
+    derived = {}
+    for key, (of_graph, index) in old_entry.derived.items():
+        if of_graph and deltas is not None and hasattr(index, 'apply_deltas'):
+            derived[key] = (True, index.apply_deltas(graph, deltas))
+        elif hasattr(index, 'rebase'):
+            if of_graph:
+                derived[key] = (True, index.rebase(graph, old_entry.graph))
+            else:
+                derived[key] = (False, index.rebase(graph['entities'], old_entry.graph['entities']))
+    return derived
@@ -0,0 +1,53 @@
+from collections import Counter
+
+import graph_snapshot
+
+
+def relationship_key(rel: dict) -> tuple[str, str, str]:
+    """Identifies a relationship by its (source, target, relationship) triple."""
+    return rel['source_entity_id'], rel['target_entity_id'], rel['relationship']
+
+
+def graph_difference(g1: dict, g2: dict) -> dict:
+    """Returns the entities and relationships in g1 but not in g2.
+
+    Entities are compared by ID. Relationships are compared by key, as a
+    multiset: if g1 has more copies of a relationship than g2, the extra
+    copies are in the difference."""
+    g2_relationships = Counter(map(relationship_key, g2['relationships']))
+
+    relationships = []
+    for rel in g1['relationships']:
+        key = relationship_key(rel)
+        if g2_relationships[key]:
+            g2_relationships[key] -= 1
+        else:
+            relationships.append(rel)
+
+    return {
+        'entities': {
+            k: v for k, v in g1['entities'].items()
+            if k not in g2['entities']
+        },
+        'relationships': relationships
+    }
+
+
+def apply_graph_delta(graph: dict, remove_subgraph: dict, add_subgraph: dict) -> dict:
+    """Returns a copy of graph with remove_subgraph excised and add_subgraph inserted.
+
+    Each relationship in remove_subgraph removes exactly one relationship of
+    the graph with the same key, leaving any other parallel relationships.
+    A graph loaded from a binary snapshot is not copied; the delta is
+    overlaid on the snapshot instead."""
+    if graph_snapshot.is_snapshot_graph(graph):
+        return graph_snapshot.apply_delta(graph, remove_subgraph, add_subgraph)
+
+    # Excise old subgraph
+    graph = graph_difference(graph, remove_subgraph)
+
+    # Insert new subgraph
+    graph['entities'].update(add_subgraph['entities'])
+    graph['relationships'].extend(add_subgraph['relationships'])
+
+    return graph
@@ -0,0 +1,110 @@
+from array import array
+from typing import Optional
+
+
+class AdjacencyIndex:
+    """Compact, read-only adjacency structure for a knowledge graph.
+
+    Nodes get integer IDs in graph order (entities first, then any entity IDs
+    that only occur in relationships). Out- and in-edges are stored CSR-style:
+    the edges of node u occupy positions offsets[u]:offsets[u + 1] of the
+    neighbor arrays. Out-edges are ordered as NetworkX iterates a
+    MultiDiGraph's edges: grouped by target in order of first appearance, then
+    in insertion order. Relationship labels are interned in a label table.
+    """
+
+    def __init__(self, graph: dict):
+        relationships = graph.get('relationships', [])
+
+        self.node_ids: list[str] = list(graph['entities'])
+        self.position: dict[str, int] = {
+                entity_id: i for i, entity_id in enumerate(self.node_ids)}
+        for rel in relationships:
+            for entity_id in (rel['source_entity_id'], rel['target_entity_id']):
+                if entity_id not in self.position:
+                    self.position[entity_id] = len(self.node_ids)
+                    self.node_ids.append(entity_id)
+
+        self.labels: list[str] = []
+        label_ids: dict[str, int] = {}
+        sources = array('i')
+        targets = array('i')
+        self.edge_labels = array('i')
+        for rel in relationships:
+            sources.append(self.position[rel['source_entity_id']])
+            targets.append(self.position[rel['target_entity_id']])
+            label = rel['relationship']
+            if label not in label_ids:
+                label_ids[label] = len(self.labels)
+                self.labels.append(label)
+            self.edge_labels.append(label_ids[label])
+
+        # Rank parallel edges by the first appearance of their (source, target) pair.
+        first_seen: dict[tuple[int, int], int] = {}
+        for edge, pair in enumerate(zip(sources, targets)):
+            first_seen.setdefault(pair, edge)
+        out_order = sorted(
+                range(len(sources)),
+                key=lambda edge: (sources[edge], first_seen[sources[edge], targets[edge]], edge))
+        in_order = sorted(range(len(targets)), key=targets.__getitem__)
+
+        self.out_offsets = _offsets(sources, len(self.node_ids))
+        self.out_edges = array('i', out_order)
+        self.out_targets = array('i', (targets[edge] for edge in out_order))
+        self.in_offsets = _offsets(targets, len(self.node_ids))
+        self.in_edges = array('i', in_order)
+        self.in_sources = array('i', (sources[edge] for edge in in_order))
+
+    def neighbors(self, node: int) -> set[int]:
+        """Returns the nodes adjacent to node, ignoring edge direction."""
+        nbrs = set(self.out_targets[self.out_offsets[node]:self.out_offsets[node + 1]])
+        nbrs.update(self.in_sources[self.in_offsets[node]:self.in_offsets[node + 1]])
+        return nbrs
+
+    def out_edges_of(self, node: int):
+        """Yields (target, label) for each out-edge of node, in NetworkX order."""
+        for i in range(self.out_offsets[node], self.out_offsets[node + 1]):
+            yield self.out_targets[i], self.labels[self.edge_labels[self.out_edges[i]]]
+
+    def in_edges_of(self, node: int):
+        """Yields (source, label) for each in-edge of node."""
+        for i in range(self.in_offsets[node], self.in_offsets[node + 1]):
+            yield self.in_sources[i], self.labels[self.edge_labels[self.in_edges[i]]]
+
+    def neighborhood(self, seeds: set[int], num_hops: Optional[int] = 2) -> tuple[list[int], set[int]]:
+        """Returns the nodes within num_hops (1 or 2) of the seeds, in node
+        order, and the outermost of those nodes having a neighbor outside."""
+        nbrs1 = {
+                nbr for node in seeds
+                for nbr in self.neighbors(node)
+                if nbr not in seeds
+        }
+
+        if num_hops > 1:
+            nbrs2 = {
+                    nbr for node in nbrs1
+                    for nbr in self.neighbors(node)
+                    if nbr not in seeds and nbr not in nbrs1
+            }
+            outer_nbrs = nbrs2
+        else:
+            nbrs2 = set()
+            outer_nbrs = nbrs1
+
+        members = seeds | nbrs1 | nbrs2
+        valence = {
+                node for node in outer_nbrs
+                if not self.neighbors(node) <= members
+        }
+
+        return sorted(members), valence
+
+
+def _offsets(ends: array, num_nodes: int) -> array:
+    """Returns CSR offsets for edges grouped by the given endpoint."""
+    offsets = array('i', bytes(4 * (num_nodes + 1)))
+    for node in ends:
+        offsets[node + 1] += 1
+    for node in range(num_nodes):
+        offsets[node + 1] += offsets[node]
+    return offsets
@@ -0,0 +1,365 @@
+"""Knowledge graphs stored as a snapshot plus an append-only log of deltas.
+
+The snapshot is `{graph_id}.json`, whose `delta_seq` metadata records the last
+delta folded into it. Each delta, i.e. a (remove_subgraph, add_subgraph) pair,
+is a separate blob `{graph_id}.deltas/{seq}.json`. The current graph is the
+snapshot with every later delta applied, in order. Compaction folds the log
+into a new snapshot and then deletes the compacted deltas.
+
+Each snapshot is also written in binary (see graph_snapshot), as
+`{graph_id}.kgsnap`, and its entities' embeddings (see vector_index) as
+`{graph_id}.embeddings`, whose `json_generation` metadata records the JSON
+snapshot they encode. Readers download them once per host into
+KG_SNAPSHOT_DIR (the embeddings only when first searched) and memory-map them
+from there. While the binary snapshot is missing or stale, readers build it
+from the JSON instead. The JSON remains the interchange format.
+
+The worker processes of a host thus share one copy of each snapshot, in the
+page cache. Each version is downloaded (or built) by the first process to
+need it, under a lock, while the others wait for it, and installed by an
+atomic rename.
+"""
+import contextlib
+import fcntl
+import functools
+import glob
+import json
+import logging
+import os
+import tempfile
+from typing import Optional
+from urllib.parse import quote
+
+from google.api_core.exceptions import GoogleAPIError, NotFound, PreconditionFailed
+
+import graph_snapshot
+import metrics
+from graph_cache import CachedGraph
+from graph_delta import apply_graph_delta
+from vector_index import EmbeddingMatrix, VectorIndex
+
+COMPACTION_INTERVAL = int(os.environ.get('KG_COMPACTION_INTERVAL', 50))
+READ_ATTEMPTS = 3
+SNAPSHOT_DIR = os.environ.get(
+        'KG_SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'kg-snapshots'))
+
+
+def read_graph(bucket, graph_id: str, cached: Optional[CachedGraph] = None) -> Optional[tuple[dict, tuple[int, int], int, Optional[list]]]:
+    """Reads a graph as its snapshot plus the deltas logged after it.
+
+    Returns None if the graph is unchanged since the cached version, else a
+    (graph, version, nbytes, deltas) tuple, where version is the pair
+    (snapshot generation, last delta applied). If only deltas were appended
+    since the cached version, they are applied to the cached graph instead of
+    downloading the snapshot again, and returned as deltas; otherwise deltas
+    is None."""
+    for attempt in range(READ_ATTEMPTS):
+        # List the log before reading the snapshot: any delta compacted in
+        # between is then covered by the snapshot.
+        deltas = _list_deltas(bucket, graph_id)
+        generation, snapshot_seq, snapshot = _stat_snapshot(bucket, graph_id)
+        seqs = sorted(seq for seq in deltas if seq > snapshot_seq)
+        version = (generation, seqs[-1] if seqs else snapshot_seq)
+
+        if cached is not None and cached.version == version:
+            return None
+
+        try:
+            if (
+                cached is not None
+                and cached.version[0] == generation
+                and cached.version[1] <= version[1]
+            ):
+                graph, nbytes = cached.graph, cached.nbytes
+                seqs = [seq for seq in seqs if seq > cached.version[1]]
+                applied = []
+            elif generation:
+                graph, nbytes = _read_snapshot(bucket, graph_id, generation, snapshot)
+                applied = None
+            else:
+                graph, nbytes = {"entities": {}, "relationships": []}, 0
+                applied = None
+
+            for seq in seqs:
+                content = deltas[seq].download_as_bytes()
+                metrics.increment('graph_log.bytes_downloaded', len(content))
+                delta = json.loads(content)
+                graph = apply_graph_delta(graph, **delta)
+                nbytes += len(content)
+                if applied is not None:
+                    applied.append(delta)
+        except NotFound:
+            # Compacted while being read; read the new snapshot instead.
+            if attempt == READ_ATTEMPTS - 1:
+                raise
+            continue
+
+        return graph, version, nbytes, applied
+
+
+def append_delta(bucket, graph_id: str, version: tuple[int, int], remove_subgraph: dict, add_subgraph: dict) -> int:
+    """Appends a delta to the graph's log, compacting the log if it has grown
+    past COMPACTION_INTERVAL deltas. Returns the delta's sequence number.
+
+    The delta must have been computed against the given version of the graph.
+    Raises PreconditionFailed if the graph has changed since."""
+    seq = version[1] + 1
+    blob = bucket.blob(_delta_name(graph_id, seq))
+    blob.upload_from_string(
+        json.dumps({'remove_subgraph': remove_subgraph, 'add_subgraph': add_subgraph}),
+        content_type="application/json",
+        if_generation_match=0)
+
+    # A compaction since `version` may have deleted an earlier delta with this
+    # number, in which case the new delta is shadowed by the snapshot.
+    _, snapshot_seq, _ = _stat_snapshot(bucket, graph_id)
+    if snapshot_seq >= seq:
+        blob.delete()
+        raise PreconditionFailed(f'{graph_id} was compacted past delta {seq}.')
+    metrics.increment('graph_log.deltas_appended')
+
+    if seq - snapshot_seq >= COMPACTION_INTERVAL:
+        compact(bucket, graph_id)
+
+    return seq
+
+
+def write_snapshot(
+        bucket, graph_id: str, graph: dict, version: Optional[tuple[int, int]] = None) -> None:
+    """Overwrites the graph's snapshot, folding in every delta up to version[1].
+
+    Raises PreconditionFailed unless the snapshot is still at generation
+    version[0] (0 if there is none). Without a version, the snapshot
+    unconditionally supersedes every delta logged so far."""
+    if version is None:
+        _, snapshot_seq, _ = _stat_snapshot(bucket, graph_id)
+        delta_seq = max([snapshot_seq, *_list_deltas(bucket, graph_id)])
+        generation = None
+    else:
+        generation, delta_seq = version
+
+    entities = graph['entities']
+    if graph_snapshot.is_snapshot_graph(graph):
+        graph = {
+            'entities': dict(graph['entities']),
+            'relationships': list(graph['relationships']),
+        }
+
+    blob = bucket.blob(f"{graph_id}.json")
+    blob.metadata = {'delta_seq': str(delta_seq)}
+    blob.upload_from_string(
+        json.dumps(graph), content_type="application/json",
+        if_generation_match=generation)
+
+    _write_binary_snapshot(bucket, graph_id, graph, json_generation=blob.generation)
+    _write_embeddings(bucket, graph_id, entities, json_generation=blob.generation)
+
+
+def compact(bucket, graph_id: str) -> None:
+    """Folds the graph's delta log into a new snapshot, unless another
+    compaction gets there first."""
+    graph, version, _, _ = read_graph(bucket, graph_id)
+    try:
+        write_snapshot(bucket, graph_id, graph, version=version)
+    except PreconditionFailed:
+        metrics.increment('graph_log.compaction_conflicts')
+        return
+
+    for seq, blob in _list_deltas(bucket, graph_id).items():
+        if seq <= version[1]:
+            try:
+                blob.delete()
+            except NotFound:
+                pass
+    metrics.increment('graph_log.compactions')
+
+
+def _read_snapshot(bucket, graph_id: str, generation: int, blob) -> tuple[dict, int]:
+    """Reads the JSON snapshot blob at generation, by memory-mapping a local
+    copy of its binary form. Returns the graph and its size."""
+    path = _local_snapshot_path(graph_id, generation, '.kgsnap')
+    if not os.path.exists(path):
+        with _host_lock(graph_id):
+            if not os.path.exists(path):
+                _install_snapshot(bucket, graph_id, generation, blob, path)
+
+    try:
+        snapshot = graph_snapshot.Snapshot.open(path)
+    except FileNotFoundError:
+        # Superseded and deleted by another process; read_graph retries.
+        raise NotFound(path)
+    snapshot.load_embeddings = functools.partial(_read_embeddings, bucket, graph_id, generation)
+    metrics.increment('graph_log.binary_snapshot_loads')
+    return snapshot.graph(), snapshot.nbytes
+
+
+def _install_snapshot(bucket, graph_id: str, generation: int, blob, path: str) -> None:
+    """Downloads the binary form of the JSON snapshot blob to path, or, if
+    there is none, builds it from the JSON."""
+    if (binary := _current_sidecar(bucket, _binary_snapshot_name(graph_id), generation)) is not None:
+        _install(path, binary.download_to_filename)
+        metrics.increment('graph_log.bytes_downloaded', binary.size or 0)
+        return
+
+    content = blob.download_as_bytes()
+    metrics.increment('graph_log.bytes_downloaded', len(content))
+    data = graph_snapshot.dump(json.loads(content))
+
+    def write(tmp_path: str) -> None:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+
+    _install(path, write)
+    metrics.increment('graph_log.binary_snapshot_builds')
+
+
+def _read_embeddings(bucket, graph_id: str, generation: int) -> Optional[EmbeddingMatrix]:
+    """Memory-maps a local copy of the embeddings of the snapshot at
+    generation, or returns None if there are none."""
+    path = _local_snapshot_path(graph_id, generation, '.embeddings')
+    if not os.path.exists(path):
+        with _host_lock(graph_id):
+            if not os.path.exists(path):
+                if (blob := _current_sidecar(bucket, _embeddings_name(graph_id), generation)) is None:
+                    return None
+                _install(path, blob.download_to_filename)
+                metrics.increment('graph_log.bytes_downloaded', blob.size or 0)
+
+    try:
+        return EmbeddingMatrix.open(path)
+    except FileNotFoundError:
+        return None
+
+
+def _current_sidecar(bucket, name: str, json_generation: int):
+    """Returns the blob name, if it was written for the JSON snapshot at
+    json_generation, else None."""
+    blob = bucket.blob(name)
+    try:
+        blob.reload()
+    except NotFound:
+        return None
+    if (blob.metadata or {}).get('json_generation') != str(json_generation):
+        return None
+    return blob
+
+
+def _install(path: str, write) -> None:
+    """Has write write a file, which is then moved to path atomically,
+    replacing older generations' copies."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, prefix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    suffix = os.path.splitext(path)[1]
+    prefix = path[:path.rindex('.', 0, -len(suffix)) + 1]
+    for other_path in glob.glob(glob.escape(prefix) + '*' + suffix):
+        if other_path != path and other_path[len(prefix):-len(suffix)].isdigit():
+            try:
+                os.remove(other_path)
+            except FileNotFoundError:
+                pass
+
+
+@contextlib.contextmanager
+def _host_lock(graph_id: str):
+    """Excludes the host's other processes from installing the graph's files."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with open(os.path.join(SNAPSHOT_DIR, f"{quote(graph_id, safe='')}.lock"), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write_binary_snapshot(bucket, graph_id: str, graph: dict, json_generation: int) -> None:
+    """Writes the binary form of the JSON snapshot at json_generation.
+
+    Readers fall back to the JSON snapshot if this fails, so failures are
+    logged rather than raised."""
+    blob = bucket.blob(_binary_snapshot_name(graph_id))
+    blob.metadata = {'json_generation': str(json_generation)}
+    try:
+        blob.upload_from_string(
+            graph_snapshot.dump(graph), content_type="application/octet-stream")
+    except GoogleAPIError:
+        metrics.increment('graph_log.binary_snapshot_failures')
+        logging.warning(
+            'Binary snapshot not written.',
+            exc_info=True,
+            extra={
+                'json_fields': {
+                    'graph_id': graph_id,
+                    'json_generation': json_generation
+                }
+            }
+        )
+
+
+def _write_embeddings(bucket, graph_id: str, entities: dict, json_generation: int) -> None:
+    """Writes the embeddings of the entities of the JSON snapshot at
+    json_generation, reusing those of the snapshot they were read from.
+
+    Readers embed entities themselves if this fails, so failures are logged
+    rather than raised."""
+    blob = bucket.blob(_embeddings_name(graph_id))
+    blob.metadata = {'json_generation': str(json_generation)}
+    try:
+        vectors = VectorIndex(entities).embeddings(list(entities))
+        blob.upload_from_string(
+            EmbeddingMatrix.quantize(vectors).dump(), content_type="application/octet-stream")
+    except Exception:
+        metrics.increment('graph_log.embeddings_failures')
+        logging.warning(
+            'Snapshot embeddings not written.',
+            exc_info=True,
+            extra={
+                'json_fields': {
+                    'graph_id': graph_id,
+                    'json_generation': json_generation
+                }
+            }
+        )
+
+
+def _stat_snapshot(bucket, graph_id: str) -> tuple[int, int, object]:
+    """Returns the snapshot's generation (0 if it does not exist), the last
+    delta folded into it, and its blob."""
+    blob = bucket.blob(f"{graph_id}.json")
+    try:
+        blob.reload()
+    except NotFound:
+        return 0, 0, blob
+    return blob.generation, int((blob.metadata or {}).get('delta_seq', 0)), blob
+
+
+def _list_deltas(bucket, graph_id: str) -> dict:
+    """Returns the graph's logged deltas' blobs by sequence number."""
+    prefix = f"{graph_id}.deltas/"
+    return {
+            int(blob.name[len(prefix):].removesuffix('.json')): blob
+            for blob in bucket.list_blobs(prefix=prefix)
+    }
+
+
+def _delta_name(graph_id: str, seq: int) -> str:
+    return f"{graph_id}.deltas/{seq:012d}.json"
+
+
+def _binary_snapshot_name(graph_id: str) -> str:
+    return f"{graph_id}.kgsnap"
+
+
+def _embeddings_name(graph_id: str) -> str:
+    return f"{graph_id}.embeddings"
+
+
+def _local_snapshot_path(graph_id: str, generation: int, suffix: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"{quote(graph_id, safe='')}.{generation}{suffix}")
@@ -0,0 +1,480 @@
+"""Compact, memory-mappable binary snapshots of knowledge graphs.
+
+A snapshot stores a graph column by column:
+
+    strings     every entity ID, name and relationship label, interned once
+    nodes       entity IDs (then IDs only occurring in relationships) as string
+                indexes, plus an open-addressing hash table of them, for
+                lookups by ID
+    names       each entity's names, as string indexes
+    entities    each entity's remaining fields, as a JSON blob that is only
+                decoded when the entity is accessed
+    edges       each relationship's source and target node and label, as
+                integer arrays, plus the CSR arrays of its AdjacencyIndex
+
+Loading a snapshot only parses a small JSON directory of these sections, and
+the graph it returns is a view over the (memory-mapped) buffer: entities are
+decoded on access, and processes mapping the same file share its pages.
+Deltas applied to such a graph are kept as an overlay on the snapshot rather
+than copying it (see apply_delta).
+
+Relationships are stored as their (source, target, relationship) triple.
+"""
+import functools
+import json
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from collections import Counter
+from collections.abc import Mapping, Sequence
+from typing import Any, Callable, Iterator, Optional
+
+from graph_index import AdjacencyIndex
+
+MAGIC = b'KGSNAP01'
+_ALIGNMENT = 8
+
+
+class Snapshot:
+    """A binary snapshot, read from a buffer such as an mmap."""
+
+    def __init__(self, buffer):
+        self._buffer = memoryview(buffer)
+        if bytes(self._buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError('Not a knowledge graph snapshot.')
+        (directory_size,) = struct.unpack_from('<Q', self._buffer, len(MAGIC))
+        start = len(MAGIC) + 8
+        directory = json.loads(bytes(self._buffer[start:start + directory_size]))
+        self.num_entities: int = directory['num_entities']
+        self.num_nodes: int = directory['num_nodes']
+        self._sections = {
+                name: _section(self._buffer[offset:offset + size], typecode)
+                for name, (offset, size, typecode) in directory['sections'].items()
+        }
+        self.labels: list[str] = [self.string(i) for i in self._sections['label_strings']]
+        self._label_ids = {label: i for i, label in enumerate(self.labels)}
+        # Returns the entities' stored embeddings, if any (see graph_log).
+        self.load_embeddings: Optional[Callable[[], Any]] = None
+
+    @classmethod
+    def open(cls, path: str) -> "Snapshot":
+        """Memory-maps the snapshot file at path."""
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._buffer)
+
+    def graph(self) -> dict:
+        """Returns the graph, as read-only views of the snapshot."""
+        return {
+            'entities': SnapshotEntities(self),
+            'relationships': SnapshotRelationships(self),
+        }
+
+    def string(self, i: int) -> str:
+        offsets = self._sections['string_offsets']
+        return str(self._sections['string_data'][offsets[i]:offsets[i + 1]], 'utf-8')
+
+    def node_id(self, node: int) -> str:
+        return self.string(self._sections['node_strings'][node])
+
+    @functools.cached_property
+    def entity_ids(self) -> list[str]:
+        return [self.node_id(node) for node in range(self.num_entities)]
+
+    def find(self, entity_id: str) -> Optional[int]:
+        """Returns the node of entity_id, or None."""
+        key = entity_id.encode()
+        table = self._sections['node_table']
+        node_strings = self._sections['node_strings']
+        offsets = self._sections['string_offsets']
+        data = self._sections['string_data']
+
+        mask = len(table) - 1
+        slot = zlib.crc32(key) & mask
+        while (node := table[slot]) >= 0:
+            s = node_strings[node]
+            if data[offsets[s]:offsets[s + 1]] == key:
+                return node
+            slot = (slot + 1) & mask
+        return None
+
+    def entity_names(self, node: int) -> list[str]:
+        offsets = self._sections['name_offsets']
+        return [
+                self.string(s)
+                for s in self._sections['name_strings'][offsets[node]:offsets[node + 1]]]
+
+    def entity(self, node: int) -> dict:
+        """Decodes the entity at node."""
+        offsets = self._sections['entity_offsets']
+        entity = json.loads(bytes(self._sections['entity_data'][offsets[node]:offsets[node + 1]]))
+        # Placeholders keep the fields' order.
+        if entity.get('entity_id') == 0:
+            entity['entity_id'] = self.node_id(node)
+        if 'entity_names' in entity:
+            entity['entity_names'] = self.entity_names(node)
+        return entity
+
+    def relationship(self, edge: int) -> dict:
+        return {
+            'source_entity_id': self.node_id(self._sections['sources'][edge]),
+            'target_entity_id': self.node_id(self._sections['targets'][edge]),
+            'relationship': self.labels[self._sections['edge_labels'][edge]],
+        }
+
+    def out_edges(self, node: int) -> Iterator[tuple[int, int, int]]:
+        """Yields (edge, target, label ID) for each out-edge of node, in
+        AdjacencyIndex order."""
+        s = self._sections
+        for i in range(s['out_offsets'][node], s['out_offsets'][node + 1]):
+            edge = s['out_edges'][i]
+            yield edge, s['out_targets'][i], s['edge_labels'][edge]
+
+    def adjacency_index(self) -> AdjacencyIndex:
+        """Returns the graph's AdjacencyIndex, backed by the snapshot's arrays."""
+        index = AdjacencyIndex.__new__(AdjacencyIndex)
+        index.node_ids = _NodeIds(self)
+        index.position = _NodePositions(self)
+        index.labels = self.labels
+        for name in ('edge_labels', 'out_offsets', 'out_edges', 'out_targets',
+                     'in_offsets', 'in_edges', 'in_sources'):
+            setattr(index, name, self._sections[name])
+        return index
+
+
+class SnapshotEntities(Mapping):
+    """The entities of a snapshot, by ID, plus changes overlaid on them: an
+    entity, or None if removed."""
+
+    def __init__(self, snapshot: Snapshot, changes: Optional[dict] = None):
+        self.snapshot = snapshot
+        self.changes = changes or {}
+        self._added = [
+                entity_id for entity_id, entity in self.changes.items()
+                if entity is not None and not self._in_snapshot(entity_id)]
+        num_removed = sum(entity is None for entity in self.changes.values())
+        self._len = snapshot.num_entities - num_removed + len(self._added)
+
+    def _in_snapshot(self, entity_id: str) -> bool:
+        node = self.snapshot.find(entity_id)
+        return node is not None and node < self.snapshot.num_entities
+
+    def __getitem__(self, entity_id: str) -> dict:
+        if entity_id in self.changes:
+            if (entity := self.changes[entity_id]) is None:
+                raise KeyError(entity_id)
+            return entity
+        node = self.snapshot.find(entity_id)
+        if node is None or node >= self.snapshot.num_entities:
+            raise KeyError(entity_id)
+        return self.snapshot.entity(node)
+
+    def __contains__(self, entity_id) -> bool:
+        if entity_id in self.changes:
+            return self.changes[entity_id] is not None
+        return isinstance(entity_id, str) and self._in_snapshot(entity_id)
+
+    def __iter__(self) -> Iterator[str]:
+        changes = self.changes
+        for entity_id in self.snapshot.entity_ids:
+            if changes.get(entity_id, True) is not None:
+                yield entity_id
+        yield from self._added
+
+    def __len__(self) -> int:
+        return self._len
+
+    def entity_names(self) -> Iterator[tuple[str, list[str]]]:
+        """Yields (entity ID, names) for each entity, without decoding the
+        rest of the snapshot's entities."""
+        changes = self.changes
+        for node, entity_id in enumerate(self.snapshot.entity_ids):
+            if entity_id not in changes:
+                yield entity_id, self.snapshot.entity_names(node)
+            elif (entity := changes[entity_id]) is not None:
+                yield entity_id, entity['entity_names']
+        for entity_id in self._added:
+            yield entity_id, changes[entity_id]['entity_names']
+
+    def changes_since(self, old: Mapping) -> Optional[tuple[dict, dict]]:
+        """Returns the entities of self and old that may differ, if both
+        overlay the same snapshot, else None."""
+        if not isinstance(old, SnapshotEntities) or old.snapshot is not self.snapshot:
+            return None
+        entity_ids = self.changes.keys() | old.changes.keys()
+        return (
+            {entity_id: self[entity_id] for entity_id in entity_ids if entity_id in self},
+            {entity_id: old[entity_id] for entity_id in entity_ids if entity_id in old},
+        )
+
+    def with_delta(self, remove_entities: Mapping, add_entities: Mapping) -> "SnapshotEntities":
+        changes = dict(self.changes)
+        for entity_id in remove_entities:
+            if entity_id in self:
+                if self._in_snapshot(entity_id):
+                    changes[entity_id] = None
+                else:
+                    del changes[entity_id]
+        changes.update(add_entities)
+        return SnapshotEntities(self.snapshot, changes)
+
+
+class SnapshotRelationships(Sequence):
+    """The relationships of a snapshot, minus removed ones (by edge), plus
+    added ones."""
+
+    def __init__(self, snapshot: Snapshot, removed: frozenset = frozenset(), added: tuple = ()):
+        self.snapshot = snapshot
+        self.removed = removed
+        self.added = added
+        self._removed_edges = sorted(removed)
+        self._num_edges = len(snapshot._sections['sources'])
+
+    @property
+    def pristine(self) -> bool:
+        return not self.removed and not self.added
+
+    def __len__(self) -> int:
+        return self._num_edges - len(self.removed) + len(self.added)
+
+    def __getitem__(self, i: int) -> dict:
+        if not isinstance(i, int):
+            raise TypeError('Relationships can only be indexed by integers.')
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        num_kept = self._num_edges - len(self.removed)
+        if i >= num_kept:
+            return self.added[i - num_kept]
+        # The i-th kept edge: skip the removed edges at or before it.
+        edge = i
+        for removed_edge in self._removed_edges:
+            if removed_edge > edge:
+                break
+            edge += 1
+        return self.snapshot.relationship(edge)
+
+    def __iter__(self) -> Iterator[dict]:
+        removed = self.removed
+        for edge in range(self._num_edges):
+            if edge not in removed:
+                yield self.snapshot.relationship(edge)
+        yield from self.added
+
+    def with_delta(self, remove_relationships: list, add_relationships: list) -> "SnapshotRelationships":
+        """Removes one relationship per relationship in remove_relationships
+        with the same (source, target, relationship) key, snapshot edges
+        first, and appends add_relationships."""
+        snapshot = self.snapshot
+        remaining = Counter(
+                (rel['source_entity_id'], rel['target_entity_id'], rel['relationship'])
+                for rel in remove_relationships)
+
+        removed = set(self.removed)
+        for (source_id, target_id, label), count in list(remaining.items()):
+            source, target = snapshot.find(source_id), snapshot.find(target_id)
+            label_id = snapshot._label_ids.get(label)
+            if source is None or target is None or label_id is None:
+                continue
+            for edge, edge_target, edge_label in snapshot.out_edges(source):
+                if count and edge_target == target and edge_label == label_id and edge not in removed:
+                    removed.add(edge)
+                    count -= 1
+            remaining[source_id, target_id, label] = count
+
+        added = []
+        for rel in self.added:
+            key = rel['source_entity_id'], rel['target_entity_id'], rel['relationship']
+            if remaining[key]:
+                remaining[key] -= 1
+            else:
+                added.append(rel)
+        added.extend(add_relationships)
+
+        return SnapshotRelationships(snapshot, frozenset(removed), tuple(added))
+
+
+class _NodeIds(Sequence):
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, node: int) -> str:
+        if not 0 <= node < self.snapshot.num_nodes:
+            raise IndexError(node)
+        return self.snapshot.node_id(node)
+
+    def __len__(self) -> int:
+        return self.snapshot.num_nodes
+
+
+class _NodePositions(Mapping):
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, entity_id: str) -> int:
+        if (node := self.snapshot.find(entity_id)) is None:
+            raise KeyError(entity_id)
+        return node
+
+    def __iter__(self) -> Iterator[str]:
+        return (self.snapshot.node_id(node) for node in range(self.snapshot.num_nodes))
+
+    def __len__(self) -> int:
+        return self.snapshot.num_nodes
+
+
+def is_snapshot_graph(graph: dict) -> bool:
+    return isinstance(graph['entities'], SnapshotEntities)
+
+
+def snapshot_adjacency_index(graph: dict) -> Optional[AdjacencyIndex]:
+    """Returns the stored AdjacencyIndex of a graph loaded from a snapshot,
+    unless deltas have changed its relationships."""
+    relationships = graph['relationships']
+    if isinstance(relationships, SnapshotRelationships) and relationships.pristine:
+        return relationships.snapshot.adjacency_index()
+    return None
+
+
+def apply_delta(graph: dict, remove_subgraph: dict, add_subgraph: dict) -> dict:
+    """Like graph_delta.apply_graph_delta, but overlays the delta on a graph
+    loaded from a snapshot instead of copying the snapshot."""
+    return {
+        'entities': graph['entities'].with_delta(
+                remove_subgraph['entities'], add_subgraph['entities']),
+        'relationships': graph['relationships'].with_delta(
+                remove_subgraph['relationships'], add_subgraph['relationships']),
+    }
+
+
+def dump(graph: dict) -> bytes:
+    """Returns the binary snapshot of graph."""
+    index = AdjacencyIndex(graph)
+    entities = graph['entities']
+
+    strings: dict[str, int] = {}
+
+    def intern(s: str) -> int:
+        if (i := strings.get(s)) is None:
+            i = strings[s] = len(strings)
+        return i
+
+    node_strings = array('i', (intern(node_id) for node_id in index.node_ids))
+
+    name_offsets = array('i', [0])
+    name_strings = array('i')
+    entity_offsets = array('q', [0])
+    entity_data = bytearray()
+    entity_names = entities.entity_names() if hasattr(entities, 'entity_names') else (
+            (entity_id, entity['entity_names']) for entity_id, entity in entities.items())
+    for (entity_id, names), entity in zip(entity_names, entities.values()):
+        name_strings.extend(intern(name) for name in names)
+        name_offsets.append(len(name_strings))
+        fields = dict(entity)
+        if fields.get('entity_id') == entity_id:
+            fields['entity_id'] = 0
+        if 'entity_names' in fields:
+            fields['entity_names'] = 0
+        entity_data += json.dumps(fields, separators=(',', ':')).encode()
+        entity_offsets.append(len(entity_data))
+
+    label_strings = array('i', (intern(label) for label in index.labels))
+
+    string_data = bytearray()
+    string_offsets = array('q', [0])
+    for s in strings:
+        string_data += s.encode()
+        string_offsets.append(len(string_data))
+
+    # Linear probing, at most half full.
+    node_table = array('i', [-1]) * (1 << (2 * len(index.node_ids)).bit_length())
+    mask = len(node_table) - 1
+    for node, node_id in enumerate(index.node_ids):
+        slot = zlib.crc32(node_id.encode()) & mask
+        while node_table[slot] >= 0:
+            slot = (slot + 1) & mask
+        node_table[slot] = node
+
+    sources = array('i', bytes(4 * len(index.edge_labels)))
+    targets = array('i', bytes(4 * len(index.edge_labels)))
+    for node in range(len(index.node_ids)):
+        for i in range(index.out_offsets[node], index.out_offsets[node + 1]):
+            sources[index.out_edges[i]] = node
+            targets[index.out_edges[i]] = index.out_targets[i]
+
+    sections = {
+        'string_offsets': string_offsets,
+        'string_data': bytes(string_data),
+        'node_strings': node_strings,
+        'node_table': node_table,
+        'name_offsets': name_offsets,
+        'name_strings': name_strings,
+        'entity_offsets': entity_offsets,
+        'entity_data': bytes(entity_data),
+        'label_strings': label_strings,
+        'sources': sources,
+        'targets': targets,
+        'edge_labels': index.edge_labels,
+        'out_offsets': index.out_offsets,
+        'out_edges': index.out_edges,
+        'out_targets': index.out_targets,
+        'in_offsets': index.in_offsets,
+        'in_edges': index.in_edges,
+        'in_sources': index.in_sources,
+    }
+    return _pack(sections, num_entities=len(entities), num_nodes=len(index.node_ids))
+
+
+def _pack(sections: dict, **fields) -> bytes:
+    """Lays out the sections, aligned, after a directory of their offsets."""
+    chunks = {}
+    for name, section in sections.items():
+        if isinstance(section, array):
+            if sys.byteorder != 'little':
+                section = array(section.typecode, section)
+                section.byteswap()
+            chunks[name] = (section.tobytes(), section.typecode)
+        else:
+            chunks[name] = (section, 'B')
+
+    # Offsets depend on the directory's size, which depends on the offsets.
+    directory_size = 0
+    while True:
+        offset = _align(len(MAGIC) + 8 + directory_size)
+        layout = {}
+        for name, (data, typecode) in chunks.items():
+            layout[name] = [offset, len(data), typecode]
+            offset = _align(offset + len(data))
+        directory = json.dumps({**fields, 'sections': layout}).encode()
+        if len(directory) <= directory_size:
+            break
+        directory_size = len(directory) + 64
+
+    buffer = bytearray(offset)
+    buffer[:len(MAGIC)] = MAGIC
+    struct.pack_into('<Q', buffer, len(MAGIC), len(directory))
+    buffer[len(MAGIC) + 8:len(MAGIC) + 8 + len(directory)] = directory
+    for name, (data, _) in chunks.items():
+        start = layout[name][0]
+        buffer[start:start + len(data)] = data
+    return bytes(buffer)
+
+
+def _section(view: memoryview, typecode: str):
+    if typecode == 'B':
+        return view
+    if sys.byteorder != 'little':
+        section = array(typecode, view.tobytes())
+        section.byteswap()
+        return section
+    return view.cast(typecode)
+
+
+def _align(offset: int) -> int:
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
@@ -0,0 +1,287 @@
+"""Where knowledge graphs are stored: a bucket, laid out as graph_log lays
+graphs out, chosen by KG_GRAPH_STORE:
+
+    gcs             the GCS bucket KNOWLEDGE_GRAPH_BUCKET (the default)
+    file:///{path}  a local directory, to run the service offline
+    memory          this process's memory, for tests
+
+The local and in-memory buckets implement the part of the google-cloud-storage
+Bucket/Blob API that graph_log uses: generations, custom metadata, generation
+preconditions, prefix listing and deletes.
+
+Reads go through tiers: graphs cached in memory (see graph_cache), then local
+copies of their snapshots in KG_SNAPSHOT_DIR, validated by generation (see
+graph_log), then the bucket. With KG_SNAPSHOT_DIR on a local SSD that
+outlives the process, a restarted instance serves graphs from disk rather
+than downloading them again.
+"""
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import requests
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.cloud import storage
+
+from graph_cache import CachedGraph
+from graph_log import append_delta, compact, read_graph, write_snapshot
+
+
+class GraphStore:
+    """Reads and writes the graphs of a bucket (see graph_log)."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def read(self, graph_id: str, cached: Optional[CachedGraph] = None) -> Optional[tuple[dict, tuple[int, int], int, Optional[list]]]:
+        """As graph_log.read_graph."""
+        return read_graph(self.bucket, graph_id, cached=cached)
+
+    def append_delta(self, graph_id: str, version: tuple[int, int], remove_subgraph: dict, add_subgraph: dict) -> int:
+        """As graph_log.append_delta."""
+        return append_delta(
+                self.bucket, graph_id, version=version,
+                remove_subgraph=remove_subgraph, add_subgraph=add_subgraph)
+
+    def write_snapshot(self, graph_id: str, graph: dict, version: Optional[tuple[int, int]] = None) -> None:
+        """As graph_log.write_snapshot."""
+        write_snapshot(self.bucket, graph_id, graph, version=version)
+
+    def compact(self, graph_id: str) -> None:
+        """As graph_log.compact."""
+        compact(self.bucket, graph_id)
+
+    def delete(self, graph_id: str) -> None:
+        """Deletes every blob of the graph."""
+        for blob in self.bucket.list_blobs(prefix=f'{graph_id}.'):
+            try:
+                blob.delete()
+            except NotFound:
+                pass
+
+
+@functools.cache
+def get_graph_store() -> GraphStore:
+    """Returns the process's graph store, as configured by KG_GRAPH_STORE."""
+    kind = os.environ.get('KG_GRAPH_STORE', 'gcs')
+    if kind == 'gcs':
+        bucket_name = os.environ.get("KNOWLEDGE_GRAPH_BUCKET")
+        if not bucket_name:
+            raise ValueError("KNOWLEDGE_GRAPH_BUCKET environment variable not set.")
+        return GraphStore(get_storage_client().bucket(bucket_name))
+    if kind.startswith('file:///'):
+        return GraphStore(LocalBucket(kind[len('file://'):]))
+    if kind == 'memory':
+        return GraphStore(MemoryBucket())
+    raise ValueError(f'Unknown graph store: {kind}')
+
+
+@functools.cache
+def get_storage_client() -> storage.Client:
+    """Returns the process's long-lived storage client, whose HTTP connection
+    pool (of KG_STORAGE_POOL_SIZE connections) is shared by all requests."""
+    storage_client = storage.Client()
+    pool_size = int(os.environ.get('KG_STORAGE_POOL_SIZE', 64))
+    storage_client._http.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size))
+    return storage_client
+
+
+_lock = threading.Lock()
+
+
+class LocalBucket:
+    """Objects in a directory. Object data lives at `{root}/{name}`; each
+    object's generation and metadata live at `{root}/.meta/{name}.json`."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, '.meta'), exist_ok=True)
+
+    def blob(self, name: str) -> "LocalBlob":
+        return LocalBlob(self, name)
+
+    def list_blobs(self, prefix: str = ''):
+        blobs = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d != '.meta']
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                if name.startswith(prefix):
+                    blob = self.blob(name)
+                    try:
+                        blob.reload()
+                    except NotFound:
+                        continue
+                    blobs.append(blob)
+        return sorted(blobs, key=lambda blob: blob.name)
+
+
+class LocalBlob:
+    def __init__(self, bucket: LocalBucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.metadata = None
+        self.size = None
+
+    @property
+    def _path(self) -> str:
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.bucket.root, '.meta', self.name + '.json')
+
+    def _stat(self) -> dict:
+        try:
+            with open(self._meta_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise NotFound(self.name)
+
+    def reload(self) -> None:
+        stat = self._stat()
+        self.generation, self.metadata = stat['generation'], stat['metadata']
+        self.size = os.path.getsize(self._path) if os.path.exists(self._path) else None
+
+    def exists(self) -> bool:
+        return os.path.exists(self._meta_path)
+
+    def download_as_bytes(self) -> bytes:
+        with _lock:
+            if self.generation is not None and self._stat()['generation'] != self.generation:
+                raise NotFound(f'{self.name}#{self.generation}')
+            try:
+                with open(self._path, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                raise NotFound(self.name)
+
+    def download_to_filename(self, filename: str) -> None:
+        with open(filename, 'wb') as f:
+            f.write(self.download_as_bytes())
+
+    def download_as_text(self) -> str:
+        return self.download_as_bytes().decode()
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None) -> None:
+        if isinstance(data, str):
+            data = data.encode()
+
+        with _lock:
+            if if_generation_match is not None:
+                try:
+                    current = self._stat()['generation']
+                except NotFound:
+                    current = 0
+                if current != if_generation_match:
+                    raise PreconditionFailed(self.name)
+
+            self.generation = time.time_ns()
+            _write_atomically(self._path, data)
+            _write_atomically(self._meta_path, json.dumps(
+                {'generation': self.generation, 'metadata': self.metadata}).encode())
+
+    def delete(self) -> None:
+        with _lock:
+            try:
+                os.remove(self._meta_path)
+                os.remove(self._path)
+            except FileNotFoundError:
+                raise NotFound(self.name)
+
+
+class MemoryBucket:
+    """Objects in a dict, of name -> (data, generation, metadata)."""
+
+    def __init__(self):
+        self.objects: dict[str, tuple[bytes, int, Optional[dict]]] = {}
+        self._generation = 0
+
+    def blob(self, name: str) -> "MemoryBlob":
+        return MemoryBlob(self, name)
+
+    def list_blobs(self, prefix: str = ''):
+        blobs = []
+        with _lock:
+            names = sorted(name for name in self.objects if name.startswith(prefix))
+        for name in names:
+            blob = self.blob(name)
+            try:
+                blob.reload()
+            except NotFound:
+                continue
+            blobs.append(blob)
+        return blobs
+
+
+class MemoryBlob:
+    def __init__(self, bucket: MemoryBucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.metadata = None
+        self.size = None
+
+    def _get(self) -> tuple[bytes, int, Optional[dict]]:
+        try:
+            return self.bucket.objects[self.name]
+        except KeyError:
+            raise NotFound(self.name)
+
+    def reload(self) -> None:
+        with _lock:
+            data, self.generation, metadata = self._get()
+        self.metadata = dict(metadata) if metadata is not None else None
+        self.size = len(data)
+
+    def exists(self) -> bool:
+        return self.name in self.bucket.objects
+
+    def download_as_bytes(self) -> bytes:
+        with _lock:
+            data, generation, _ = self._get()
+        if self.generation is not None and generation != self.generation:
+            raise NotFound(f'{self.name}#{self.generation}')
+        return data
+
+    def download_to_filename(self, filename: str) -> None:
+        with open(filename, 'wb') as f:
+            f.write(self.download_as_bytes())
+
+    def download_as_text(self) -> str:
+        return self.download_as_bytes().decode()
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None) -> None:
+        if isinstance(data, str):
+            data = data.encode()
+
+        with _lock:
+            if if_generation_match is not None:
+                current = self.bucket.objects.get(self.name, (None, 0, None))[1]
+                if current != if_generation_match:
+                    raise PreconditionFailed(self.name)
+
+            # Unique across buckets, as local copies are keyed by generation.
+            self.bucket._generation = max(self.bucket._generation + 1, time.time_ns())
+            self.generation = self.bucket._generation
+            metadata = dict(self.metadata) if self.metadata is not None else None
+            self.bucket.objects[self.name] = bytes(data), self.generation, metadata
+
+    def delete(self) -> None:
+        with _lock:
+            if self.bucket.objects.pop(self.name, None) is None:
+                raise NotFound(self.name)
+
+
+def _write_atomically(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,141 @@
+"""Configurable logging and timing of function calls, in place of bare @flog.
+
+KG_INSTRUMENTATION holds a JSON object mapping function names to settings,
+e.g.
+
+    {"*": {"mode": "summary", "sample_rate": 0.01},
+     "get_knowledge_subgraph": {"mode": "timing"}}
+
+A function's settings are looked up by `module.qualname`, then by `qualname`,
+then under "*". The modes are:
+
+    full     log arguments and return values in full, with @flog (async
+             functions are summarized instead)
+    summary  log a summary (e.g. entity and relationship counts of graphs,
+             truncated strings) of arguments and return values, and duration
+    timing   only record durations
+    off      do nothing
+
+Except when off, every call's duration is recorded in the histogram
+`duration_ms.<module>.<qualname>` (see /metrics). Only a sample_rate fraction
+of calls is logged.
+"""
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import time
+
+from floggit import flog
+
+import metrics
+
+DEFAULT_SETTINGS = {'mode': 'summary', 'sample_rate': 1.0}
+MAX_STRING_LENGTH = 200
+
+_config: dict = json.loads(os.environ.get('KG_INSTRUMENTATION', '{}'))
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+
+
+def configure(config: dict) -> None:
+    """Replaces the instrumentation settings of all functions."""
+    global _config
+    _config = config
+
+
+def instrument(func):
+    """Decorates func with logging and timing per its configured settings."""
+    name = f'{func.__module__}.{func.__qualname__}'
+    is_async = inspect.iscoroutinefunction(func)
+    flogged = flog(func)
+
+    def settings() -> dict:
+        return {
+            **DEFAULT_SETTINGS,
+            **_config.get('*', {}),
+            **_config.get(func.__qualname__, {}),
+            **_config.get(name, {}),
+        }
+
+    def begin():
+        s = settings()
+        if s['mode'] == 'off':
+            return None, False
+        log = s['mode'] != 'timing' and random.random() < s['sample_rate']
+        return s['mode'], log
+
+    def end(mode, log, start, args, kwargs, result):
+        duration_ms = 1000 * (time.perf_counter() - start)
+        metrics.observe(f'duration_ms.{name}', duration_ms)
+        if log and (mode == 'summary' or mode == 'full' and is_async):
+            logger.info(
+                name,
+                extra={
+                    'json_fields': {
+                        'function': name,
+                        'duration_ms': round(duration_ms, 3),
+                        'args': _summarize(inspect.getcallargs(func, *args, **kwargs)),
+                        'result': _summarize(result),
+                    }
+                }
+            )
+
+    if is_async:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            mode, log = begin()
+            if mode is None:
+                return await func(*args, **kwargs)
+            start = time.perf_counter()
+            result = None
+            try:
+                result = await func(*args, **kwargs)
+                return result
+            finally:
+                end(mode, log, start, args, kwargs, result)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            mode, log = begin()
+            if mode is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = None
+            try:
+                if log and mode == 'full':
+                    result = flogged(*args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
+                return result
+            finally:
+                end(mode, log, start, args, kwargs, result)
+
+    return wrapper
+
+
+def _summarize(value, depth: int = 0):
+    """Returns a small, JSON-serializable stand-in for value."""
+    if isinstance(value, dict) and 'entities' in value and 'relationships' in value:
+        return {
+            'entities': len(value['entities']),
+            'relationships': len(value['relationships']),
+        }
+    if isinstance(value, dict):
+        if depth > 0:
+            return {'len': len(value)}
+        return {str(k): _summarize(v, depth + 1) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return {'len': len(value)}
+    if isinstance(value, str):
+        if len(value) > MAX_STRING_LENGTH:
+            return value[:MAX_STRING_LENGTH] + f'... ({len(value)} chars)'
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return type(value).__name__
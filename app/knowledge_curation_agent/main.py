@@ -1,9 +1,10 @@
 import os
 from dotenv import load_dotenv
+import functools
 from typing import Optional
 
 from google.adk.runners import Runner
-from google.adk.sessions import VertexAiSessionService
+from google.adk.sessions import BaseSessionService, InMemorySessionService, VertexAiSessionService
 from google.genai import types
 
 from .agent import agent
@@ -13,28 +14,46 @@ load_dotenv()
 
 AGENT_ENGINE_ID = os.environ['SESSION_SERVICE_URI'].split('/')[-1]
 
-session_service = VertexAiSessionService(
-    agent_engine_id=AGENT_ENGINE_ID,
-)
+# Where curation sessions are kept: 'vertex' (durably, in the Agent Engine)
+# or 'memory' (in-process, for the length of the run, sparing a round trip
+# per curation when their history isn't needed).
+SESSION_BACKEND = os.environ.get('KG_SESSION_BACKEND', 'vertex')
 
 _agent_runner: Optional[Runner] = None
 
+
+@functools.cache
+def get_session_service() -> BaseSessionService:
+    """Returns the process's session service, as configured by KG_SESSION_BACKEND."""
+    if SESSION_BACKEND == 'memory':
+        return InMemorySessionService()
+    if SESSION_BACKEND == 'vertex':
+        return VertexAiSessionService(agent_engine_id=AGENT_ENGINE_ID)
+    raise ValueError(f'Unknown session backend: {SESSION_BACKEND}')
+
+
 def get_agent_runner() -> Runner:
-    """Lazily initializes and returns the agent_runner."""
+    """Lazily initializes and returns the agent_runner.
+
+    The API builds it at startup (see warm_up), so that curations don't."""
     global _agent_runner
     if _agent_runner is None:
-        # This code will only run on the FIRST call to main() after startup,
-        # and will run within the background task, freeing up the main thread.
         _agent_runner = Runner(
             agent=agent,
             app_name=AGENT_ENGINE_ID,
-            session_service=session_service
+            session_service=get_session_service()
         )
     return _agent_runner
 
 
+def warm_up() -> None:
+    """Builds the agent runner and its session service ahead of the first curation."""
+    get_agent_runner()
+
+
 async def main(graph_id: str, user_id: str, query: str):
     agent_runner = get_agent_runner()
+    session_service = get_session_service()
 
     session = await session_service.create_session(
             app_name=AGENT_ENGINE_ID,
@@ -45,6 +64,12 @@ async def main(graph_id: str, user_id: str, query: str):
     qwer = agent_runner.run_async(
             user_id=user_id, session_id=session.id, new_message=user_content)
 
-    # Need this line.... Is there a good replacement?
-    async for event in qwer:
-        pass
+    try:
+        # Need this line.... Is there a good replacement?
+        async for event in qwer:
+            pass
+    finally:
+        if SESSION_BACKEND == 'memory':
+            # Nothing reads the session afterwards; don't let them pile up.
+            await session_service.delete_session(
+                    app_name=AGENT_ENGINE_ID, user_id=user_id, session_id=session.id)
@@ -3,83 +3,99 @@ import json
 import os
 import logging
 from dotenv import load_dotenv
-from floggit import flog
-from google.cloud import storage
+from instrumentation import instrument
 from google.cloud import spanner
 
+import change_feed
+import metrics
+from embeddings import embed_documents, entity_text, get_embedder, relationship_text
+from graph_store import get_graph_store
+from utils import fetch_versioned_knowledge_graph, get_spanner_database
+
 load_dotenv()
 
-PROJECT_ID = os.environ['GOOGLE_CLOUD_PROJECT']
-INSTANCE_ID = "knowledge-graph"
-DATABASE_ID = "kg"
 
-SPANNER_DATABASE = spanner.Client(
-        project=PROJECT_ID).instance(INSTANCE_ID).database(DATABASE_ID)
+def fetch_knowledge_graph(graph_id: str) -> tuple[dict, tuple[int, int]]:
+    """Fetches the knowledge graph and its version from the graph store (via
+    the in-process cache, revalidated now).
 
+    The version is the pair (snapshot generation, last logged delta), and is
+    the precondition for storing changes to the graph."""
+    return fetch_versioned_knowledge_graph(graph_id)
 
-def fetch_knowledge_graph(graph_id: str) -> dict:
-    """Fetches the knowledge graph from the Google Cloud Storage bucket."""
-    bucket = _get_bucket()
-    blob = bucket.blob(f"{graph_id}.json")
-    if not blob.exists():
-        return {"entities": {}, "relationships": []}
-    else:
-        content = blob.download_as_text()
-        return json.loads(content)
 
+def store_knowledge_graph(knowledge_graph: dict, graph_id: str, version: tuple[int, int]) -> None:
+    """Stores the knowledge graph in the graph store, as a snapshot
+    superseding any logged deltas.
 
-def store_knowledge_graph(knowledge_graph: dict, graph_id: str) -> None:
-    """Stores the knowledge graph in the Google Cloud Storage bucket."""
-    bucket = _get_bucket()
-    blob = bucket.blob(f"{graph_id}.json")
-    blob.upload_from_string(
-        json.dumps(knowledge_graph), content_type="application/json"
-    )
+    Raises PreconditionFailed if the snapshot has changed since version."""
+    get_graph_store().write_snapshot(graph_id, knowledge_graph, version=version)
 
-def _get_bucket():
-    storage_client = storage.Client()
-    bucket_name = os.environ.get("KNOWLEDGE_GRAPH_BUCKET")
-    if not bucket_name:
-        raise ValueError("KNOWLEDGE_GRAPH_BUCKET environment variable not set.")
-    return storage_client.get_bucket(bucket_name)
 
+def append_knowledge_graph_delta(
+        graph_id: str, version: tuple[int, int],
+        remove_subgraph: dict, add_subgraph: dict) -> int:
+    """Logs a change to the knowledge graph in the graph store, and publishes
+    it to the change feed.
 
-def fetch_from_database():
-    with SPANNER_DATABASE.snapshot() as snapshot:
-        entities = snapshot.execute_sql("select * from entity")
-    with SPANNER_DATABASE.snapshot() as snapshot:
-        relationships = snapshot.execute_sql("select * from relationship")
+    Raises PreconditionFailed if the graph has changed since version."""
+    seq = get_graph_store().append_delta(
+            graph_id, version=version,
+            remove_subgraph=remove_subgraph, add_subgraph=add_subgraph)
+    change_feed.publish(
+            graph_id, base_version=version, version=(version[0], seq),
+            delta={'remove_subgraph': remove_subgraph, 'add_subgraph': add_subgraph})
+    return seq
 
-    return entities, relationships
 
+@instrument
+def store_graph_delta(graph_id: str, remove_subgraph: dict, add_subgraph: dict):
+    """Mirrors a change to the knowledge graph to Spanner, including the
+    entity_name rows by which spanner_graph finds entities, and embeddings of
+    the added entities and relationships."""
+    entity_embeddings, relationship_embeddings = _embed_delta(graph_id, add_subgraph)
 
-@flog
-def store_graph_delta(remove_subgraph: dict, add_subgraph: dict):
     entities_to_upsert = [
         [
+            graph_id,
             e['entity_id'],
             e['entity_names'],
             dt.datetime.strptime(e['updated_at'], "%Y-%m-%dT%H:%M:%S%z"),
             e['updated_by'],
-            json.dumps(e.get('properties', {}))
+            json.dumps(e.get('properties', {})),
+            embedding
         ]
+        for e, embedding in zip(add_subgraph['entities'].values(), entity_embeddings)
+    ]
+
+    names_to_upsert = [
+        [graph_id, name, e['entity_id']]
         for e in add_subgraph['entities'].values()
+        for name in {name.lower() for name in e['entity_names']}
     ]
 
     relationships_to_upsert = [
         [
+            graph_id,
             r["source_entity_id"],
             r['target_entity_id'],
-            r["relationship"]
+            r["relationship"],
+            embedding
         ]
-        for r in add_subgraph['relationships']
+        for r, embedding in zip(add_subgraph['relationships'], relationship_embeddings)
     ]
 
     entities_to_delete = [
-            [entity_id] for entity_id in remove_subgraph['entities']]
+            [graph_id, entity_id] for entity_id in remove_subgraph['entities']]
+
+    names_to_delete = [
+        [graph_id, name, entity_id]
+        for entity_id, e in remove_subgraph['entities'].items()
+        for name in {name.lower() for name in e.get('entity_names', [])}
+    ]
 
     relationships_to_delete = [
-        (r['source_entity_id'], r['target_entity_id'], r['relationship'])
+        (graph_id, r['source_entity_id'], r['target_entity_id'], r['relationship'])
         for r in remove_subgraph['relationships']
     ]
 
@@ -88,6 +104,10 @@ def store_graph_delta(remove_subgraph: dict, add_subgraph: dict):
             transaction.delete(
                     'relationship', keyset=spanner.KeySet(keys=relationships_to_delete))
 
+        if names_to_delete:
+            transaction.delete(
+                    'entity_name', keyset=spanner.KeySet(keys=names_to_delete))
+
         if entities_to_delete:
             transaction.delete(
                     'entity', keyset=spanner.KeySet(keys=entities_to_delete))
@@ -95,14 +115,21 @@ def store_graph_delta(remove_subgraph: dict, add_subgraph: dict):
         if entities_to_upsert:
             transaction.insert_or_update(
                 'entity',
-                columns=['entity_id', 'entity_names', 'updated_at', 'updated_by', 'properties'],
+                columns=['graph_id', 'entity_id', 'entity_names', 'updated_at', 'updated_by', 'properties', 'embedding'],
                 values=entities_to_upsert
             )
 
+        if names_to_upsert:
+            transaction.insert_or_update(
+                'entity_name',
+                columns=['graph_id', 'name', 'entity_id'],
+                values=names_to_upsert
+            )
+
         if relationships_to_upsert:
             transaction.insert_or_update(
                 'relationship',
-                columns=['source_entity_id', 'target_entity_id', 'relationship'],
+                columns=['graph_id', 'source_entity_id', 'target_entity_id', 'relationship', 'embedding'],
                 values=relationships_to_upsert
             )
 
@@ -113,7 +140,7 @@ def store_graph_delta(remove_subgraph: dict, add_subgraph: dict):
         or relationships_to_delete
     ):
         try:
-            results = SPANNER_DATABASE.run_in_transaction(execute)
+            results = get_spanner_database().run_in_transaction(execute)
         except Exception as e:
             print('Transaction failed; rolled back.')
             logging.exception(e)
@@ -130,3 +157,27 @@ def store_graph_delta(remove_subgraph: dict, add_subgraph: dict):
         'relationships_inserted_or_updated': relationships_to_upsert,
         'relationships_deleted': relationships_to_delete
     }
+
+
+def _embed_delta(graph_id: str, add_subgraph: dict) -> tuple[list, list]:
+    """Embeds the added entities and relationships, in batches.
+
+    If embedding fails, the embeddings are None, so that the delta is still
+    stored, just not found by semantic search."""
+    entities = list(add_subgraph['entities'].values())
+    relationships = add_subgraph['relationships']
+    try:
+        embedder = get_embedder()
+        return (
+            embed_documents(embedder, [entity_text(e) for e in entities]),
+            embed_documents(embedder, [
+                relationship_text(r, add_subgraph['entities']) for r in relationships])
+        )
+    except Exception:
+        metrics.increment('embeddings.failures')
+        logging.warning(
+            'Graph delta stored without embeddings.',
+            exc_info=True,
+            extra={'json_fields': {'graph_id': graph_id}}
+        )
+        return [None] * len(entities), [None] * len(relationships)
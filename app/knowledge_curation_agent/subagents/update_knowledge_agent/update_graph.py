@@ -1,14 +1,26 @@
 import datetime as dt
+import hashlib
 import json
 import logging
+import os
+import random
+import time
+from collections import Counter
 from typing import Optional
-from floggit import flog
+from instrumentation import instrument
+from google.api_core.exceptions import PreconditionFailed
 
 from google.adk.agents.callback_context import CallbackContext
 from google.adk.models import LlmResponse
 
 from .utils import generate_random_string, remove_nonalphanumeric
-from .kg_service import fetch_knowledge_graph, store_knowledge_graph, store_graph_delta
+from .kg_service import fetch_knowledge_graph, append_knowledge_graph_delta, store_graph_delta
+import metrics
+from graph_delta import graph_difference, relationship_key
+from utils import get_graph_index
+
+MAX_WRITE_ATTEMPTS = int(os.environ.get('KG_WRITE_MAX_ATTEMPTS', 5))
+WRITE_BACKOFF_SECONDS = float(os.environ.get('KG_WRITE_BACKOFF_SECONDS', 0.1))
 
 
 def main(callback_context: CallbackContext, llm_response: LlmResponse) -> Optional[LlmResponse]:
@@ -42,7 +54,7 @@ def main(callback_context: CallbackContext, llm_response: LlmResponse) -> Option
         return
 
 
-@flog
+@instrument
 def _update_graph(
         old_subgraph: dict, new_subgraph: dict, user_id: str, graph_id: str
 ) -> None:
@@ -94,7 +106,7 @@ def _update_graph(
             add_subgraph=add_subgraph)
 
 
-@flog
+@instrument
 def _trim_fuzzy_relationships(graph: dict, ignore: set) -> dict:
     '''Remove edges that refer to nonexistent entities.
 
@@ -112,7 +124,7 @@ def _trim_fuzzy_relationships(graph: dict, ignore: set) -> dict:
     return graph
 
 
-@flog
+@instrument
 def _get_valence_entities(graph: dict) -> dict:
     '''Returns a graph's valence entities.
 
@@ -128,7 +140,7 @@ def _get_valence_entities(graph: dict) -> dict:
             if entity['has_external_neighbor']
     }
 
-@flog
+@instrument
 def _get_missing_entity_ids(
         graph: dict, required_entity_ids: set) -> set:
     '''Returns the IDs of entities missing from the graph.'''
@@ -139,7 +151,7 @@ def _get_missing_entity_ids(
     return required_entity_ids - existing_entity_ids
 
 
-@flog
+@instrument
 def _update_graph_metadata(g: dict, user_id: str) -> dict:
     '''Updates the metadata of all entities in the graph.
 
@@ -162,14 +174,18 @@ def _generate_entity_id(name: str) -> str:
     return f"{remove_nonalphanumeric(name)[:4].lower()}.{generate_random_string(length=4)}"
 
 
-@flog
-def _signature(entity):
-    return {
-            k: v for k, v in entity.items()
-            if k in ['entity_names', 'properties']}
+def _signature(entity: dict) -> str:
+    '''Returns a stable hash of the entity's names and properties.
 
+    Names keep their order, since the first is the primary name; properties
+    are serialized with sorted keys.'''
+    canonical = json.dumps(
+            [entity.get('entity_names', []), entity.get('properties', {})],
+            sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
 
-@flog
+
+@instrument
 def _relabel_entities(g: dict, id_mapping: dict) -> dict:
     '''
     Args:
@@ -200,7 +216,7 @@ def _relabel_entities(g: dict, id_mapping: dict) -> dict:
     return g
 
 
-@flog
+@instrument
 def _relabel_inequivalent_entities(g1: dict, g2: dict) -> dict:
     '''
     Args:
@@ -212,8 +228,6 @@ def _relabel_inequivalent_entities(g1: dict, g2: dict) -> dict:
         different from, an entity in g1
     '''
 
-    entities_to_relabel = []
-
     colliding_entity_ids = set(g1['entities']).intersection(g2['entities'])
     entity_ids_to_relabel = [
             entity_id for entity_id in colliding_entity_ids
@@ -230,7 +244,7 @@ def _relabel_inequivalent_entities(g1: dict, g2: dict) -> dict:
     return g2
 
 
-@flog
+@instrument
 def _relabel_equivalent_entities(g1: dict, g2: dict) -> dict:
     '''
     Args:
@@ -241,19 +255,17 @@ def _relabel_equivalent_entities(g1: dict, g2: dict) -> dict:
         dict: g2, with entities equivalent to g1's now assigned with g1's labels 
     '''
 
-    g1_entity_signatures = {
-        entity_id: _signature(entity)
-        for entity_id, entity in g1['entities'].items()
-    }
-    id_mapping = {}
+    # Signature -> ID of the first g1 entity having it
+    g1_entity_ids = {}
+    for entity_id, entity in g1['entities'].items():
+        g1_entity_ids.setdefault(_signature(entity), entity_id)
 
     # Identify equivalent entities
-    for g2_entity_id, g2_entity in g2['entities'].items():
-        g2_entity_signature = _signature(g2_entity)
-        for g1_entity_id, g1_entity_signature in g1_entity_signatures.items():
-            if g2_entity_signature == g1_entity_signature:
-                id_mapping[g2_entity_id] = g1_entity_id
-                break
+    id_mapping = {
+            g2_entity_id: g1_entity_id
+            for g2_entity_id, g2_entity in g2['entities'].items()
+            if (g1_entity_id := g1_entity_ids.get(_signature(g2_entity))) is not None
+    }
 
     g2 = _relabel_entities(g2, id_mapping)
 
@@ -265,7 +277,7 @@ def _relabel_equivalent_entities(g1: dict, g2: dict) -> dict:
     return g2
 
 
-@flog
+@instrument
 def _calc_graph_difference(g1: dict, g2: dict) -> dict:
     '''
     Args:
@@ -275,78 +287,99 @@ def _calc_graph_difference(g1: dict, g2: dict) -> dict:
     Returns:
         dict: The entities/relationships in g1 - g2
 
-    NB: Algo assumes A ~ B <=> A.id == B.id
+    NB: Algo assumes A ~ B <=> A.id == B.id, and compares relationships
+    by (source, target, relationship), counting parallel copies.
     '''
-
-    g1_minus_g2 = {'entities': {}, 'relationships': []}
-    g1_minus_g2['entities'] = {
-            k: v for k, v in g1['entities'].items()
-            if k not in g2['entities']
-    }
-    g1_minus_g2['relationships'] = [
-            rel for rel in g1['relationships']
-            if rel not in g2['relationships']
-    ]
-
-    return g1_minus_g2
+    return graph_difference(g1, g2)
 
 
-@flog
+@instrument
 def _splice_subgraph(
         graph_id: str,
         remove_subgraph: dict,
         add_subgraph: dict):
 
     '''Splices new_subgraph into the knowledge graph identified by graph_id,
-    excising old_subgraph first.'''
-
-    # This is where to add a lock, to be removed either if graph is erroneous or stored.
-    graph = fetch_knowledge_graph(graph_id)
-
-    # Excise old subgraph
-    graph['entities'] = {
-            k: v
-            for k, v in graph['entities'].items()
-            if k not in remove_subgraph['entities']
-    }
-    remove_relationships = [
-            (rel['source_entity_id'], rel['target_entity_id'])
-            for rel in remove_subgraph['relationships']
-    ]
-    graph['relationships'] = [
-            rel for rel in graph['relationships']
-            if (rel['source_entity_id'], rel['target_entity_id'])
-            not in remove_relationships
-    ]
-
-    # Insert new subgraph
-    graph['entities'].update(
-            add_subgraph['entities'])
-    graph['relationships'].extend(
-            add_subgraph['relationships'])
-
-    if invalid_entity_ids := _get_invalid_relationship_entity_ids(graph):
-        logging.warning(
-            'Graph delta not recorded due to invalid relationship entity IDs.',
-            extra={
-                'json_fields': {
-                    'graph_id': graph_id,
-                    'invalid_relationship_entity_ids': list(invalid_entity_ids)
+    excising old_subgraph first.
+
+    Only the delta is written, to the graph's log, on condition that the
+    graph is unchanged since it was read to validate the delta. Otherwise the
+    delta is validated against the new graph and written again, with
+    exponential backoff.'''
+
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        graph, version = fetch_knowledge_graph(graph_id)
+
+        if invalid_entity_ids := _get_invalid_relationship_entity_ids(
+                graph=graph, remove_subgraph=remove_subgraph, add_subgraph=add_subgraph):
+            logging.warning(
+                'Graph delta not recorded due to invalid relationship entity IDs.',
+                extra={
+                    'json_fields': {
+                        'graph_id': graph_id,
+                        'invalid_relationship_entity_ids': list(invalid_entity_ids)
+                    }
                 }
-            }
-        )
-    else:
+            )
+            return
+
+        try:
+            append_knowledge_graph_delta(
+                    graph_id=graph_id,
+                    version=version,
+                    remove_subgraph=remove_subgraph,
+                    add_subgraph=add_subgraph)
+        except PreconditionFailed:
+            metrics.increment('graph_write.conflicts')
+            time.sleep(WRITE_BACKOFF_SECONDS * 2**attempt * random.uniform(0.5, 1.5))
+            continue
+
+        metrics.increment('graph_write.retries', attempt)
         store_graph_delta(
+                graph_id=graph_id,
                 remove_subgraph=remove_subgraph, add_subgraph=add_subgraph)
-        store_knowledge_graph(knowledge_graph=graph, graph_id=graph_id)
-
-
-@flog
-def _get_invalid_relationship_entity_ids(graph: dict) -> set:
-    '''Returns relationship between non-existent entities.'''
+        return
 
-    entity_ids = set(graph['entities'].keys())
-    terminals = set(rel['source_entity_id'] for rel in graph['relationships']).union(
-        rel['target_entity_id'] for rel in graph['relationships'])
+    metrics.increment('graph_write.failures')
+    logging.error(
+        'Graph delta not recorded due to concurrent writes.',
+        extra={
+            'json_fields': {
+                'graph_id': graph_id,
+                'attempts': MAX_WRITE_ATTEMPTS
+            }
+        }
+    )
+
+
+@instrument
+def _get_invalid_relationship_entity_ids(
+        graph: dict, remove_subgraph: dict, add_subgraph: dict) -> set:
+    '''Returns IDs of non-existent entities that relationships would refer
+    to, were the delta spliced into the graph.
+
+    Only relationships added or left dangling by the delta are checked, so
+    the cost scales with the size of the delta.'''
+
+    removed_entity_ids = remove_subgraph['entities'].keys() - add_subgraph['entities'].keys()
+    entity_ids = graph['entities'].keys() - removed_entity_ids | add_subgraph['entities'].keys()
+    terminals = set(rel['source_entity_id'] for rel in add_subgraph['relationships']).union(
+        rel['target_entity_id'] for rel in add_subgraph['relationships'])
+
+    # Relationships of removed entities that are not removed themselves
+    index = get_graph_index(graph)
+    remove_relationships = Counter(map(relationship_key, remove_subgraph['relationships']))
+    for entity_id in removed_entity_ids:
+        if (node := index.position.get(entity_id)) is None:
+            continue
+        relationships = Counter(
+                (entity_id, index.node_ids[target], relationship)
+                for target, relationship in index.out_edges_of(node))
+        relationships.update(
+                (index.node_ids[source], entity_id, relationship)
+                for source, relationship in index.in_edges_of(node)
+                if source != node)
+        if relationships - remove_relationships:
+            terminals.add(entity_id)
 
     return terminals - entity_ids
@@ -1,11 +1,46 @@
-from floggit import flog
-from get_relevant_neighborhood import main as get_relevant_neighborhood
-from get_random_neighborhood import main as get_random_neighborhood
+import asyncio
+import contextlib
+import json
+import os
+from typing import Literal, Optional, Union
+
+from instrumentation import instrument
+import metrics
+from get_relevant_neighborhood import main_async as get_relevant_neighborhood
+from get_relevant_neighborhood import stream_async as stream_relevant_neighborhood
+from get_relevant_neighborhood import batch_async as get_relevant_neighborhoods
+from get_random_neighborhood import main_async as get_random_neighborhood
+from expand_query import main_async as expand_query
+from expand_query import batch_async as expand_queries
 from knowledge_curation_agent.main import main as _curate_knowledge
+from knowledge_curation_agent.main import warm_up as warm_up_curation
+from utils import subscribe_to_changes, warm_up as warm_up_reads
+from curation_queue import CurationScheduler, QueueFull
 
-from fastapi import FastAPI, BackgroundTasks, Body
+from fastapi import FastAPI, Body, HTTPException
+from fastapi.responses import StreamingResponse
 
-app = FastAPI()
+# Looks _curate_knowledge up on each run, so that it can be replaced.
+_curation_scheduler = CurationScheduler.from_env(
+        run=lambda **job: _curate_knowledge(**job))
+
+
+# Graphs to load at startup, comma-separated.
+WARM_GRAPHS = [graph_id for graph_id in os.environ.get('KG_WARM_GRAPHS', '').split(',') if graph_id]
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Before serving, so that no request waits on clients, graphs or the runner.
+    subscribe_to_changes()
+    await asyncio.to_thread(warm_up_reads, WARM_GRAPHS)
+    await asyncio.to_thread(warm_up_curation)
+    _curation_scheduler.start()
+    yield
+    await _curation_scheduler.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 from pydantic import BaseModel
@@ -15,62 +50,120 @@ class CurateRequest(BaseModel):
     user_id: str
     graph_id: str
 
+
+class SearchBatchRequest(BaseModel):
+    queries: list[str]
+    graph_id: str
+    word_boundary: bool = False
+    mode: Literal['substring', 'semantic', 'hybrid'] = 'substring'
+    k: int = 10
+
+
+class ExpandQueryBatchRequest(BaseModel):
+    queries: list[str]
+    graph_id: str
+    word_boundary: bool = False
+    max_chars: Optional[int] = None
+    max_tokens: Optional[int] = None
+
 @app.post('/curate_knowledge')
-def curate_knowledge_route(
-        data: CurateRequest,
-        background_tasks: BackgroundTasks = None) -> dict:
-    background_tasks.add_task(
-            _curate_knowledge,
-            graph_id=data.graph_id,
-            user_id=data.user_id,
-            query=data.query)
+async def curate_knowledge_route(data: CurateRequest) -> dict:
+    '''Queues the curation of the knowledge in the query. Responds 429 if
+    too many curations are already queued.'''
+    try:
+        await _curation_scheduler.submit(
+                graph_id=data.graph_id,
+                user_id=data.user_id,
+                query=data.query)
+    except QueueFull:
+        raise HTTPException(
+                status_code=429,
+                detail='Too many curations are queued. Try again later.',
+                headers={'Retry-After': '5'})
     return {'message': 'All set. Any new or updated knowledge is being curated.'}
 
 
+@app.get('/metrics')
+def metrics_route() -> dict:
+    '''Returns this process's counters and gauges, e.g. graph cache hits,
+    misses and bytes loaded.'''
+    return metrics.snapshot()
+
+
 @app.get('/random_neighborhood')
-@flog
-def random_neighborhood_route(graph_id: str) -> dict:
+@instrument
+async def random_neighborhood_route(
+        graph_id: str, weighting: Literal['uniform', 'degree', 'recency', 'connected'] = 'uniform',
+        count: Optional[int] = None) -> Union[dict, list[dict], None]:
     '''Returns a random neighborhood (entity plus neighbors) from the specified
-    knowledge graph.'''
-    return get_random_neighborhood(graph_id=graph_id)
+    knowledge graph.
+
+    Entities are drawn uniformly, or by weighting: in proportion to their
+    number of relationships (degree), favoring recently updated ones (recency),
+    or uniformly among those with any relationships (connected). With count, a
+    list of that many neighborhoods of distinct entities is returned (fewer if
+    the graph has fewer entities).'''
+    return await get_random_neighborhood(graph_id=graph_id, weighting=weighting, count=count)
 
 
 @app.get("/search")
-@flog
-def search_route(query: str, graph_id: str) -> dict:
+@instrument
+async def search_route(
+        query: str, graph_id: str, word_boundary: bool = False, stream: bool = False,
+        mode: Literal['substring', 'semantic', 'hybrid'] = 'substring', k: int = 10) -> dict:
     '''Returns a neighborhood (a set of entities plus their neighborhoods),
-    relevant to the input query, from the specified knowledge graph.''' 
-    return get_relevant_neighborhood(query=query, graph_id=graph_id)
+    relevant to the input query, from the specified knowledge graph.
+
+    Entities are found by their names occurring in the query or, in semantic
+    mode, as the k entities whose embeddings are nearest the query's. Hybrid
+    mode finds both, keeping only the nearest that are similar enough.
+
+    With stream, the neighborhood is streamed as NDJSON instead: a line
+    {"entity": ...} per entity, then a line {"relationship": ...} per
+    relationship.'''
+    if stream:
+        items = await stream_relevant_neighborhood(
+                query=query, graph_id=graph_id, word_boundary=word_boundary, mode=mode, k=k)
+        return StreamingResponse(
+                (json.dumps(item) + '\n' for item in items),
+                media_type='application/x-ndjson')
+
+    return await get_relevant_neighborhood(
+            query=query, graph_id=graph_id, word_boundary=word_boundary, mode=mode, k=k)
+
+
+@app.post("/search:batch")
+@instrument
+async def search_batch_route(data: SearchBatchRequest) -> list[dict]:
+    '''Returns the neighborhood /search would return for each of the queries,
+    in order, loading the graph once for all of them.'''
+    return await get_relevant_neighborhoods(
+            queries=data.queries, graph_id=data.graph_id,
+            word_boundary=data.word_boundary, mode=data.mode, k=data.k)
 
 
 @app.get("/expand_query")
-@flog
-def expand_query_route(query: str, graph_id: str) -> str:
+@instrument
+async def expand_query_route(
+        query: str, graph_id: str, word_boundary: bool = False,
+        max_chars: Optional[int] = None, max_tokens: Optional[int] = None) -> str:
     """Returns a paragraph that relates what is contained in the knowledge
-    graph, relevant to the input query."""
-    nbhd = get_relevant_neighborhood(query=query, graph_id=graph_id)
-
-    relevant_entities_str = ""
-    for entity in nbhd['entities'].values():
-        entity_name = entity['entity_names'][0]
-        entity_str = ''
-        if entity.get('properties'):
-            entity_str += f"{entity_name} has properties: {str(entity['properties'])}. "
-        if len(entity['entity_names']) > 1:
-            entity_str += f"{entity_name} is also known as: {', '.join(entity['entity_names'][1:])}"
-
-        if entity_str:
-            relevant_entities_str += entity_str + "\n"
-
-    relationships_str = ""
-    for rel in nbhd['relationships']:
-        source_name = nbhd['entities'][rel['source_entity_id']]['entity_names'][0]
-        target_name = nbhd['entities'][rel['target_entity_id']]['entity_names'][0]
-        relationships_str += f"{source_name} {rel['relationship']} {target_name}\n"
-
-    if relevant_entities_str or relationships_str:
-        relevant_subgraph_str = f"(FYI, according to the Knowledge Graph: {relevant_entities_str}\n{relationships_str}.)"
-    else:
-        relevant_subgraph_str = ''
-
-    return relevant_subgraph_str
+    graph, relevant to the input query.
+
+    The entities matched in the query, their relationships and neighbors are
+    related most relevant first, for as long as they fit within max_chars
+    characters or max_tokens tokens (by default, KG_EXPAND_QUERY_MAX_CHARS
+    characters)."""
+    return await expand_query(
+            query=query, graph_id=graph_id, word_boundary=word_boundary,
+            max_chars=max_chars, max_tokens=max_tokens)
+
+
+@app.post("/expand_query:batch")
+@instrument
+async def expand_query_batch_route(data: ExpandQueryBatchRequest) -> list[str]:
+    """Returns the paragraph /expand_query would return for each of the
+    queries, in order, loading the graph once for all of them."""
+    return await expand_queries(
+            queries=data.queries, graph_id=data.graph_id, word_boundary=data.word_boundary,
+            max_chars=data.max_chars, max_tokens=data.max_tokens)
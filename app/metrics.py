@@ -0,0 +1,53 @@
+import bisect
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_histograms = {}
+
+# Upper bounds of histogram buckets, e.g. of durations in milliseconds.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf'))
+
+
+def increment(name: str, value: int = 1) -> None:
+    """Adds value to the named counter."""
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value) -> None:
+    """Records the current value of the named gauge."""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, value: float) -> None:
+    """Records value in the named histogram."""
+    with _lock:
+        if (histogram := _histograms.get(name)) is None:
+            histogram = _histograms[name] = {'count': 0, 'sum': 0, 'buckets': [0] * len(BUCKETS)}
+        histogram['count'] += 1
+        histogram['sum'] += value
+        histogram['buckets'][bisect.bisect_left(BUCKETS, value)] += 1
+
+
+def snapshot() -> dict:
+    """Returns a copy of all counters, gauges and histograms recorded by this process."""
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'histograms': {
+                name: {
+                    'count': histogram['count'],
+                    'sum': histogram['sum'],
+                    'buckets': {
+                        str(bound): count
+                        for bound, count in zip(BUCKETS, histogram['buckets'])
+                    },
+                }
+                for name, histogram in _histograms.items()
+            },
+        }
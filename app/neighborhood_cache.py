@@ -0,0 +1,183 @@
+"""Ready-to-serve neighborhoods of single entities, merged to answer queries.
+
+A fragment is the subgraph get_knowledge_subgraph returns for one entity and
+hop count, plus what is needed to merge it with others: each member's
+neighbors outside the fragment, and the fragment's out-edges to them. The
+neighborhood of several entities is the union of their fragments, plus the
+edges between fragments, with has_external_neighbor set on the members that
+still have a neighbor outside the union.
+
+Relationships are identified by their source and rank, i.e. their position
+among the source's out-edges, which orders them as AdjacencyIndex does and
+stays fixed until the source's edges change.
+"""
+import threading
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Optional
+
+import metrics
+from graph_delta import relationship_key
+from graph_index import AdjacencyIndex
+
+
+@dataclass
+class Fragment:
+    entities: dict
+    relationships: list
+    ranks: list[tuple[str, int]]
+    # Member -> its neighbors outside the fragment
+    external: dict[str, set[str]]
+    # (source, rank, target, relationship) of out-edges leaving the fragment
+    outgoing: list[tuple[str, int, str, str]]
+
+
+class NeighborhoodCache:
+    """LRU cache of a graph's fragments, keyed by entity ID and hop count.
+
+    Fragments are dropped as deltas touch any of their members (see
+    apply_deltas), so that a cached fragment is always current."""
+
+    def __init__(self, graph: dict, max_fragments: int = 1024):
+        self.max_fragments = max_fragments
+        self._fragments: OrderedDict[tuple[str, int], Fragment] = OrderedDict()
+        self._containing: defaultdict[str, set] = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subgraph(self, index: AdjacencyIndex, graph: dict, entity_ids: set[str], num_hops: int) -> dict:
+        """Returns the neighborhood of entity_ids, as get_knowledge_subgraph."""
+        fragments = [self._fragment(index, graph, entity_id, num_hops) for entity_id in entity_ids]
+        return merge_fragments(index, fragments)
+
+    def subgraphs(self, index: AdjacencyIndex, graph: dict, entity_id_sets: list[set[str]], num_hops: int) -> list[dict]:
+        """Like subgraph, for each of entity_id_sets, looking up each entity's
+        fragment once and merging repeated sets once."""
+        fragments = {
+                entity_id: self._fragment(index, graph, entity_id, num_hops)
+                for entity_id in set().union(*entity_id_sets)}
+        merged = {}
+        for entity_ids in map(frozenset, entity_id_sets):
+            if entity_ids not in merged:
+                merged[entity_ids] = merge_fragments(
+                        index, [fragments[entity_id] for entity_id in entity_ids])
+        return [merged[frozenset(entity_ids)] for entity_ids in entity_id_sets]
+
+    def apply_deltas(self, graph: dict, deltas: list[dict]) -> "NeighborhoodCache":
+        """Drops the fragments having a member whose entity or relationships
+        are changed by deltas, i.e. (remove_subgraph, add_subgraph) pairs."""
+        touched = set()
+        for delta in deltas:
+            for subgraph in (delta['remove_subgraph'], delta['add_subgraph']):
+                touched.update(subgraph['entities'])
+                for rel in subgraph['relationships']:
+                    source_id, target_id, _ = relationship_key(rel)
+                    touched.update((source_id, target_id))
+
+        with self._lock:
+            for entity_id in touched:
+                for key in list(self._containing.get(entity_id, ())):
+                    self._drop(key)
+            metrics.increment('neighborhood_cache.invalidations', len(touched))
+        return self
+
+    def _fragment(self, index: AdjacencyIndex, graph: dict, entity_id: str, num_hops: int) -> Fragment:
+        key = entity_id, num_hops
+        with self._lock:
+            if (fragment := self._fragments.get(key)) is not None:
+                self._fragments.move_to_end(key)
+                metrics.increment('neighborhood_cache.hits')
+                return fragment
+
+        metrics.increment('neighborhood_cache.misses')
+        fragment = build_fragment(index, graph, entity_id, num_hops)
+        if self.max_fragments <= 0:
+            return fragment
+
+        with self._lock:
+            self._drop(key)
+            self._fragments[key] = fragment
+            for member in fragment.entities:
+                self._containing[member].add(key)
+            while len(self._fragments) > self.max_fragments:
+                self._drop(next(iter(self._fragments)))
+        return fragment
+
+    def _drop(self, key: tuple[str, int]) -> None:
+        if (fragment := self._fragments.pop(key, None)) is None:
+            return
+        for member in fragment.entities:
+            keys = self._containing[member]
+            keys.discard(key)
+            if not keys:
+                del self._containing[member]
+
+
+def build_fragment(index: AdjacencyIndex, graph: dict, entity_id: str, num_hops: int) -> Fragment:
+    """Traverses the graph for the neighborhood of a single entity."""
+    nodes, valence_nodes = index.neighborhood({index.position[entity_id]}, num_hops=num_hops)
+    members = set(nodes)
+
+    entities = {}
+    relationships, ranks = [], []
+    external, outgoing = {}, []
+    for node in nodes:
+        node_id = index.node_ids[node]
+        entities[node_id] = {
+            **graph['entities'].get(node_id, {}),
+            'id': node_id,
+            'has_external_neighbor': node in valence_nodes
+        }
+        for rank, (target, relationship) in enumerate(index.out_edges_of(node)):
+            target_id = index.node_ids[target]
+            if target in members:
+                relationships.append({
+                    'source_entity_id': node_id,
+                    'target_entity_id': target_id,
+                    'relationship': relationship
+                })
+                ranks.append((node_id, rank))
+            else:
+                outgoing.append((node_id, rank, target_id, relationship))
+        if node in valence_nodes:
+            external[node_id] = {index.node_ids[nbr] for nbr in index.neighbors(node) - members}
+
+    return Fragment(
+            entities=entities, relationships=relationships, ranks=ranks,
+            external=external, outgoing=outgoing)
+
+
+def merge_fragments(index: AdjacencyIndex, fragments: list[Fragment]) -> dict:
+    """Returns the neighborhood of the fragments' entities, ordered as
+    get_knowledge_subgraph orders it."""
+    members: dict[str, tuple[dict, Optional[set]]] = {}
+    for fragment in fragments:
+        for entity_id, entity in fragment.entities.items():
+            members.setdefault(entity_id, (entity, fragment.external.get(entity_id)))
+
+    relationships = {}
+    for fragment in fragments:
+        relationships.update(zip(fragment.ranks, fragment.relationships))
+        for source_id, rank, target_id, relationship in fragment.outgoing:
+            if target_id in members:
+                relationships[source_id, rank] = {
+                    'source_entity_id': source_id,
+                    'target_entity_id': target_id,
+                    'relationship': relationship
+                }
+
+    position = index.position
+    return {
+        'entities': {
+            entity_id: {
+                **entity,
+                'has_external_neighbor': bool(external) and not external <= members.keys()
+            }
+            for entity_id, (entity, external) in sorted(
+                    members.items(), key=lambda item: position[item[0]])
+        },
+        'relationships': [
+            dict(rel)
+            for (source_id, rank), rel in sorted(
+                    relationships.items(), key=lambda item: (position[item[0][0]], item[0][1]))
+        ]
+    }
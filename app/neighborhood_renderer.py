@@ -0,0 +1,147 @@
+"""Renders neighborhoods as the paragraph /expand_query returns, within a
+budget of characters.
+
+The parts of a neighborhood are ranked by relevance to its seeds, the
+entities the query matched: the seeds, then relationships between seeds,
+then relationships between seeds and their neighbors, then the neighbors
+(those related to more seeds first), then any other relationships. Parts are
+taken in that order while they fit the budget, and written out entities
+first, in one join.
+
+Each entity's text depends on the entity alone, so is rendered once per graph
+version and kept by a FragmentRenderer.
+"""
+import os
+import threading
+from collections import Counter, OrderedDict
+from typing import Optional
+
+import metrics
+
+# The budget when a request sets none.
+MAX_CHARS = int(os.environ.get('KG_EXPAND_QUERY_MAX_CHARS', 4000))
+# Characters per token, to budget by tokens without tokenizing.
+CHARS_PER_TOKEN = float(os.environ.get('KG_CHARS_PER_TOKEN', 4))
+
+_PREFIX = '(FYI, according to the Knowledge Graph: '
+_SUFFIX = '.)'
+
+
+def get_budget(max_chars: Optional[int] = None, max_tokens: Optional[int] = None) -> int:
+    """Returns the lesser of max_chars and max_tokens in characters, or
+    MAX_CHARS if neither is given."""
+    budgets = [max_chars] if max_chars is not None else []
+    if max_tokens is not None:
+        budgets.append(int(max_tokens * CHARS_PER_TOKEN))
+    return min(budgets, default=MAX_CHARS)
+
+
+class FragmentRenderer:
+    """LRU cache of rendered entities, keyed by entity ID.
+
+    Entities changed by a new graph version are dropped on rebase, so that a
+    cached fragment is always current."""
+
+    def __init__(self, entities: dict, max_fragments: int = 65536):
+        self.max_fragments = max_fragments
+        self._fragments: OrderedDict[str, tuple[str, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def fragments(self, entities: dict) -> dict[str, tuple[str, str]]:
+        """Returns the (name, line) of each of entities (see render_entity)."""
+        fragments, missing = {}, []
+        with self._lock:
+            for entity_id in entities:
+                if (fragment := self._fragments.get(entity_id)) is not None:
+                    self._fragments.move_to_end(entity_id)
+                    fragments[entity_id] = fragment
+                else:
+                    missing.append(entity_id)
+        metrics.increment('render_cache.hits', len(fragments))
+        metrics.increment('render_cache.misses', len(missing))
+
+        rendered = {entity_id: render_entity(entities[entity_id]) for entity_id in missing}
+        fragments.update(rendered)
+        if self.max_fragments > 0 and rendered:
+            with self._lock:
+                self._fragments.update(rendered)
+                while len(self._fragments) > self.max_fragments:
+                    self._fragments.popitem(last=False)
+        return fragments
+
+    def rebase(self, entities: dict, old_entities: dict) -> "FragmentRenderer":
+        """Drops the fragments of entities changed from old_entities."""
+        if hasattr(entities, 'changes_since') and (
+                narrowed := entities.changes_since(old_entities)) is not None:
+            changed = narrowed[0].keys() | narrowed[1].keys()
+        else:
+            changed = {
+                    entity_id for entity_id in entities.keys() | old_entities.keys()
+                    if entities.get(entity_id) is not old_entities.get(entity_id)}
+        with self._lock:
+            for entity_id in changed:
+                self._fragments.pop(entity_id, None)
+        metrics.increment('render_cache.invalidations', len(changed))
+        return self
+
+
+def render_entity(entity: dict) -> tuple[str, str]:
+    """Returns the entity's name, and the line describing its properties and
+    other names ('' if it has neither)."""
+    name = entity['entity_names'][0]
+    line = ''
+    if entity.get('properties'):
+        line += f"{name} has properties: {str(entity['properties'])}. "
+    if len(entity['entity_names']) > 1:
+        line += f"{name} is also known as: {', '.join(entity['entity_names'][1:])}"
+    return name, line + '\n' if line else ''
+
+
+def render_neighborhood(
+        nbhd: dict, seeds: set[str], max_chars: int = MAX_CHARS,
+        renderer: Optional[FragmentRenderer] = None) -> str:
+    """Returns the paragraph relating the neighborhood, of at most max_chars
+    characters ('' if there is nothing to relate)."""
+    entities, relationships = nbhd['entities'], nbhd['relationships']
+    fragments = (
+            renderer.fragments(entities) if renderer is not None
+            else {entity_id: render_entity(entity) for entity_id, entity in entities.items()})
+
+    degree, seed_links = Counter(), Counter()
+    for rel in relationships:
+        source_id, target_id = rel['source_entity_id'], rel['target_entity_id']
+        degree[source_id] += 1
+        degree[target_id] += 1
+        seed_links[source_id] += target_id in seeds
+        seed_links[target_id] += source_id in seeds
+    ranked = sorted(
+            entities, key=lambda entity_id: (entity_id not in seeds, -seed_links[entity_id], -degree[entity_id]))
+    position = {entity_id: i for i, entity_id in enumerate(ranked)}
+
+    # (rank, is relationship, text) of each part
+    parts = [
+        ((0 if entity_id in seeds else 3, position[entity_id]), False, fragments[entity_id][1])
+        for entity_id in ranked if fragments[entity_id][1]
+    ]
+    for rel in relationships:
+        source_id, target_id = rel['source_entity_id'], rel['target_entity_id']
+        tier = {2: 1, 1: 2, 0: 4}[(source_id in seeds) + (target_id in seeds)]
+        rank = tier, *sorted((position[source_id], position[target_id]))
+        text = f"{fragments[source_id][0]} {rel['relationship']} {fragments[target_id][0]}\n"
+        parts.append((rank, True, text))
+    if not parts:
+        return ''
+    parts.sort(key=lambda part: part[0])
+
+    remaining = max_chars - len(_PREFIX) - len('\n') - len(_SUFFIX)
+    taken = {False: [], True: []}
+    for _, is_relationship, text in parts:
+        if len(text) <= remaining:
+            taken[is_relationship].append(text)
+            remaining -= len(text)
+    if len(taken[False]) + len(taken[True]) < len(parts):
+        metrics.increment('render.truncated')
+    if not taken[False] and not taken[True]:
+        return ''
+
+    return ''.join([_PREFIX, *taken[False], '\n', *taken[True], _SUFFIX])
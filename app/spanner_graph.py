@@ -0,0 +1,239 @@
+"""Reads knowledge graph neighborhoods from Spanner, to which
+kg_service.store_graph_delta mirrors every change.
+
+A read fetches only what the neighborhood needs, in a few queries whose cost
+scales with the neighborhood rather than the graph, all from one consistent
+snapshot:
+
+    seeds      the entities having a name in the query, by the entity_name
+               table (Spanner can't index the elements of entity_names)
+    edges      the seeds' relationships, by the primary key (source) and by
+               the RelationshipByTarget index (target)
+    inner      the relationships between the seeds' neighbors
+    valence    which of the neighbors have a relationship leaving the
+               neighborhood
+    entities   the neighborhood's entities
+
+In semantic mode, the seeds are instead the entities nearest the query by
+the EntityEmbeddingIndex vector index (see embeddings), and in hybrid mode,
+both, keeping only the nearest at least min_similarity similar.
+
+Neighborhoods are 1-hop, and shaped as get_knowledge_subgraph shapes them,
+but ordered by ID. Spanner keys relationships by (source, target,
+relationship), so parallel copies of a relationship are read as one.
+"""
+import os
+import random
+import string
+from typing import Optional
+
+from google.cloud.spanner_v1 import param_types
+
+from embeddings import get_embedder
+from entity_matcher import substrings
+
+# Names longer than this are never matched.
+MAX_NAME_LENGTH = int(os.environ.get('KG_SPANNER_MAX_NAME_LENGTH', 100))
+
+_IDS = param_types.Array(param_types.STRING)
+_PARAM_TYPES = {
+    'graph_id': param_types.STRING,
+    'names': _IDS,
+    'entity_ids': _IDS,
+    'neighbor_ids': _IDS,
+    'member_ids': _IDS,
+    'key': param_types.STRING,
+    'embedding': param_types.Array(param_types.FLOAT32),
+    'k': param_types.INT64,
+}
+
+_SEEDS_SQL = """
+SELECT DISTINCT n.entity_id
+FROM entity_name AS n
+JOIN entity AS e ON e.graph_id = n.graph_id AND e.entity_id = n.entity_id
+WHERE n.graph_id = @graph_id AND n.name IN UNNEST(@names)
+"""
+
+# Nearest first. Rows of other graphs are filtered out after the search, so
+# fewer than k may be found.
+_NEAREST_SQL = """
+SELECT entity_id, distance
+FROM (
+  SELECT entity_id, APPROX_COSINE_DISTANCE(
+      embedding, @embedding, options => JSON '{"num_leaves_to_search": 10}') AS distance
+  FROM entity@{FORCE_INDEX=EntityEmbeddingIndex}
+  WHERE graph_id = @graph_id AND embedding IS NOT NULL
+  ORDER BY distance
+  LIMIT @k
+)
+"""
+
+_EDGES_SQL = """
+SELECT source_entity_id, target_entity_id, relationship
+FROM relationship
+WHERE graph_id = @graph_id AND source_entity_id IN UNNEST(@entity_ids)
+UNION DISTINCT
+SELECT source_entity_id, target_entity_id, relationship
+FROM relationship@{FORCE_INDEX=RelationshipByTarget}
+WHERE graph_id = @graph_id AND target_entity_id IN UNNEST(@entity_ids)
+"""
+
+_INNER_SQL = """
+SELECT source_entity_id, target_entity_id, relationship
+FROM relationship
+WHERE graph_id = @graph_id
+  AND source_entity_id IN UNNEST(@neighbor_ids)
+  AND target_entity_id IN UNNEST(@neighbor_ids)
+"""
+
+_VALENCE_SQL = """
+SELECT source_entity_id
+FROM relationship
+WHERE graph_id = @graph_id
+  AND source_entity_id IN UNNEST(@neighbor_ids)
+  AND target_entity_id NOT IN UNNEST(@member_ids)
+UNION DISTINCT
+SELECT target_entity_id
+FROM relationship@{FORCE_INDEX=RelationshipByTarget}
+WHERE graph_id = @graph_id
+  AND target_entity_id IN UNNEST(@neighbor_ids)
+  AND source_entity_id NOT IN UNNEST(@member_ids)
+"""
+
+_ENTITIES_SQL = """
+SELECT entity_id, entity_names, updated_at, updated_by, properties
+FROM entity
+WHERE graph_id = @graph_id AND entity_id IN UNNEST(@entity_ids)
+"""
+
+_RANDOM_ENTITY_SQL = """
+SELECT entity_id
+FROM entity
+WHERE graph_id = @graph_id AND entity_id >= @key
+ORDER BY entity_id
+LIMIT 1
+"""
+
+
+def get_relevant_neighborhood(
+        database, graph_id: str, query: str, word_boundary: bool = False,
+        mode: str = 'substring', k: int = 10, min_similarity: float = 0.5) -> dict:
+    """Returns the neighborhood of the entities found in query, as
+    utils.get_relevant_entities finds them."""
+    embedding = get_embedder().embed_query(query) if mode != 'substring' else None
+    with database.snapshot(multi_use=True) as snapshot:
+        seeds = set()
+        if mode in ('substring', 'hybrid'):
+            seeds |= _query_ids(
+                    snapshot, _SEEDS_SQL, graph_id=graph_id,
+                    names=sorted(substrings(query, MAX_NAME_LENGTH, word_boundary=word_boundary)))
+        if mode in ('semantic', 'hybrid'):
+            max_distance = 1 - min_similarity if mode == 'hybrid' else 2
+            seeds |= {
+                    entity_id
+                    for entity_id, distance in _query(
+                        snapshot, _NEAREST_SQL, graph_id=graph_id, embedding=embedding, k=k)
+                    if distance <= max_distance}
+        return _get_neighborhood(snapshot, graph_id, seeds)
+
+
+def get_random_neighborhood(database, graph_id: str) -> Optional[dict]:
+    """Returns a random entity and its neighborhood, or None if the graph has
+    no entities.
+
+    The entity is the first at or after a random key, so entities following
+    larger gaps between IDs are likelier to be picked."""
+    entities_and_nbhds = get_random_neighborhoods(database, graph_id, count=1)
+    return entities_and_nbhds[0] if entities_and_nbhds else None
+
+
+def get_random_neighborhoods(database, graph_id: str, count: int) -> list[dict]:
+    """Like get_random_neighborhood, for up to count distinct entities, read
+    from one snapshot. Fewer are returned if draws repeat."""
+    with database.snapshot(multi_use=True) as snapshot:
+        entity_ids = {}
+        for _ in range(count):
+            key = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+            drawn = (
+                _query_ids(snapshot, _RANDOM_ENTITY_SQL, graph_id=graph_id, key=key)
+                or _query_ids(snapshot, _RANDOM_ENTITY_SQL, graph_id=graph_id, key='')
+            )
+            if not drawn:
+                return []
+            entity_ids.update(dict.fromkeys(drawn))
+        nbhds = [_get_neighborhood(snapshot, graph_id, {entity_id}) for entity_id in entity_ids]
+
+    entities_and_nbhds = []
+    for entity_id, nbhd in zip(entity_ids, nbhds):
+        entity = {
+                k: v for k, v in nbhd['entities'][entity_id].items()
+                if k not in ('id', 'has_external_neighbor')}
+        entities_and_nbhds.append({
+            'entity': entity,
+            'entity_neighborhood': nbhd
+        })
+    return entities_and_nbhds
+
+
+def _get_neighborhood(snapshot, graph_id: str, seeds: set[str]) -> dict:
+    if not seeds:
+        return {'entities': {}, 'relationships': []}
+
+    relationships = set(_query(snapshot, _EDGES_SQL, graph_id=graph_id, entity_ids=sorted(seeds)))
+    members = seeds.union(*((source, target) for source, target, _ in relationships))
+    neighbors = sorted(members - seeds)
+
+    valence = set()
+    if neighbors:
+        relationships.update(_query(
+                snapshot, _INNER_SQL, graph_id=graph_id, neighbor_ids=neighbors))
+        valence = _query_ids(
+                snapshot, _VALENCE_SQL, graph_id=graph_id,
+                neighbor_ids=neighbors, member_ids=sorted(members))
+
+    entities = {
+            row[0]: _entity(row)
+            for row in _query(snapshot, _ENTITIES_SQL, graph_id=graph_id, entity_ids=sorted(members))
+    }
+
+    return {
+        'entities': {
+            entity_id: {
+                **entities.get(entity_id, {}),
+                'id': entity_id,
+                'has_external_neighbor': entity_id in valence
+            }
+            for entity_id in sorted(members)
+        },
+        'relationships': [
+            {
+                'source_entity_id': source_id,
+                'target_entity_id': target_id,
+                'relationship': relationship
+            }
+            for source_id, target_id, relationship in sorted(relationships)
+        ]
+    }
+
+
+def _entity(row) -> dict:
+    entity_id, entity_names, updated_at, updated_by, properties = row
+    entity = {'entity_id': entity_id, 'entity_names': list(entity_names)}
+    if updated_at is not None:
+        entity['updated_at'] = updated_at.isoformat(timespec='seconds')
+    if updated_by is not None:
+        entity['updated_by'] = updated_by
+    if properties is not None:
+        entity['properties'] = dict(properties)
+    return entity
+
+
+def _query(snapshot, sql: str, **params) -> list[tuple]:
+    rows = snapshot.execute_sql(
+            sql, params=params,
+            param_types={name: _PARAM_TYPES[name] for name in params})
+    return [tuple(row) for row in rows]
+
+
+def _query_ids(snapshot, sql: str, **params) -> set[str]:
+    return {row[0] for row in _query(snapshot, sql, **params)}
@@ -1,110 +1,274 @@
-import json
+import asyncio
+import functools
+import logging
 import os
-import random
-import networkx as nx
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Iterator, Optional
 
-from google.cloud import storage
-from floggit import flog
+from google.cloud import spanner
+from google.cloud.spanner_v1.database import Database
+from instrumentation import instrument
+
+from entity_matcher import EntityMatcher
+from entity_sampler import EntitySampler
+import metrics
+from change_feed import Change, get_change_feed
+from graph_cache import CachedGraph, GraphCache
+from graph_delta import apply_graph_delta
+from graph_index import AdjacencyIndex
+from graph_store import get_graph_store
+from graph_snapshot import snapshot_adjacency_index
+from neighborhood_cache import NeighborhoodCache
+from neighborhood_renderer import FragmentRenderer
+from vector_index import VectorIndex
 
 load_dotenv()
 
+_graph_cache = GraphCache.from_env()
+NEIGHBORHOOD_CACHE_SIZE = int(os.environ.get('KG_NEIGHBORHOOD_CACHE_SIZE', 1024))
+RENDER_CACHE_SIZE = int(os.environ.get('KG_RENDER_CACHE_SIZE', 65536))
+
+# Where /search and /random_neighborhood read from: 'gcs' (whole graphs, via
+# the cache) or 'spanner' (just the neighborhoods; see spanner_graph).
+READ_BACKEND = os.environ.get('KG_READ_BACKEND', 'gcs')
+SPANNER_INSTANCE_ID = os.environ.get('KG_SPANNER_INSTANCE', 'knowledge-graph')
+SPANNER_DATABASE_ID = os.environ.get('KG_SPANNER_DATABASE', 'kg')
+# How similar to the query an entity must be to be found in hybrid mode, as
+# well as among the k nearest.
+HYBRID_MIN_SIMILARITY = float(os.environ.get('KG_HYBRID_MIN_SIMILARITY', 0.5))
+_inflight_loads: dict[str, asyncio.Future] = {}
+
 
-@flog
-def get_relevant_entities(query: str, entities: dict) -> set[str]:
-    '''Returns a set of entity IDs from the knowledge graph found in the given query.'''
-    relevant_entity_ids = set()
+@instrument
+def get_relevant_entities(query: str, entities: dict, word_boundary: bool = False, mode: str = 'substring', k: int = 10) -> set[str]:
+    '''Returns a set of entity IDs from the knowledge graph found in the given query.
 
-    for entity_id, entity_data in entities.items():
-        for entity_name in entity_data['entity_names']:
-            if entity_name.lower() in query.lower():
-                relevant_entity_ids.add(entity_id)
-                break
+    In 'substring' mode, entity names are matched case-insensitively as
+    substrings of the query, or as whole words if word_boundary is set. In
+    'semantic' mode, the k entities whose embeddings (see vector_index) are
+    most similar to the query's are found instead, and in 'hybrid' mode, both
+    the name matches and those of the k at least HYBRID_MIN_SIMILARITY similar.'''
+    found = set()
+    if mode in ('substring', 'hybrid'):
+        matcher = _get_entity_matcher(entities)
+        found.update(matcher.match(query, word_boundary=word_boundary))
+    if mode in ('semantic', 'hybrid'):
+        min_similarity = HYBRID_MIN_SIMILARITY if mode == 'hybrid' else -1
+        index = _graph_cache.derived(entities, 'vector_index', VectorIndex)
+        found.update(
+                entity_id for entity_id, similarity in index.search(query, k=k)
+                if similarity >= min_similarity)
+    return {entity_id for entity_id in found if entity_id in entities}
 
-    return relevant_entity_ids
+
+@instrument
+def get_relevant_entities_batch(queries: list[str], entities: dict, word_boundary: bool = False, mode: str = 'substring', k: int = 10) -> list[set[str]]:
+    '''Like get_relevant_entities, for each of queries, in one pass over the
+    entity matcher and one over the vector index.'''
+    found = [set() for _ in queries]
+    if mode in ('substring', 'hybrid'):
+        matcher = _get_entity_matcher(entities)
+        for ids, matches in zip(found, matcher.match_batch(queries, word_boundary=word_boundary)):
+            ids.update(matches)
+    if mode in ('semantic', 'hybrid'):
+        min_similarity = HYBRID_MIN_SIMILARITY if mode == 'hybrid' else -1
+        index = _graph_cache.derived(entities, 'vector_index', VectorIndex)
+        for ids, hits in zip(found, index.search_batch(queries, k=k)):
+            ids.update(entity_id for entity_id, similarity in hits if similarity >= min_similarity)
+    return [{entity_id for entity_id in ids if entity_id in entities} for ids in found]
 
 
 def fetch_knowledge_graph(graph_id: str) -> dict:
-    """Fetches the knowledge graph from the Google Cloud Storage bucket."""
-    bucket = _get_bucket()
-    blob = bucket.blob(f"{graph_id}.json")
-    if not blob.exists():
-        return {"entities": {}, "relationships": []}
-    else:
-        content = blob.download_as_text()
-        return json.loads(content)
+    """Fetches the knowledge graph from the graph store (see graph_store).
+
+    Graphs are served from an in-process cache, and only read again when
+    their snapshot or delta log has changed."""
+    return _graph_cache.get(graph_id, _load_knowledge_graph)
+
+
+def fetch_versioned_knowledge_graph(graph_id: str) -> tuple[dict, tuple[int, int]]:
+    """Fetches the knowledge graph and its version, i.e. its snapshot's
+    generation and last logged delta, confirmed against storage just now."""
+    entry = _graph_cache.get_entry(graph_id, _load_knowledge_graph, max_age=0)
+    return entry.graph, entry.version
+
+
+async def fetch_knowledge_graph_async(graph_id: str) -> dict:
+    """Fetches the knowledge graph without blocking the event loop.
+
+    The graph is loaded, and its indexes built, in a worker thread.
+    Concurrent fetches of the same graph share a single in-flight load."""
+    if (load := _inflight_loads.get(graph_id)) is None:
+        load = _inflight_loads[graph_id] = asyncio.ensure_future(
+                asyncio.to_thread(_fetch_indexed_knowledge_graph, graph_id))
+        load.add_done_callback(lambda _: _inflight_loads.pop(graph_id, None))
+    # Shielded, so that a cancelled request doesn't cancel the others' load.
+    return await asyncio.shield(load)
+
+
+def _fetch_indexed_knowledge_graph(graph_id: str) -> dict:
+    g = fetch_knowledge_graph(graph_id)
+    get_graph_index(g)
+    _get_entity_matcher(g['entities']).compile()
+    return g
+
+
+def _load_knowledge_graph(graph_id: str, cached: Optional[CachedGraph]) -> Optional[tuple[dict, tuple[int, int], int, Optional[list]]]:
+    """Reads the knowledge graph, unless it is unchanged since it was cached."""
+    return get_graph_store().read(graph_id, cached=cached)
+
+
+def subscribe_to_changes() -> None:
+    """Has changes pushed by the change feed, if any, applied to the cached
+    graphs."""
+    if (feed := get_change_feed()) is not None:
+        feed.subscribe(_apply_change)
+
+
+def _apply_change(change: Change) -> None:
+    def load(graph_id: str, cached: Optional[CachedGraph]) -> Optional[tuple[dict, tuple[int, int], int, Optional[list]]]:
+        if cached is not None and cached.version == change.version:
+            return None
+        if cached is None or cached.version != change.base_version or change.delta is None:
+            metrics.increment('change_feed.revalidations')
+            return _load_knowledge_graph(graph_id, cached)
+
+        metrics.increment('change_feed.applied')
+        graph = apply_graph_delta(cached.graph, **change.delta)
+        return graph, change.version, cached.nbytes, [change.delta]
+
+    _graph_cache.refresh(change.graph_id, load)
+
+
+def _get_entity_matcher(entities: dict) -> EntityMatcher:
+    return _graph_cache.derived(entities, 'entity_matcher', EntityMatcher)
+
+
+def get_graph_index(graph: dict) -> AdjacencyIndex:
+    """Returns the adjacency index of the graph, built once per cached version
+    (or read from its binary snapshot)."""
+    return _graph_cache.derived(graph, 'adjacency', _build_graph_index)
 
 
-@flog
+def _build_graph_index(graph: dict) -> AdjacencyIndex:
+    return snapshot_adjacency_index(graph) or AdjacencyIndex(graph)
+
+
+def get_entity_sampler(graph: dict, weighting: str = 'uniform') -> EntitySampler:
+    """Returns the sampler of the graph's entities with the given weighting
+    (see entity_sampler), built once per cached version."""
+    return _graph_cache.derived(
+            graph, f'sampler:{weighting}',
+            lambda g: EntitySampler(g, get_graph_index(g), weighting))
+
+
+@instrument
 def get_knowledge_subgraph(entity_ids: set[str], graph: dict, num_hops: Optional[int] = 2) -> dict:
-    """Extracts a subgraph from the knowledge graph centered around the given entity IDs."""
-
-    mdg = _knowledge_graph_to_nx(graph)
-
-    # Relevant entities' 1-hop neighbors.
-    nbrs1 = {
-            nbr for entity_id in entity_ids
-            for nbr in mdg.to_undirected().neighbors(entity_id)
-            if nbr not in entity_ids
-    }
-
-    if num_hops > 1:
-        # Relevant entities' 2-hop neighbors.
-        nbrs2 = {
-                nbr for entity_id in nbrs1
-                for nbr in mdg.to_undirected().neighbors(entity_id)
-                if nbr not in entity_ids and nbr not in nbrs1
-        }
+    """Extracts a subgraph from the knowledge graph centered around the given entity IDs.
+
+    Unless KG_NEIGHBORHOOD_CACHE_SIZE is 0, the subgraph is merged from the
+    cached neighborhoods of each entity, which are only traversed once per
+    change to them."""
 
-        outer_nbrs = nbrs2
-    else:
-        nbrs2 = set()
-        outer_nbrs = nbrs1
-
-    # outer neighbors connected to at least one external entity
-    valence_entities = {
-            entity_id for entity_id in outer_nbrs 
-            if set(mdg.to_undirected().neighbors(entity_id)) - entity_ids - nbrs1 - nbrs2
-    }
-
-    subgraph = mdg.subgraph(entity_ids|nbrs1|nbrs2)
-    subgraph_json = nx.node_link_data(subgraph, edges="links")
-
-    # Reformat
-    subgraph = {
-        'entities': {
-            node['entity_id']: dict(**node, has_external_neighbor=(node['entity_id'] in valence_entities))
-            for node in subgraph_json['nodes']
-        },
-        'relationships': [
-            {
-                'source_entity_id': link['source'],
-                'target_entity_id': link['target'],
-                'relationship': link['relationship']
-            } for link in subgraph_json['links']
-        ]
-    }
+    index = get_graph_index(graph)
+    if NEIGHBORHOOD_CACHE_SIZE > 0:
+        return _get_neighborhood_cache(graph).subgraph(index, graph, entity_ids, num_hops)
+
+    subgraph = {'entities': {}, 'relationships': []}
+    for item in iter_knowledge_subgraph(entity_ids, graph, num_hops=num_hops):
+        if 'entity' in item:
+            subgraph['entities'][item['entity']['id']] = item['entity']
+        else:
+            subgraph['relationships'].append(item['relationship'])
 
     return subgraph
 
 
-def _knowledge_graph_to_nx(g: dict) -> "nx.MultiDiGraph":
-    """Converts the knowledge graph dictionary to a NetworkX MultiDiGraph."""
-    mdg = nx.MultiDiGraph()
-    mdg.add_nodes_from((k, v) for k, v in g["entities"].items())
-    mdg.add_edges_from(
-        (
-            rel["source_entity_id"],
-            rel["target_entity_id"],
-            {"relationship": rel["relationship"]},
-        )
-        for rel in g.get("relationships", [])
-    )
-    return mdg
-
-
-def _get_bucket():
-    storage_client = storage.Client()
-    bucket_name = os.environ.get("KNOWLEDGE_GRAPH_BUCKET")
-    return storage_client.get_bucket(bucket_name)
+@instrument
+def get_knowledge_subgraphs(entity_id_sets: list[set[str]], graph: dict, num_hops: Optional[int] = 2) -> list[dict]:
+    """Like get_knowledge_subgraph, for each of entity_id_sets, sharing the
+    neighborhoods of entities in more than one set, and of repeated sets."""
+    index = get_graph_index(graph)
+    if NEIGHBORHOOD_CACHE_SIZE > 0:
+        return _get_neighborhood_cache(graph).subgraphs(index, graph, entity_id_sets, num_hops)
+
+    subgraphs = {}
+    for entity_ids in map(frozenset, entity_id_sets):
+        if entity_ids not in subgraphs:
+            subgraphs[entity_ids] = get_knowledge_subgraph(entity_ids, graph, num_hops=num_hops)
+    return [subgraphs[frozenset(entity_ids)] for entity_ids in entity_id_sets]
+
+
+def iter_knowledge_subgraph(entity_ids: set[str], graph: dict, num_hops: Optional[int] = 2) -> Iterator[dict]:
+    """Yields the subgraph get_knowledge_subgraph would return, one item at a
+    time: {'entity': ...} for each entity, then {'relationship': ...} for
+    each relationship, without holding the whole subgraph in memory."""
+
+    index = get_graph_index(graph)
+    seeds = {index.position[entity_id] for entity_id in entity_ids}
+
+    # Neighbors within num_hops, and outer neighbors connected to at least one external entity
+    nodes, valence_nodes = index.neighborhood(seeds, num_hops=num_hops)
+    members = set(nodes)
+
+    # Reformat, matching NetworkX's node-link output for the induced subgraph
+    for node in nodes:
+        yield {
+            'entity': {
+                **graph['entities'].get(index.node_ids[node], {}),
+                'id': index.node_ids[node],
+                'has_external_neighbor': node in valence_nodes
+            }
+        }
+
+    for node in nodes:
+        for target, relationship in index.out_edges_of(node):
+            if target in members:
+                yield {
+                    'relationship': {
+                        'source_entity_id': index.node_ids[node],
+                        'target_entity_id': index.node_ids[target],
+                        'relationship': relationship
+                    }
+                }
+
+
+def _get_neighborhood_cache(graph: dict) -> NeighborhoodCache:
+    return _graph_cache.derived(
+            graph, 'neighborhoods',
+            lambda g: NeighborhoodCache(g, max_fragments=NEIGHBORHOOD_CACHE_SIZE))
+
+
+def get_fragment_renderer(entities: dict) -> FragmentRenderer:
+    """Returns the cache of the entities' rendered text (see
+    neighborhood_renderer), kept across versions of the graph."""
+    return _graph_cache.derived(
+            entities, 'fragments',
+            lambda e: FragmentRenderer(e, max_fragments=RENDER_CACHE_SIZE))
+
+
+@functools.cache
+def get_spanner_database() -> Database:
+    """Returns the process's Spanner database, whose session pool is shared
+    by all requests. Set SPANNER_EMULATOR_HOST to use the emulator."""
+    return spanner.Client(project=os.environ.get('GOOGLE_CLOUD_PROJECT')).instance(
+            SPANNER_INSTANCE_ID).database(SPANNER_DATABASE_ID)
+
+
+def warm_up(graph_ids: list[str]) -> None:
+    """Builds the graph store's client (and Spanner's, if read from), and
+    loads graph_ids into the graph cache with the indexes searches use, so
+    that the first requests don't."""
+    get_graph_store()
+    if READ_BACKEND == 'spanner':
+        get_spanner_database()
+        return
+
+    for graph_id in graph_ids:
+        try:
+            graph = fetch_knowledge_graph(graph_id)
+        except Exception:
+            logging.warning('Graph not warmed.', exc_info=True, extra={'json_fields': {'graph_id': graph_id}})
+            continue
+        get_graph_index(graph)
+        _get_entity_matcher(graph['entities'])
@@ -0,0 +1,207 @@
+"""In-process nearest-neighbor search over entity embeddings.
+
+Embeddings are the rows of contiguous matrices, either float32 or, with
+KG_EMBEDDING_QUANTIZATION=int8, int8 with a float32 scale per row (a quarter
+of the memory, for a little precision). Queries are searched in batches: a
+matrix product per block of rows, then argpartition for the top k.
+
+A graph's embeddings are also stored in a sidecar file next to each snapshot
+(see graph_log), in the snapshot's entity order, which readers memory-map, so
+that only the entities changed since the snapshot are embedded in-process.
+The sidecar file holds MAGIC, the size of a JSON header, the header, and
+then, aligned, the per-row scales (if quantized) and the matrix.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+from typing import Optional
+
+import numpy as np
+
+from embeddings import DIMENSION, Embedder, embed_documents, entity_text, get_embedder
+from graph_snapshot import SnapshotEntities
+
+MAGIC = b'KGEMB001'
+QUANTIZATION = os.environ.get('KG_EMBEDDING_QUANTIZATION', 'float32')
+BLOCK_ROWS = 8192
+_ALIGNMENT = 64
+
+
+class EmbeddingMatrix:
+    """Unit-length embeddings, one per row, possibly quantized."""
+
+    def __init__(self, values: np.ndarray, scales: Optional[np.ndarray] = None):
+        self.values = values
+        self.scales = scales
+
+    @classmethod
+    def quantize(cls, vectors, quantization: str = QUANTIZATION) -> "EmbeddingMatrix":
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, DIMENSION)
+        if quantization == 'float32':
+            return cls(np.ascontiguousarray(vectors))
+        if quantization == 'int8':
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            values = np.round(vectors / scales[:, None]).astype(np.int8)
+            return cls(values, scales.astype(np.float32))
+        raise ValueError(f'Unknown quantization: {quantization}')
+
+    @classmethod
+    def open(cls, path: str) -> "EmbeddingMatrix":
+        """Memory-maps the sidecar file at path."""
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not an embeddings file.')
+        (header_size,) = struct.unpack_from('<Q', buffer, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(buffer[start:start + header_size])
+        rows, offset = header['rows'], _align(start + header_size)
+
+        scales = None
+        if header['dtype'] == 'int8':
+            scales = np.frombuffer(buffer, dtype='<f4', count=rows, offset=offset)
+            offset = _align(offset + scales.nbytes)
+        values = np.frombuffer(
+                buffer, dtype=np.dtype(header['dtype']).newbyteorder('<'),
+                count=rows * DIMENSION, offset=offset).reshape(rows, DIMENSION)
+        return cls(values, scales)
+
+    def dump(self) -> bytes:
+        """Returns the sidecar file of the matrix."""
+        header = json.dumps({'dtype': self.values.dtype.name, 'rows': len(self)}).encode()
+        chunks = [MAGIC, struct.pack('<Q', len(header)), header]
+        for array in ([self.scales] if self.scales is not None else []) + [self.values]:
+            chunks.append(bytes(_align(sum(map(len, chunks))) - sum(map(len, chunks))))
+            chunks.append(np.ascontiguousarray(array).astype(array.dtype.newbyteorder('<')).tobytes())
+        return b''.join(chunks)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """Returns the cosine similarity of each row (axis 0) with each
+        query (axis 1)."""
+        scores = np.empty((len(self), len(queries)), dtype=np.float32)
+        for start in range(0, len(self), BLOCK_ROWS):
+            block = self.values[start:start + BLOCK_ROWS]
+            block_scores = block.astype(np.float32, copy=False) @ queries.T
+            if self.scales is not None:
+                block_scores *= self.scales[start:start + BLOCK_ROWS, None]
+            scores[start:start + len(block)] = block_scores
+        return scores
+
+    def to_float32(self) -> np.ndarray:
+        vectors = self.values.astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[:, None]
+        return vectors
+
+
+class VectorIndex:
+    """Embeddings of a graph's entities, searched by cosine similarity.
+
+    Entities are embedded when the index is built, except those whose
+    embeddings are stored alongside the snapshot they were loaded from. On
+    rebase, only added or changed entities are embedded; the rows of removed
+    or changed entities are masked out.
+    """
+
+    def __init__(self, entities: dict, embedder: Embedder = None, quantization: str = QUANTIZATION):
+        self.embedder = embedder or get_embedder()
+        self.quantization = quantization
+        self._lock = threading.Lock()
+        self.entity_ids: list[str] = []
+        self._rows: dict[str, int] = {}
+        self._matrices: list[EmbeddingMatrix] = []
+        self._alive = np.zeros(0, dtype=bool)
+
+        if (stored := _stored_embeddings(entities)) is not None:
+            self._append(entities.snapshot.entity_ids, stored)
+            self._update(entities, entities.changes.keys())
+        else:
+            self._append(list(entities), self._embed(entities, list(entities)))
+
+    def search(self, query: str, k: int = 10) -> list[tuple[str, float]]:
+        """Returns the (entity ID, similarity) of the k entities most similar
+        to query, most similar first."""
+        return self.search_batch([query], k=k)[0]
+
+    def search_batch(self, queries: list[str], k: int = 10) -> list[list[tuple[str, float]]]:
+        """Like search, for each of queries, in one pass over the index."""
+        vectors = np.asarray(
+                [self.embedder.embed_query(query) for query in queries],
+                dtype=np.float32).reshape(len(queries), DIMENSION)
+        with self._lock:
+            k = min(k, int(self._alive.sum()))
+            if k <= 0:
+                return [[] for _ in queries]
+            scores = np.concatenate([matrix.scores(vectors) for matrix in self._matrices])
+            scores[~self._alive] = -np.inf
+            top = np.argpartition(-scores, k - 1, axis=0)[:k]
+
+            results = []
+            for j in range(len(queries)):
+                rows = top[:, j][np.argsort(-scores[top[:, j], j])]
+                results.append([(self.entity_ids[i], float(scores[i, j])) for i in rows])
+            return results
+
+    def embeddings(self, entity_ids: list[str]) -> np.ndarray:
+        """Returns the float32 embeddings of entity_ids, one per row."""
+        with self._lock:
+            vectors = np.concatenate(
+                    [matrix.to_float32() for matrix in self._matrices]
+                    or [np.zeros((0, DIMENSION), dtype=np.float32)])
+            return vectors[[self._rows[entity_id] for entity_id in entity_ids]]
+
+    def rebase(self, entities: dict, old_entities: dict) -> "VectorIndex":
+        """Updates the index in place from old_entities to entities."""
+        if hasattr(entities, 'changes_since') and (
+                narrowed := entities.changes_since(old_entities)) is not None:
+            entities, old_entities = narrowed
+            changed = entities.keys() | old_entities.keys()
+        else:
+            changed = {
+                    entity_id for entity_id in entities.keys() | old_entities.keys()
+                    if entities.get(entity_id) is not old_entities.get(entity_id)}
+        self._update(entities, changed)
+        return self
+
+    def _update(self, entities: dict, changed) -> None:
+        """Replaces the embeddings of the changed entity IDs."""
+        added = [entity_id for entity_id in changed if entity_id in entities]
+        matrix = self._embed(entities, added)
+        with self._lock:
+            for entity_id in changed:
+                if (row := self._rows.pop(entity_id, None)) is not None:
+                    self._alive[row] = False
+            self._append(added, matrix)
+
+    def _append(self, entity_ids: list[str], matrix: EmbeddingMatrix) -> None:
+        start = len(self.entity_ids)
+        self.entity_ids.extend(entity_ids)
+        self._rows.update((entity_id, start + i) for i, entity_id in enumerate(entity_ids))
+        self._matrices.append(matrix)
+        self._alive = np.concatenate([self._alive, np.ones(len(entity_ids), dtype=bool)])
+
+    def _embed(self, entities: dict, entity_ids: list[str]) -> EmbeddingMatrix:
+        embeddings = embed_documents(
+                self.embedder, [entity_text(entities[entity_id]) for entity_id in entity_ids])
+        return EmbeddingMatrix.quantize(embeddings, self.quantization)
+
+
+def _stored_embeddings(entities: dict) -> Optional[EmbeddingMatrix]:
+    """Returns the stored embeddings of the snapshot entities are loaded from,
+    if any."""
+    if not isinstance(entities, SnapshotEntities) or entities.snapshot.load_embeddings is None:
+        return None
+    matrix = entities.snapshot.load_embeddings()
+    if matrix is None or len(matrix) != entities.snapshot.num_entities:
+        return None
+    return matrix
+
+
+def _align(offset: int) -> int:
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
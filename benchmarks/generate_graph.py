@@ -0,0 +1,113 @@
+"""Generates a synthetic knowledge graph, plus queries that mention its entities.
+
+Entity names are made of random syllables, with a configurable number of
+aliases. Relationship endpoints are drawn from a Zipf-like distribution over
+entities, so that `--skew` controls how much the degree concentrates on hubs
+(0 is uniform).
+
+    uv run python benchmarks/generate_graph.py --entities 10000 \\
+        --relationships 30000 --data-dir /tmp/kg-bench --graph-id bench
+
+This writes the graph as `{graph_id}.json` into a local graph store at --data-dir,
+and the queries as `{data_dir}/{graph_id}.queries.json`. Its embeddings are
+made by the local hashing embedder unless KG_EMBEDDER is set.
+"""
+import argparse
+import datetime as dt
+import itertools
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+os.environ.setdefault('KG_EMBEDDER', 'hashing')
+
+from graph_store import GraphStore, LocalBucket  # noqa: E402
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ten', 'su', 'vor', 'el', 'dan', 'pi', 'qua', 'zo', 'ber', 'nix']
+RELATIONSHIPS = ['works with', 'reports to', 'owns', 'is part of', 'depends on', 'was founded by', 'uses']
+FILLER = ['what', 'did', 'say', 'about', 'the', 'latest', 'update', 'on', 'and', 'with', 'for', 'project']
+
+
+def random_name(rng: random.Random) -> str:
+    return ' '.join(
+            ''.join(rng.choices(SYLLABLES, k=rng.randint(2, 3))).capitalize()
+            for _ in range(rng.randint(1, 2)))
+
+
+def generate_graph(
+        num_entities: int, num_relationships: int,
+        max_aliases: int = 2, skew: float = 1.0, seed: int = 0) -> dict:
+    """Returns a random graph whose relationship endpoints follow a Zipf-like
+    distribution with exponent skew."""
+    rng = random.Random(seed)
+    updated_at = dt.datetime(2025, 1, 1, tzinfo=dt.UTC)
+
+    entities = {}
+    for i in range(num_entities):
+        entity_id = f'ent.{i:07d}'
+        entities[entity_id] = {
+            'entity_id': entity_id,
+            'updated_at': (updated_at + dt.timedelta(minutes=i)).isoformat(timespec='seconds'),
+            'updated_by': 'benchmark',
+            'entity_names': [random_name(rng) for _ in range(1 + rng.randint(0, max_aliases))],
+            'properties': {'rank': i} if rng.random() < 0.5 else {},
+        }
+
+    entity_ids = list(entities)
+    cum_weights = list(itertools.accumulate((rank + 1) ** -skew for rank in range(num_entities)))
+    sources = rng.choices(entity_ids, cum_weights=cum_weights, k=num_relationships)
+    targets = rng.choices(entity_ids, cum_weights=cum_weights, k=num_relationships)
+    relationships = [
+        {
+            'source_entity_id': source,
+            'target_entity_id': target,
+            'relationship': rng.choice(RELATIONSHIPS),
+        }
+        for source, target in zip(sources, targets)
+    ]
+
+    return {'entities': entities, 'relationships': relationships}
+
+
+def generate_queries(graph: dict, num_queries: int, seed: int = 0) -> list[str]:
+    """Returns queries mentioning 0-3 of the graph's entities by one of their names."""
+    rng = random.Random(seed)
+    entities = list(graph['entities'].values())
+    queries = []
+    for _ in range(num_queries):
+        words = rng.choices(FILLER, k=rng.randint(3, 8))
+        for entity in rng.sample(entities, k=min(len(entities), rng.randint(0, 3))):
+            words.insert(rng.randint(0, len(words)), rng.choice(entity['entity_names']))
+        queries.append(' '.join(words))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entities', type=int, default=10_000)
+    parser.add_argument('--relationships', type=int, default=30_000)
+    parser.add_argument('--aliases', type=int, default=2, help='Maximum aliases per entity.')
+    parser.add_argument('--skew', type=float, default=1.0, help='Degree skew (0 is uniform).')
+    parser.add_argument('--queries', type=int, default=1_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default='/tmp/kg-bench')
+    parser.add_argument('--graph-id', default='bench')
+    args = parser.parse_args()
+
+    graph = generate_graph(
+            args.entities, args.relationships,
+            max_aliases=args.aliases, skew=args.skew, seed=args.seed)
+    store = GraphStore(LocalBucket(args.data_dir))
+    store.delete(args.graph_id)
+    store.write_snapshot(args.graph_id, graph, version=(0, 0))
+
+    with open(os.path.join(args.data_dir, f'{args.graph_id}.queries.json'), 'w') as f:
+        json.dump(generate_queries(graph, args.queries, seed=args.seed), f)
+
+
+if __name__ == '__main__':
+    main()
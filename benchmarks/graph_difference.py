@@ -0,0 +1,100 @@
+"""Times graph differencing and splicing on large synthetic graphs.
+
+Compares the hashed-key implementations in app/graph_delta.py with the
+list-scanning versions they replaced. The old versions are quadratic, so they
+are timed on a small fraction of the graph and extrapolated.
+
+    uv run python benchmarks/graph_difference.py --relationships 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from graph_delta import apply_graph_delta, graph_difference  # noqa: E402
+
+
+def old_graph_difference(g1: dict, g2: dict) -> dict:
+    return {
+        'entities': {k: v for k, v in g1['entities'].items() if k not in g2['entities']},
+        'relationships': [rel for rel in g1['relationships'] if rel not in g2['relationships']],
+    }
+
+
+def old_apply_graph_delta(graph: dict, remove_subgraph: dict, add_subgraph: dict) -> dict:
+    entities = {k: v for k, v in graph['entities'].items() if k not in remove_subgraph['entities']}
+    remove_relationships = [
+            (rel['source_entity_id'], rel['target_entity_id'])
+            for rel in remove_subgraph['relationships']]
+    relationships = [
+            rel for rel in graph['relationships']
+            if (rel['source_entity_id'], rel['target_entity_id']) not in remove_relationships]
+    entities.update(add_subgraph['entities'])
+    relationships.extend(add_subgraph['relationships'])
+    return {'entities': entities, 'relationships': relationships}
+
+
+def random_graph(num_entities: int, num_relationships: int) -> dict:
+    entity_ids = [f'e{i}' for i in range(num_entities)]
+    return {
+        'entities': {
+            entity_id: {'entity_id': entity_id, 'entity_names': [entity_id]}
+            for entity_id in entity_ids
+        },
+        'relationships': [
+            {
+                'source_entity_id': random.choice(entity_ids),
+                'target_entity_id': random.choice(entity_ids),
+                'relationship': random.choice(['knows', 'owns', 'part of']),
+            }
+            for _ in range(num_relationships)
+        ],
+    }
+
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--relationships', type=int, default=100_000)
+    parser.add_argument('--entities', type=int, default=20_000)
+    parser.add_argument('--changed', type=float, default=0.1,
+                        help='Fraction of relationships differing between the graphs.')
+    parser.add_argument('--old-sample', type=int, default=2_000,
+                        help='Relationships of g1 to time the old versions on.')
+    args = parser.parse_args()
+
+    random.seed(0)
+    g1 = random_graph(args.entities, args.relationships)
+    num_changed = int(args.changed * args.relationships)
+    g2 = {
+        'entities': g1['entities'],
+        'relationships': g1['relationships'][num_changed:]
+        + random_graph(args.entities, num_changed)['relationships'],
+    }
+    remove_subgraph = {'entities': {}, 'relationships': g1['relationships'][:num_changed]}
+    add_subgraph = {'entities': {}, 'relationships': g2['relationships'][-num_changed:]}
+
+    sample = {'entities': g1['entities'], 'relationships': g1['relationships'][:args.old_sample]}
+    scale = args.relationships / args.old_sample
+
+    new_diff = timed(graph_difference, g1, g2)
+    old_diff = timed(old_graph_difference, sample, g2) * scale
+    new_splice = timed(apply_graph_delta, g1, remove_subgraph, add_subgraph)
+    old_splice = timed(old_apply_graph_delta, sample, remove_subgraph, add_subgraph) * scale
+
+    print(f'{args.relationships} relationships, {num_changed} changed')
+    print(f'{"":<12}{"old (est.)":>14}{"new":>12}{"speedup":>10}')
+    for name, old, new in [('difference', old_diff, new_diff), ('splice', old_splice, new_splice)]:
+        print(f'{name:<12}{old:>13.2f}s{new:>11.3f}s{old / new:>9.0f}x')
+
+
+if __name__ == '__main__':
+    main()
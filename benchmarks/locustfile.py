@@ -0,0 +1,91 @@
+"""Locust scenarios for the API, using the queries from generate_graph.py.
+
+Reads (/search, streamed, batched or not, /expand_query, /random_neighborhood) are tagged `read`, and
+/curate_knowledge is tagged `curate`, so either can be excluded:
+
+    uv run locust -f benchmarks/locustfile.py --headless -u 50 -r 10 -t 1m \\
+        --host http://127.0.0.1:8080 --graph-id bench --exclude-tags curate
+"""
+import json
+import os
+import random
+
+from locust import HttpUser, constant, events, tag, task
+
+
+@events.init_command_line_parser.add_listener
+def _(parser):
+    parser.add_argument('--graph-id', default='bench')
+    parser.add_argument('--data-dir', default='/tmp/kg-bench',
+                        help='Where generate_graph.py wrote {graph_id}.queries.json.')
+    parser.add_argument('--word-boundary', action='store_true')
+
+
+class KnowledgeGraphUser(HttpUser):
+    wait_time = constant(0)
+
+    def on_start(self):
+        options = self.environment.parsed_options
+        self.graph_id = options.graph_id
+        self.word_boundary = options.word_boundary
+        with open(os.path.join(options.data_dir, f'{self.graph_id}.queries.json')) as f:
+            self.queries = json.load(f)
+
+    def params(self) -> dict:
+        return {
+            'query': random.choice(self.queries),
+            'graph_id': self.graph_id,
+            'word_boundary': self.word_boundary,
+        }
+
+    @tag('read')
+    @task(10)
+    def search(self):
+        self.client.get('/search', params=self.params(), name='/search')
+
+    @tag('read')
+    @task(2)
+    def search_stream(self):
+        with self.client.get(
+                '/search', params={**self.params(), 'stream': True},
+                name='/search?stream', stream=True) as response:
+            for _ in response.iter_lines():
+                pass
+
+    @tag('read')
+    @task(1)
+    def search_batch(self):
+        self.client.post('/search:batch', json={
+            'queries': random.sample(self.queries, k=min(len(self.queries), 16)),
+            'graph_id': self.graph_id,
+            'word_boundary': self.word_boundary,
+        }, name='/search:batch')
+
+    @tag('read')
+    @task(5)
+    def expand_query(self):
+        self.client.get('/expand_query', params=self.params(), name='/expand_query')
+
+    @tag('read')
+    @task(2)
+    def random_neighborhood(self):
+        self.client.get(
+                '/random_neighborhood', params={'graph_id': self.graph_id},
+                name='/random_neighborhood')
+
+    @tag('read')
+    @task(1)
+    def random_neighborhoods(self):
+        self.client.get(
+                '/random_neighborhood',
+                params={'graph_id': self.graph_id, 'weighting': 'degree', 'count': 16},
+                name='/random_neighborhood?count')
+
+    @tag('curate')
+    @task(1)
+    def curate_knowledge(self):
+        self.client.post('/curate_knowledge', json={
+            'query': random.choice(self.queries),
+            'user_id': f'bench-{random.randrange(100)}',
+            'graph_id': self.graph_id,
+        })
@@ -0,0 +1,109 @@
+"""Compares recall and latency of semantic entity retrieval with the substring matcher.
+
+Queries mention 1-3 entities of a synthetic graph (generate_graph.py) by one
+of their names, either exactly or, with --typos, with one character of each
+name dropped. Recall is the fraction of mentioned entities found: by the
+EntityMatcher, among the top --k of the VectorIndex, or by either, as hybrid
+mode finds them (the top --k at least --min-similarity similar).
+
+    uv run python benchmarks/retrieval.py --entities 10000 --k 10 --typos \\
+        --quantization int8
+
+Uses the local hashing embedder unless KG_EMBEDDER is set.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+os.environ.setdefault('KG_EMBEDDER', 'hashing')
+
+from entity_matcher import EntityMatcher  # noqa: E402
+from generate_graph import FILLER, generate_graph  # noqa: E402
+from vector_index import VectorIndex  # noqa: E402
+
+
+def generate_queries(graph: dict, num_queries: int, typos: bool, seed: int = 0) -> list[tuple[str, set[str]]]:
+    """Returns (query, IDs of the entities it mentions) pairs."""
+    rng = random.Random(seed)
+    entity_ids = list(graph['entities'])
+    queries = []
+    for _ in range(num_queries):
+        words = rng.choices(FILLER, k=rng.randint(3, 8))
+        mentioned = set(rng.sample(entity_ids, k=min(len(entity_ids), rng.randint(1, 3))))
+        for entity_id in mentioned:
+            name = rng.choice(graph['entities'][entity_id]['entity_names'])
+            if typos and len(name) > 3:
+                i = rng.randrange(1, len(name))
+                name = name[:i] + name[i + 1:]
+            words.insert(rng.randint(0, len(words)), name)
+        queries.append((' '.join(words), mentioned))
+    return queries
+
+
+def evaluate(name: str, retrieve, queries: list[tuple[str, set[str]]]) -> None:
+    durations, found, mentioned = [], 0, 0
+    for query, entity_ids in queries:
+        start = time.perf_counter()
+        retrieved = retrieve(query)
+        durations.append(1000 * (time.perf_counter() - start))
+        found += len(entity_ids & retrieved)
+        mentioned += len(entity_ids)
+
+    durations.sort()
+    print(
+        f'{name:<12} recall {found / mentioned:6.1%}   '
+        f'mean {statistics.mean(durations):8.3f} ms   '
+        f'p95 {durations[int(0.95 * (len(durations) - 1))]:8.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entities', type=int, default=10_000)
+    parser.add_argument('--queries', type=int, default=1_000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--typos', action='store_true', help='Misspell the names in queries.')
+    parser.add_argument('--quantization', choices=['float32', 'int8'], default='float32')
+    parser.add_argument(
+            '--min-similarity', type=float, default=0.3,
+            help='Lower than the server default, for the weaker hashing embedder.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    graph = generate_graph(args.entities, 0, seed=args.seed)
+    queries = generate_queries(graph, args.queries, typos=args.typos, seed=args.seed)
+
+    start = time.perf_counter()
+    matcher = EntityMatcher(graph['entities'])
+    matcher.compile()
+    print(f'matcher built in {time.perf_counter() - start:.2f} s')
+    start = time.perf_counter()
+    index = VectorIndex(graph['entities'], quantization=args.quantization)
+    print(f'vector index built in {time.perf_counter() - start:.2f} s')
+
+    def search(query: str, min_similarity: float = -1) -> set[str]:
+        return {
+                entity_id for entity_id, similarity in index.search(query, k=args.k)
+                if similarity >= min_similarity}
+
+    evaluate('substring', matcher.match, queries)
+    evaluate(f'semantic@{args.k}', search, queries)
+    evaluate(
+            f'hybrid@{args.k}',
+            lambda query: matcher.match(query) | search(query, args.min_similarity),
+            queries)
+
+    # Batched, as a batch of queries is searched in one pass over the index.
+    start = time.perf_counter()
+    for i in range(0, len(queries), 64):
+        index.search_batch([query for query, _ in queries[i:i + 64]], k=args.k)
+    print(f'semantic@{args.k} batched: mean {1000 * (time.perf_counter() - start) / len(queries):8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
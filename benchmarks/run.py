@@ -0,0 +1,121 @@
+"""Reports p50/p95/p99 latency and throughput of the API per graph size.
+
+For each size, generates a graph (generate_graph.py), starts the API against
+it (serve.py), runs the Locust scenarios headless (locustfile.py), and
+collects the per-endpoint statistics Locust writes with --csv.
+
+    uv run python benchmarks/run.py --sizes 1000:3000,10000:30000,100000:300000 \\
+        --users 50 --duration 1m
+
+Sizes are entities:relationships. Extra arguments after `--` are passed to
+Locust, e.g. `-- --exclude-tags curate`.
+"""
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def wait_until_up(url: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def read_stats(csv_prefix: str) -> list[dict]:
+    with open(f'{csv_prefix}_stats.csv') as f:
+        return [
+            {
+                'name': row['Name'],
+                'requests': int(row['Request Count']),
+                'failures': int(row['Failure Count']),
+                'p50': row['50%'],
+                'p95': row['95%'],
+                'p99': row['99%'],
+                'rps': float(row['Requests/s']),
+            }
+            for row in csv.DictReader(f)
+        ]
+
+
+def run_size(args, num_entities: int, num_relationships: int, locust_args: list[str]) -> list[dict]:
+    graph_id = f'bench-{num_entities}-{num_relationships}'
+    subprocess.run([
+        sys.executable, os.path.join(BENCHMARKS_DIR, 'generate_graph.py'),
+        '--entities', str(num_entities),
+        '--relationships', str(num_relationships),
+        '--skew', str(args.skew),
+        '--data-dir', args.data_dir,
+        '--graph-id', graph_id,
+    ], check=True)
+
+    host = f'http://127.0.0.1:{args.port}'
+    server = subprocess.Popen([
+        sys.executable, os.path.join(BENCHMARKS_DIR, 'serve.py'),
+        '--data-dir', args.data_dir,
+        '--port', str(args.port),
+        '--llm-latency', str(args.llm_latency),
+    ])
+    try:
+        wait_until_up(f'{host}/metrics')
+        # Load the graph once, so the first requests do not time the cold load.
+        urllib.request.urlopen(f'{host}/random_neighborhood?graph_id={graph_id}', timeout=600)
+
+        csv_prefix = os.path.join(args.data_dir, graph_id)
+        subprocess.run([
+            sys.executable, '-m', 'locust',
+            '-f', os.path.join(BENCHMARKS_DIR, 'locustfile.py'),
+            '--headless', '--only-summary',
+            '--host', host,
+            '-u', str(args.users),
+            '-r', str(args.spawn_rate),
+            '-t', args.duration,
+            '--csv', csv_prefix,
+            '--graph-id', graph_id,
+            '--data-dir', args.data_dir,
+            *locust_args,
+        ], check=True)
+        return read_stats(csv_prefix)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000:3000,10000:30000,100000:300000',
+                        help='Comma-separated entities:relationships pairs.')
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--spawn-rate', type=int, default=10)
+    parser.add_argument('--duration', default='1m')
+    parser.add_argument('--llm-latency', type=float, default=1.0)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--data-dir', default='/tmp/kg-bench')
+    args, locust_args = parser.parse_known_args()
+    locust_args = [arg for arg in locust_args if arg != '--']
+
+    print(f'{"entities":>9} {"rels":>8}  {"endpoint":<22}{"requests":>9}{"fails":>7}'
+          f'{"p50 ms":>8}{"p95 ms":>8}{"p99 ms":>8}{"req/s":>9}')
+    for size in args.sizes.split(','):
+        num_entities, num_relationships = map(int, size.split(':'))
+        for stats in run_size(args, num_entities, num_relationships, locust_args):
+            print(f'{num_entities:>9} {num_relationships:>8}  {stats["name"]:<22}'
+                  f'{stats["requests"]:>9}{stats["failures"]:>7}'
+                  f'{stats["p50"]:>8}{stats["p95"]:>8}{stats["p99"]:>8}{stats["rps"]:>9.1f}',
+                  flush=True)
+
+
+if __name__ == '__main__':
+    main()
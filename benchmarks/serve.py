@@ -0,0 +1,94 @@
+"""Runs the API for benchmarking, against a local graph store and a stubbed LLM.
+
+Reads and writes go to the local graph store at --data-dir instead of GCS, and
+writes to Spanner are skipped. /curate_knowledge runs the real graph update
+path (_update_graph), but the agent's LLM calls are replaced by a
+deterministic edit of the relevant neighborhood, after a simulated latency.
+
+    uv run python benchmarks/serve.py --data-dir /tmp/kg-bench --port 8080
+"""
+import argparse
+import asyncio
+import copy
+import hashlib
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+# Configuration the app requires at import. Nothing reaches these services.
+os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'kg-bench')
+os.environ.setdefault('SESSION_SERVICE_URI', 'agentengine://kg-bench')
+os.environ.setdefault('SPANNER_EMULATOR_HOST', 'localhost:9010')
+os.environ.setdefault('KG_EMBEDDER', 'hashing')
+os.environ.setdefault('KG_SESSION_BACKEND', 'memory')
+os.environ.setdefault('KG_INSTRUMENTATION', '{"*": {"mode": "timing"}}')
+
+import uvicorn  # noqa: E402
+
+import main as app_main  # noqa: E402
+from get_relevant_neighborhood import main as get_relevant_neighborhood  # noqa: E402
+from knowledge_curation_agent.subagents.update_knowledge_agent import update_graph  # noqa: E402
+
+
+def stub_llm(neighborhood: dict, query: str) -> dict:
+    """Returns the replacement subgraph an LLM might write for neighborhood:
+    the same entities and relationships, plus an entity named after the query
+    and related to the first of the others."""
+    replacement = copy.deepcopy(neighborhood)
+    for entity in replacement['entities'].values():
+        entity.pop('id', None)
+        entity.pop('has_external_neighbor', None)
+
+    name = 'Note ' + hashlib.blake2b(query.encode(), digest_size=4).hexdigest()
+    replacement['entities'][name] = {
+        'entity_id': name,
+        'entity_names': [name],
+        'properties': {'query': query},
+    }
+    if neighborhood['entities']:
+        replacement['relationships'].append({
+            'source_entity_id': name,
+            'target_entity_id': next(iter(neighborhood['entities'])),
+            'relationship': 'mentions',
+        })
+    return replacement
+
+
+def stub_curate_knowledge(llm_latency: float):
+    async def curate_knowledge(graph_id: str, user_id: str, query: str):
+        # One model call for the fetch agent, and one for the update agent.
+        await asyncio.sleep(llm_latency)
+        neighborhood = await asyncio.to_thread(
+                get_relevant_neighborhood, query=query, graph_id=graph_id)
+        await asyncio.sleep(llm_latency)
+        await asyncio.to_thread(
+                update_graph._update_graph,
+                old_subgraph=neighborhood,
+                new_subgraph=stub_llm(neighborhood, query),
+                user_id=user_id,
+                graph_id=graph_id)
+
+    return curate_knowledge
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='/tmp/kg-bench')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--llm-latency', type=float, default=1.0,
+                        help='Seconds each stubbed model call takes.')
+    args = parser.parse_args()
+
+    # Read when the store is first used, i.e. after this.
+    os.environ['KG_GRAPH_STORE'] = 'file://' + os.path.abspath(args.data_dir)
+    update_graph.store_graph_delta = lambda *args, **kwargs: None
+    app_main._curate_knowledge = stub_curate_knowledge(args.llm_latency)
+
+    uvicorn.run(app_main.app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
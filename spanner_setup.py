@@ -1,53 +1,72 @@
 google_sql_ddl_statements = [
     # 0. DROP tables
     '''DROP INDEX IF EXISTS RelationshipEmbeddingIndex''',
+    '''DROP INDEX IF EXISTS RelationshipByTarget''',
     '''DROP TABLE IF EXISTS relationship''',
+    '''DROP TABLE IF EXISTS entity_name''',
     '''DROP INDEX IF EXISTS EntityEmbeddingIndex''',
     '''DROP TABLE IF EXISTS entity''',
 
     # 1. CREATE entity table
     '''
     CREATE TABLE entity (
+        graph_id STRING(MAX) NOT NULL,
         entity_id STRING(MAX) NOT NULL,
         entity_names ARRAY<STRING(MAX)> NOT NULL,
         updated_at TIMESTAMP,
         updated_by STRING(MAX),
         properties JSON,
         embedding ARRAY<FLOAT32>(vector_length=>768)
-    ) PRIMARY KEY (entity_id)
+    ) PRIMARY KEY (graph_id, entity_id)
     ''',
-    
-    # 2. CREATE relationship table (NON-INTERLEAVED)
+
+    # 2. CREATE entity_name table, indexing entities by (lowercased) name,
+    # since array elements can't be indexed
+    '''
+    CREATE TABLE entity_name (
+        graph_id STRING(MAX) NOT NULL,
+        name STRING(MAX) NOT NULL,
+        entity_id STRING(MAX) NOT NULL
+    ) PRIMARY KEY (graph_id, name, entity_id)
+    ''',
+
+    # 3. CREATE relationship table (NON-INTERLEAVED), plus an index of
+    # relationships by target (by source is the primary key)
     '''
     CREATE TABLE relationship (
+        graph_id STRING(MAX) NOT NULL,
         source_entity_id STRING(MAX) NOT NULL,
         target_entity_id STRING(MAX) NOT NULL,
         relationship STRING(MAX) NOT NULL,
         embedding ARRAY<FLOAT32>(vector_length=>768)
-    ) PRIMARY KEY (source_entity_id, target_entity_id, relationship)
+    ) PRIMARY KEY (graph_id, source_entity_id, target_entity_id, relationship)
     ''',
-    
-    # 3. Add Foreign Key constraints
+
+    '''
+    CREATE INDEX RelationshipByTarget ON relationship (graph_id, target_entity_id)
+    ''',
+
+    # 4. Add Foreign Key constraints
     '''
     ALTER TABLE relationship 
     ADD CONSTRAINT FK_SourceEntity 
-    FOREIGN KEY (source_entity_id) REFERENCES entity (entity_id)
+    FOREIGN KEY (graph_id, source_entity_id) REFERENCES entity (graph_id, entity_id)
     ''',
     
     '''
     ALTER TABLE relationship 
     ADD CONSTRAINT FK_TargetEntity 
-    FOREIGN KEY (target_entity_id) REFERENCES entity (entity_id)
+    FOREIGN KEY (graph_id, target_entity_id) REFERENCES entity (graph_id, entity_id)
     ''',
 
-    # 4. CREATE VECTOR INDEX for entity
+    # 5. CREATE VECTOR INDEX for entity
     '''
     CREATE VECTOR INDEX EntityEmbeddingIndex ON entity (embedding)
     WHERE embedding IS NOT NULL
     OPTIONS (distance_type = 'COSINE')
     ''',
     
-    # 5. CREATE VECTOR INDEX for relationship
+    # 6. CREATE VECTOR INDEX for relationship
     '''
     CREATE VECTOR INDEX RelationshipEmbeddingIndex ON relationship (embedding)
     WHERE embedding IS NOT NULL
@@ -56,26 +75,94 @@ google_sql_ddl_statements = [
 ]
 
 
+import argparse
+import datetime as dt
+import json
 import os
 from google.cloud import spanner
 
 # --- Configuration ---
 # IMPORTANT: Replace these placeholders with your actual Spanner instance and database IDs.
 # Ensure you are authenticated (e.g., using 'gcloud auth application-default login')
+# To use the Spanner emulator instead, set SPANNER_EMULATOR_HOST (e.g. localhost:9010);
+# the instance and database are then created if missing.
 PROJECT_ID = os.environ.get("GCLOUD_PROJECT") or "staging-470600"
-INSTANCE_ID = "knowledge-graph"
-DATABASE_ID = "kg"
+INSTANCE_ID = os.environ.get("KG_SPANNER_INSTANCE", "knowledge-graph")
+DATABASE_ID = os.environ.get("KG_SPANNER_DATABASE", "kg")
+BATCH_SIZE = 1000
 
 
-def run_dml():
-    """Initializes the Spanner client and runs the transaction."""
-
+def get_database():
     spanner_client = spanner.Client(project=PROJECT_ID)
     instance = spanner_client.instance(INSTANCE_ID)
     database = instance.database(DATABASE_ID)
+
+    if os.environ.get("SPANNER_EMULATOR_HOST"):
+        if not instance.exists():
+            instance = spanner_client.instance(
+                    INSTANCE_ID, configuration_name=f"projects/{PROJECT_ID}/instanceConfigs/emulator-config")
+            instance.create().result()
+            database = instance.database(DATABASE_ID)
+        if not database.exists():
+            database.create().result()
+
+    return database
+
+
+def run_dml():
+    """Initializes the Spanner client and runs the transaction."""
+
+    database = get_database()
     operation = database.update_ddl(google_sql_ddl_statements)
     operation.result()
 
 
+def load_graph(graph_id: str, path: str):
+    """Loads a graph, as stored in the GCS bucket (e.g. by
+    benchmarks/generate_graph.py), into the tables."""
+    with open(path) as f:
+        graph = json.load(f)
+
+    entities = [
+        [
+            graph_id,
+            entity_id,
+            entity['entity_names'],
+            dt.datetime.fromisoformat(entity['updated_at']) if entity.get('updated_at') else None,
+            entity.get('updated_by'),
+            json.dumps(entity.get('properties', {}))
+        ]
+        for entity_id, entity in graph['entities'].items()
+    ]
+    names = sorted({
+        (graph_id, name.lower(), entity_id)
+        for entity_id, entity in graph['entities'].items()
+        for name in entity['entity_names']
+    })
+    relationships = sorted({
+        (graph_id, r['source_entity_id'], r['target_entity_id'], r['relationship'])
+        for r in graph['relationships']
+    })
+
+    database = get_database()
+    for table, columns, rows in [
+        ('entity', ['graph_id', 'entity_id', 'entity_names', 'updated_at', 'updated_by', 'properties'], entities),
+        ('entity_name', ['graph_id', 'name', 'entity_id'], names),
+        ('relationship', ['graph_id', 'source_entity_id', 'target_entity_id', 'relationship'], relationships),
+    ]:
+        for start in range(0, len(rows), BATCH_SIZE):
+            with database.batch() as batch:
+                batch.insert_or_update(table, columns=columns, values=rows[start:start + BATCH_SIZE])
+
+
 if __name__ == "__main__":
-    run_dml()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--load", metavar="GRAPH_JSON",
+                        help="Load this graph into the existing tables, instead of recreating them.")
+    parser.add_argument("--graph-id", help="The graph to load the graph JSON as.")
+    args = parser.parse_args()
+
+    if args.load:
+        load_graph(args.graph_id, args.load)
+    else:
+        run_dml()